@@ -1,32 +1,340 @@
+from bisect import bisect_left
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, HTTPServer
+import argparse
+import os
+import selectors
+import signal
+import socket
+import sys
+import threading
 import time
 
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Info, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+
+HELLO = b"hello from demo app (ca-central-1)\n"
+VERSION = "1.0.0"
+KNOWN_PATHS = ("/", "/metrics")
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+class Shard:
+    """One thread's request counters; only the owning thread writes to it."""
+
+    __slots__ = ("requests", "buckets", "sums", "in_flight")
+
+    def __init__(self):
+        self.requests = defaultdict(int)     # (path, code) -> count
+        self.buckets = {}                    # path -> per-bucket counts, last is +Inf
+        self.sums = defaultdict(float)       # path -> total seconds
+        self.in_flight = 0
+
+class RequestMetrics:
+    """Request counters, latency histograms and in-flight gauge.
+
+    The hot path increments plain ints in a thread-local shard (no locks, no
+    prometheus_client children); collect() merges every shard at scrape time.
+    Shards outlive their threads so counters stay monotonic.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = Shard()
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    @staticmethod
+    def observe(shard, path, code, seconds):
+        shard.requests[(path, code)] += 1
+        counts = shard.buckets.get(path)
+        if counts is None:
+            counts = shard.buckets[path] = [0] * (len(LATENCY_BUCKETS) + 1)
+        counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        shard.sums[path] += seconds
+
+    def collect(self):
+        with self._lock:
+            shards = list(self._shards)
+        requests, buckets, sums, in_flight = defaultdict(int), {}, defaultdict(float), 0
+        for shard in shards:
+            # dict(...) copies in one step under the GIL, so a writer adding a
+            # key mid-scrape cannot break the iteration
+            for key, n in dict(shard.requests).items():
+                requests[key] += n
+            for path, counts in dict(shard.buckets).items():
+                merged = buckets.setdefault(path, [0] * len(counts))
+                for i, n in enumerate(counts):
+                    merged[i] += n
+            for path, total in dict(shard.sums).items():
+                sums[path] += total
+            in_flight += shard.in_flight
+
+        c = CounterMetricFamily("demo_requests", "HTTP requests served", labels=["path", "code"])
+        for (path, code), n in sorted(requests.items()):
+            c.add_metric([path, str(code)], n)
+        yield c
+
+        h = HistogramMetricFamily("demo_request_duration_seconds", "HTTP request latency",
+                                  labels=["path"])
+        for path, counts in sorted(buckets.items()):
+            cumulative, acc = [], 0
+            for bound, n in zip(LATENCY_BUCKETS + (float("inf"),), counts):
+                acc += n
+                cumulative.append(("+Inf" if bound == float("inf") else str(bound), acc))
+            h.add_metric([path], cumulative, sums[path])
+        yield h
+
+        g = GaugeMetricFamily("demo_requests_in_flight", "HTTP requests being served")
+        g.add_metric([], in_flight)
+        yield g
+
+class Exposition:
+    """generate_latest() cached for ttl seconds; concurrent scrapes share one render."""
+
+    def __init__(self, registry, ttl=1.0):
+        self.registry = registry
+        self.ttl = ttl
+        self._body = b""
+        self._at = float("-inf")
+        self._lock = threading.Lock()
+
+    def body(self):
+        if time.monotonic() - self._at < self.ttl:
+            return self._body
+        with self._lock:
+            if time.monotonic() - self._at >= self.ttl:
+                self._body = generate_latest(self.registry)
+                self._at = time.monotonic()
+            return self._body
+
+METRICS = RequestMetrics()
+REGISTRY.register(METRICS)    # process/platform/gc collectors are registered by default
+Info("demo_app", "demo app build info").info({"version": VERSION})
+EXPOSITION = Exposition(REGISTRY)
+
 class Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections open between requests; every response must
+    # carry Content-Length so the client knows where it ends.
+    protocol_version = "HTTP/1.1"
+    # idle keep-alive connections are closed after this many seconds
+    timeout = 5
+    disable_nagle_algorithm = True
+    parked = False
+
+    def handle(self):
+        park = getattr(self.server, "park", None)
+        self.handle_one_request()
+        while not self.close_connection:
+            if park is not None and not self.pending():
+                # idle between requests: hand the socket back to the server's
+                # selector instead of blocking this worker on the next read
+                self.parked = park(self.request)
+                if self.parked:
+                    return
+            self.handle_one_request()
+
+    def pending(self):
+        """True if the next request is already buffered or readable."""
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
     def do_GET(self):
-        if self.path == '/metrics':
-            # simple Prometheus-style metrics
-            metrics = [
-                'demo_requests_total{path="/"} 42',
-                'demo_app_info{version="1.0.0"} 1'
-            ]
-            body = "\n".join(metrics) + "\n"
-            self.send_response(200)
-            self.send_header("Content-Type", "text/plain; version=0.0.4")
-            self.end_headers()
-            self.wfile.write(body.encode())
-        else:
-            self.send_response(200)
-            self.send_header("Content-Type", "text/plain")
-            self.end_headers()
-            self.wfile.write(b"hello from demo app (ca-central-1)\n")
+        start = time.perf_counter()
+        shard = METRICS.shard()
+        shard.in_flight += 1
+        try:
+            if self.path == '/metrics':
+                self.reply(EXPOSITION.body(), CONTENT_TYPE_LATEST)
+            else:
+                self.reply(HELLO, "text/plain")
+        finally:
+            shard.in_flight -= 1
+            path = self.path if self.path in KNOWN_PATHS else "other"
+            METRICS.observe(shard, path, 200, time.perf_counter() - start)
+
+    def reply(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if self.server.draining:
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
     def log_message(self, format, *args):
         return
 
+class SimpleHandler(Handler):
+    # --mode simple serves one connection at a time: an idle keep-alive client
+    # would block everyone else until the timeout, so close after each response
+    protocol_version = "HTTP/1.0"
+
+class PoolHTTPServer(HTTPServer):
+    """HTTPServer that hands each request to a fixed-size worker pool.
+
+    Unlike ThreadingHTTPServer the thread count is bounded; requests beyond
+    workers + max_pending are refused straight away instead of queueing
+    without limit behind slow clients. Idle keep-alive connections are parked
+    in a selector (up to max_idle) and go back to the pool only when the next
+    request arrives, so they never pin a worker.
+    """
+
+    request_queue_size = 128
+
+    def __init__(self, address, handler, workers=16, max_pending=256, max_idle=1024):
+        super().__init__(address, handler)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="http")
+        self.slots = threading.BoundedSemaphore(workers + max_pending)
+        self.draining = False
+        self.max_idle = max_idle
+        self.idle_timeout = handler.timeout
+        self._idle = {}                 # socket -> (client address, parked at)
+        self._to_park = []
+        self._park_lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._reactor = threading.Thread(target=self._watch_idle, name="http-idle", daemon=True)
+        self._reactor.start()
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            self.shutdown_request(request)
+            return
+        try:
+            self.pool.submit(self._work, request, client_address)
+        except RuntimeError:        # pool shut down by drain()
+            self.slots.release()
+            self.shutdown_request(request)
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def _work(self, request, client_address):
+        parked = False
+        try:
+            parked = self.finish_request(request, client_address).parked
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            if not parked:
+                self.shutdown_request(request)
+            self.slots.release()
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):   # client went away
+            super().handle_error(request, client_address)
+
+    def park(self, request):
+        """Queue an idle keep-alive socket for the selector; False if full/draining."""
+        with self._park_lock:
+            if self.draining or len(self._idle) + len(self._to_park) >= self.max_idle:
+                return False
+            self._to_park.append((request, request.getpeername()))
+        self._wake_w.send(b"\0")
+        return True
+
+    def _watch_idle(self):
+        while True:
+            events = self._selector.select(timeout=0.5)
+            now = time.monotonic()
+            with self._park_lock:
+                to_park, self._to_park = self._to_park, []
+                stop = self.draining
+            for request, addr in to_park:
+                self._idle[request] = (addr, now)
+                self._selector.register(request, selectors.EVENT_READ)
+            for key, _ in events:
+                request = key.fileobj
+                if request is self._wake_r:
+                    try:
+                        self._wake_r.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                addr, _ = self._idle.pop(request)
+                self._selector.unregister(request)
+                if stop:
+                    self.shutdown_request(request)
+                else:
+                    self.process_request(request, addr)
+            for request, (addr, since) in list(self._idle.items()):
+                if stop or now - since > self.idle_timeout:
+                    del self._idle[request]
+                    self._selector.unregister(request)
+                    self.shutdown_request(request)
+            if stop:
+                return
+
+    def drain(self, grace=10.0):
+        """Stop accepting, let in-flight requests finish (up to grace seconds)."""
+        with self._park_lock:
+            self.draining = True
+        self._wake_w.send(b"\0")
+        self.shutdown()
+        self.server_close()
+        deadline = time.monotonic() + grace
+        done = threading.Thread(target=self.pool.shutdown, kwargs={"wait": True}, daemon=True)
+        done.start()
+        done.join(max(0.0, deadline - time.monotonic()))
+
+def parse_args():
+    p = argparse.ArgumentParser(description="demo app")
+    p.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8000)))
+    p.add_argument("--mode", choices=["pool", "simple"], default=os.environ.get("DEMO_SERVER_MODE", "pool"),
+                   help="pool: bounded worker pool with keep-alive (default); simple: single-threaded")
+    p.add_argument("--workers", type=int, default=int(os.environ.get("DEMO_WORKERS", 16)),
+                   help="Worker threads in pool mode")
+    p.add_argument("--max-pending", type=int, default=int(os.environ.get("DEMO_MAX_PENDING", 256)),
+                   help="Connections allowed to wait for a worker before new ones are refused")
+    p.add_argument("--metrics-cache", type=float, default=float(os.environ.get("DEMO_METRICS_CACHE", 1.0)),
+                   help="Seconds to reuse the rendered /metrics body (0 renders every scrape)")
+    p.add_argument("--grace", type=float, default=float(os.environ.get("DEMO_SHUTDOWN_GRACE", 10)),
+                   help="Seconds to let in-flight requests finish on SIGTERM")
+    return p.parse_args()
+
 def run():
-    port = 8000
-    server = HTTPServer(('', port), Handler)
-    print(f"Starting server on :{port}")
+    args = parse_args()
+    port = args.port
+    EXPOSITION.ttl = args.metrics_cache
+    if args.mode == "simple":
+        server = HTTPServer(('', port), SimpleHandler)
+        server.draining = False
+        print(f"Starting server on :{port}")
+        server.serve_forever()
+        return
+
+    server = PoolHTTPServer(('', port), Handler, workers=args.workers, max_pending=args.max_pending)
+    # shutdown() blocks until serve_forever returns, so it cannot run in the handler
+    drainer = threading.Thread(target=server.drain, args=(args.grace,), daemon=True)
+
+    def on_signal(signum, frame):
+        if not drainer.is_alive() and drainer.ident is None:
+            drainer.start()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    print(f"Starting server on :{port} (workers={args.workers})")
     server.serve_forever()
+    # serve_forever returns once drain() has called shutdown(); wait for the drain
+    drainer.join(args.grace + 1)
+    print("Server stopped")
 
 if __name__ == "__main__":
     run()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+loadgen.py — open-loop load generator / benchmark for the demo app
+
+Sends a weighted mix of GETs (default "/" and "/metrics") at a fixed arrival
+rate over a pool of keep-alive connections and prints a JSON report.
+
+Open loop: request i is *due* at start + i/rate whether or not earlier
+requests have finished. Latency is measured from the due time, so time spent
+waiting for a free connection behind a stalled server is counted
+(coordinated-omission correction). The uncorrected service time (send ->
+response) is reported alongside for comparison. Requests still pending when
+the run ends are reported as "unfinished" errors, and rates/error_rate are
+taken over every request scheduled in the measured window, so overload shows
+up as errors instead of as missing (slowest) samples.
+
+Examples:
+  ./loadgen.py http://localhost:8000 --rate 2000 --duration 30
+  ./loadgen.py http://localhost:8000 --mix "/=95,/metrics=5" --connections 128 --processes 4
+  ./loadgen.py http://localhost:8000 --rate 5000 --out after.json --compare before.json
+
+Dependencies:
+  - Python 3.8+ (stdlib only)
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import random
+import sys
+import time
+from array import array
+from collections import Counter
+from urllib.parse import urlsplit
+
+PERCENTILES = (50, 90, 95, 99, 99.9)
+COMPARE_KEYS = ("throughput_rps", "error_rate", "p50_ms", "p95_ms", "p99_ms", "p99.9_ms")
+
+def parse_mix(value: str):
+    """'/=95,/metrics=5' -> [('/', 95.0), ('/metrics', 5.0)]"""
+    mix = []
+    for part in value.split(","):
+        path, _, weight = part.strip().rpartition("=")
+        if not path:
+            path, weight = weight, "1"
+        try:
+            mix.append((path, float(weight)))
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"bad mix entry {part!r}")
+    if not mix or sum(w for _, w in mix) <= 0:
+        raise argparse.ArgumentTypeError("mix needs at least one positive weight")
+    return mix
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Open-loop HTTP load generator for the demo app")
+    p.add_argument("url", help="Base URL, e.g. http://localhost:8000")
+    p.add_argument("--rate", type=float, default=1000, help="Target requests/sec (total)")
+    p.add_argument("--duration", type=float, default=30, help="Measured seconds")
+    p.add_argument("--warmup", type=float, default=3, help="Seconds of load before measuring")
+    p.add_argument("--connections", type=int, default=64, help="Keep-alive connections (total)")
+    p.add_argument("--processes", type=int, default=1, help="Generator processes (rate/connections are split)")
+    p.add_argument("--mix", type=parse_mix, default=parse_mix("/=95,/metrics=5"),
+                   help='Weighted paths, e.g. "/=95,/metrics=5"')
+    p.add_argument("--arrival", choices=["constant", "poisson"], default="constant",
+                   help="Inter-arrival distribution")
+    p.add_argument("--timeout", type=float, default=5.0, help="Per-request timeout (s), for the wait for a connection and for the request")
+    p.add_argument("--max-backlog", type=int, default=100000,
+                   help="Due-but-unsent requests before new ones are counted as client_backlog errors")
+    p.add_argument("--out", help="Also write the JSON report here")
+    p.add_argument("--compare", help="Baseline report to diff against")
+    p.add_argument("--max-regression", type=float, default=None,
+                   help="Exit 1 if p99 or throughput regress by more than this percent vs --compare")
+    return p.parse_args(argv)
+
+class ProtocolError(ValueError):
+    """The server sent something that is not an HTTP/1.x response."""
+
+class Conn:
+    """One keep-alive HTTP/1.1 connection (Content-Length responses only)."""
+
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.reader = self.writer = None
+
+    async def request(self, path):
+        # an open socket has served a request before; the server may have
+        # closed it while it sat idle (the demo app does after 5s)
+        reused = self.writer is not None
+        status = await self._send(path)
+        if status is None and reused:
+            self.close()
+            status = await self._send(path)     # reconnect and resend once
+        if status is None:
+            self.close()
+            raise ConnectionError("server closed connection")
+        length, close = 0, False
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name == b"content-length":
+                length = int(value)
+            elif name == b"connection" and value.strip().lower() == b"close":
+                close = True
+        await self.reader.readexactly(length)
+        if close:
+            self.close()
+        return status
+
+    async def _send(self, path):
+        """Write the request and read the status line; None if the server closed the socket."""
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(f"GET {path} HTTP/1.1\r\nHost: {self.host}\r\n\r\n".encode())
+        try:
+            line = await self.reader.readline()
+        except ConnectionError:
+            return None
+        if not line:
+            return None
+        parts = line.split(b" ", 2)
+        if len(parts) < 2 or not parts[1].isdigit():
+            raise ProtocolError(f"malformed status line {line[:60]!r}")
+        return int(parts[1])
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+async def generate(cfg):
+    """Run one generator; returns raw samples (picklable)."""
+    host, port = cfg["host"], cfg["port"]
+    rate, conns = cfg["rate"], cfg["connections"]
+    paths = [p for p, _ in cfg["mix"]]
+    weights = [w for _, w in cfg["mix"]]
+    rng = random.Random(cfg["seed"])
+
+    # most recently used first: connections that sit idle past the server's
+    # keep-alive timeout are the ones that go stale
+    idle = asyncio.LifoQueue()
+    pool = [Conn(host, port) for _ in range(conns)]
+    for conn in pool:
+        idle.put_nowait(conn)
+
+    corrected, service = array("d"), array("d")
+    per_path = {p: array("d") for p in paths}
+    errors = Counter()
+    # scheduled: measured-window requests launched or rejected; measured: those with a result
+    counts = {"sent": 0, "scheduled": 0, "measured": 0}
+    backlog = 0
+    # perf_counter is only comparable within a process; map the shared wall
+    # clock start onto it once
+    t = cfg["start"] + time.perf_counter() - time.time()
+    measure_from = t + cfg["warmup"]
+    end = measure_from + cfg["duration"]
+
+    async def one(path, due):
+        nonlocal backlog
+        try:
+            # waiting for a connection is bounded too: a stalled server must
+            # surface as errors, not as requests that never finish
+            conn = await asyncio.wait_for(idle.get(), cfg["timeout"])
+        except asyncio.TimeoutError:
+            backlog -= 1
+            if due >= measure_from:
+                counts["measured"] += 1
+                errors["timeout"] += 1
+            return
+        backlog -= 1
+        sent = time.perf_counter()
+        try:
+            status = await asyncio.wait_for(conn.request(path), cfg["timeout"])
+            err = None if 200 <= status < 400 else f"http_{status}"
+        except asyncio.TimeoutError:
+            conn.close()
+            err = "timeout"
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            conn.close()
+            err = type(e).__name__
+        done = time.perf_counter()
+        idle.put_nowait(conn)
+        if due < measure_from:
+            return
+        counts["measured"] += 1
+        if err:
+            errors[err] += 1
+            return
+        corrected.append(done - due)
+        service.append(done - sent)
+        per_path[path].append(done - due)
+
+    tasks = set()
+    while t < end:
+        now = time.perf_counter()
+        if t > now:
+            await asyncio.sleep(t - now)
+        # launch everything that is due (sleep granularity is ~1ms)
+        now = time.perf_counter()
+        while t <= now and t < end:
+            if t >= measure_from:
+                counts["scheduled"] += 1
+            if backlog >= cfg["max_backlog"]:
+                if t >= measure_from:
+                    counts["measured"] += 1
+                    errors["client_backlog"] += 1
+            else:
+                backlog += 1
+                path = rng.choices(paths, weights)[0] if len(paths) > 1 else paths[0]
+                task = asyncio.ensure_future(one(path, t))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                counts["sent"] += 1
+            t += rng.expovariate(rate) if cfg["arrival"] == "poisson" else 1.0 / rate
+    if tasks:
+        _, pending = await asyncio.wait(tasks, timeout=cfg["timeout"] * 2)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    # whatever was scheduled but never produced a result is an error, not a
+    # missing sample: under overload these are the slowest requests
+    unfinished = counts["scheduled"] - counts["measured"]
+    if unfinished > 0:
+        errors["unfinished"] += unfinished
+        counts["measured"] += unfinished
+    for conn in pool:
+        conn.close()
+
+    return {
+        "corrected": corrected.tobytes(),
+        "service": service.tobytes(),
+        "per_path": {p: a.tobytes() for p, a in per_path.items()},
+        "errors": dict(errors),
+        "measured": counts["measured"],
+        "scheduled": counts["scheduled"],
+    }
+
+def run_worker(cfg):
+    return asyncio.run(generate(cfg))
+
+def percentiles(values: array):
+    if not values:
+        return {}
+    ordered = sorted(values)
+    out = {}
+    for pct in PERCENTILES:
+        idx = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+        out[f"p{pct:g}_ms"] = round(ordered[idx] * 1e3, 3)
+    out["mean_ms"] = round(sum(ordered) / len(ordered) * 1e3, 3)
+    out["max_ms"] = round(ordered[-1] * 1e3, 3)
+    return out
+
+def merge(results, args):
+    def cat(key):
+        out = array("d")
+        for r in results:
+            out.frombytes(r[key])
+        return out
+
+    corrected, service = cat("corrected"), cat("service")
+    errors = Counter()
+    for r in results:
+        errors.update(r["errors"])
+    scheduled = sum(r["scheduled"] for r in results)
+    # rates are per scheduled second; stragglers finishing after the window
+    # still count towards ok/latency, unfinished ones as errors
+    elapsed = args.duration
+    per_path = {}
+    for path, _ in args.mix:
+        vals = array("d")
+        for r in results:
+            vals.frombytes(r["per_path"][path])
+        per_path[path] = dict(requests=len(vals), **percentiles(vals))
+
+    report = {
+        "target": args.url,
+        "config": {
+            "rate": args.rate, "duration": args.duration, "warmup": args.warmup,
+            "connections": args.connections, "processes": args.processes,
+            "arrival": args.arrival, "mix": {p: w for p, w in args.mix},
+        },
+        "requests": scheduled,
+        "ok": len(corrected),
+        "errors": dict(errors),
+        "error_rate": round(sum(errors.values()) / scheduled, 6) if scheduled else 0.0,
+        "throughput_rps": round(len(corrected) / elapsed, 1),
+        "offered_rps": round(scheduled / elapsed, 1),
+        "latency": percentiles(corrected),
+        "service_time": percentiles(service),
+        "paths": per_path,
+    }
+    return report
+
+def flat(report):
+    out = {key: report[key] for key in ("throughput_rps", "error_rate") if key in report}
+    out.update(report.get("latency", {}))
+    return out
+
+def compare(report, baseline_path, max_regression):
+    with open(baseline_path) as f:
+        base = flat(json.load(f))
+    cur = flat(report)
+    diff, failed = {}, []
+    for key in COMPARE_KEYS:
+        if key not in cur or key not in base:
+            continue
+        change = ((cur[key] - base[key]) / base[key] * 100) if base[key] else 0.0
+        diff[key] = {"baseline": base[key], "current": cur[key], "change_pct": round(change, 2)}
+    if max_regression is not None:
+        if "p99_ms" in diff and diff["p99_ms"]["change_pct"] > max_regression:
+            failed.append("p99_ms")
+        if "throughput_rps" in diff and diff["throughput_rps"]["change_pct"] < -max_regression:
+            failed.append("throughput_rps")
+    return diff, failed
+
+def main(argv=None):
+    args = parse_args(argv)
+    url = urlsplit(args.url if "://" in args.url else f"http://{args.url}")
+    if url.scheme != "http":
+        sys.exit("only http:// targets are supported")
+    procs = max(1, args.processes)
+    start = time.time() + 0.5 + 0.2 * procs     # let every process get ready first
+    cfgs = [{
+        "host": url.hostname, "port": url.port or 80, "mix": args.mix,
+        "rate": args.rate / procs, "connections": max(1, args.connections // procs),
+        "arrival": args.arrival, "timeout": args.timeout, "max_backlog": args.max_backlog,
+        "start": start, "warmup": args.warmup, "duration": args.duration, "seed": i,
+    } for i in range(procs)]
+
+    if procs == 1:
+        results = [run_worker(cfgs[0])]
+    else:
+        with multiprocessing.Pool(procs) as pool:
+            results = pool.map(run_worker, cfgs)
+
+    report = merge(results, args)
+    rc = 0
+    if args.compare:
+        report["compare"], failed = compare(report, args.compare, args.max_regression)
+        if failed:
+            report["regressed"] = failed
+            rc = 1
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    return rc
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1294 @@
+"""
+ebpf_common.py — shared plumbing for the BCC sample monitors in this directory.
+
+The monitors import this module from their own directory, so copy it alongside
+them when installing (e.g. /root/scripts/ebpf_common.py). Nothing here imports
+bcc at module load; the scripts keep their lazy `from bcc import BPF`.
+
+Loading
+- load_bpf() is the one place the programs are compiled. BCC always runs
+  clang at startup (it has no way to load a prebuilt object), so the
+  programs keep their text free of runtime parameters (those live in maps or
+  cflags) and load_bpf() reports the compile time and RSS it cost.
+  release_compiler() hands the clang/LLVM memory back once every probe is
+  attached.
+
+Event transport
+- BPF programs declare their output channel with an `EVENTS_OUTPUT` line and
+  emit records with `SUBMIT_EVENT(ctx, data);` (data is a struct variable).
+- apply_transport() expands those placeholders for either a per-CPU perf
+  buffer (BPF_PERF_OUTPUT) or a shared ring buffer (BPF_RINGBUF_OUTPUT, 5.8+).
+  BCC cannot rewrite map calls inside C macros, so this is plain text
+  substitution, as in the upstream BCC tools.
+- EventTransport drains either buffer in batches and counts lost samples:
+  perf via the lost callback, ring buffer via an in-kernel per-CPU counter
+  bumped whenever ringbuf_output() fails.
+
+Kernel-side filters
+- Programs that accept --pid/--src-ip/--dst-ip/--src-port/--dst-port/
+  --active-only place a `FILTER_CONFIG` line in their text and call
+  filtered_out() before submitting. The values live in a one-slot BPF array
+  (filter_cfg), so they can be changed at runtime with set_filter_config()
+  (or bpftool) without recompiling, and rejected events never leave the kernel.
+
+Targets
+- Programs that trace a set of processes (the Unity tracers) place a
+  `TARGET_CONFIG` line and call target_tag(); TargetSet discovers the pids
+  (--pid, systemd --unit globs) and cgroups (--cgroup), keeps them in BPF
+  hashes, and re-syncs them periodically, so one program and one consumer
+  cover every instance on the host and records carry an instance tag.
+
+Records
+- Programs that emit more than one record type place a `TASK_DICTIONARY`
+  line and start every record with a (version, kind) byte pair.
+  announce_task() sends a thread's comm/cgroup/uid/ppid once as a REC_TASK
+  record, so the per-call records carry small integer codes and a tid
+  instead of strings; RecordDecoder picks the struct by kind and
+  TaskDictionary maps tids back to the task fields in user space.
+
+Ordering
+- Records carry their bpf_ktime_get_ns() stamp. KernelClock converts it to
+  wall-clock time through a calibrated offset (no syscall per event), and
+  ReorderBuffer holds records for --reorder-ms so the per-CPU perf buffer
+  streams come out merged in kernel-timestamp order.
+
+De-duplication
+- DedupWindow replaces the `key in deque(maxlen=N)` scans: an OrderedDict
+  gives O(1) membership, bounded by key count and optionally by age, with
+  admitted/suppressed counters.
+
+Map occupancy
+- MapOccupancyCollector exports entries/capacity per BPF map, so a map that
+  is filling up (or an LRU map that has started evicting) shows up on a
+  dashboard before flows silently stop being tracked.
+
+Log sink
+- AsyncLogWriter keeps file I/O off the event path: lines go into a bounded
+  queue, a background thread writes them in batches, flushes on size/time,
+  rotates by size or age (optionally gzipping the rotated file) and applies
+  an explicit drop policy, with counters, when the disk falls behind.
+
+Replay
+- --replay feeds recorded (--capture files) or synthetic records through the
+  same decode -> dedup -> enrich -> log -> Prometheus path with
+  ReplayTransport in place of EventTransport, so the user-space pipeline can
+  be benchmarked and regression-tested without root or bcc. replay_filter()
+  applies the filter_cfg semantics the kernel would have applied, and
+  StageTimer/--replay-report give events/sec, per-stage latency and memory.
+"""
+
+import argparse
+import bisect
+import ctypes as ct
+import gzip
+import heapq
+import os
+import queue
+import re
+import shutil
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+TRANSPORTS = ("perf", "ringbuf")
+
+def _rss_kb() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * (os.sysconf("SC_PAGE_SIZE") // 1024)
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def load_bpf(text: str, cflags=(), label: str = "bpf", quiet: bool = False):
+    """Compile and load a BCC program, reporting what the compile cost.
+
+    TRACEPOINT_PROBE/kprobe__ functions are attached by BCC here; attach the
+    rest, then call release_compiler().
+    """
+    from bcc import BPF
+    started, rss = time.monotonic(), _rss_kb()
+    b = BPF(text=text, cflags=list(cflags))
+    if not quiet:
+        print(f"[{label}] program compiled in {time.monotonic() - started:.2f}s "
+              f"(+{max(0, _rss_kb() - rss) // 1024} MiB RSS)", file=sys.stderr)
+    return b
+
+def release_compiler(b):
+    """Return clang/LLVM memory to the OS once every program is loaded and attached.
+
+    The loaded programs and maps are unaffected; only later compiles would
+    page the compiler back in. No-op on BCC versions without free_bcc_memory.
+    """
+    free = getattr(b, "free_bcc_memory", None)
+    if free is None:
+        return
+    before = _rss_kb()
+    try:
+        free()
+    except Exception as e:
+        print(f"[bpf] could not release compiler memory: {e}", file=sys.stderr)
+        return
+    freed = before - _rss_kb()
+    if freed > 1024:
+        print(f"[bpf] released {freed // 1024} MiB of compiler memory", file=sys.stderr)
+
+DEFAULT_PAGES = {"perf": 64, "ringbuf": 4096}
+
+_EVENTS_DECL = {
+    "perf": "BPF_PERF_OUTPUT(events);",
+    "ringbuf": "BPF_RINGBUF_OUTPUT(events, {pages});\nBPF_PERCPU_ARRAY(ringbuf_lost, u64, 1);",
+}
+_SUBMIT = {
+    "perf": r"events.perf_submit(\1, &\2, sizeof(\2));",
+    "ringbuf": (r"if (events.ringbuf_output(&\2, sizeof(\2), 0) != 0) { "
+                r"int __zero = 0; u64 *__lost = ringbuf_lost.lookup(&__zero); "
+                r"if (__lost) (*__lost)++; }"),
+}
+_SUBMIT_RX = re.compile(r"SUBMIT_EVENT\(\s*(\w+)\s*,\s*(\w+)\s*\);")
+
+def add_transport_args(p):
+    """Register --transport/--buffer-pages on an argparse parser."""
+    p.add_argument("--transport", choices=TRANSPORTS, default="perf",
+                   help="Kernel->user channel: per-CPU perf buffers or one shared ring buffer (5.8+)")
+    p.add_argument("--buffer-pages", type=int, default=None,
+                   help="Perf: pages per CPU; ringbuf: total pages. Power of two "
+                        f"(default: perf={DEFAULT_PAGES['perf']}, ringbuf={DEFAULT_PAGES['ringbuf']})")
+
+def buffer_pages(transport: str, pages) -> int:
+    pages = pages or DEFAULT_PAGES[transport]
+    if pages <= 0 or pages & (pages - 1):
+        raise ValueError(f"--buffer-pages must be a power of two, got {pages}")
+    return pages
+
+def apply_transport(text: str, transport: str, pages) -> str:
+    """Expand EVENTS_OUTPUT / SUBMIT_EVENT(ctx, data); for the chosen transport."""
+    pages = buffer_pages(transport, pages)
+    text = text.replace("EVENTS_OUTPUT", _EVENTS_DECL[transport].format(pages=pages), 1)
+    return _SUBMIT_RX.sub(_SUBMIT[transport], text)
+
+class EventTransport:
+    """Batch-draining consumer for the `events` table of a BPF object.
+
+    Raw records are copied out of the kernel buffer inside the BCC callback and
+    handed to on_batch(list_of_bytes) once per wakeup (or every max_batch
+    records), so per-record Python work happens outside the reader callback.
+    Use decode() to turn a raw record into the BCC ctypes struct, or pass a
+    RecordDecoder for programs that emit several record types (BCC can only
+    describe one struct per output table).
+
+    With record_size, records are instead memmoved into a preallocated arena
+    at a fixed stride (truncated or zero-padded to record_size) and on_batch()
+    gets one memoryview over the batch, for struct.iter_unpack(); the view is
+    only valid during the call.
+    """
+
+    def __init__(self, b, transport: str = "perf", pages=None, max_batch: int = 4096,
+                 warn_interval: float = 5.0, decoder=None, record_size: int = 0):
+        self.b = b
+        self.transport = transport
+        self.pages = buffer_pages(transport, pages)
+        self.max_batch = max_batch
+        self.warn_interval = warn_interval
+        self._table = b["events"]
+        self._event_cls = None
+        self.decoder = decoder
+        self._batch = []
+        self.record_size = record_size
+        if record_size:
+            self._arena = bytearray(max_batch * record_size)
+            self._arena_addr = ct.addressof((ct.c_char * len(self._arena)).from_buffer(self._arena))
+            self._arena_view = memoryview(self._arena)
+            self._count = 0
+        self._on_batch = None
+        self._perf_lost = 0
+        self._reported_lost = 0
+        self.done = False             # live transports run until interrupted
+        self._next_warn = time.monotonic() + warn_interval
+
+    def open(self, on_batch):
+        self._on_batch = on_batch
+        if self.transport == "ringbuf":
+            self._table.open_ring_buffer(self._ringbuf_cb)
+        else:
+            self._table.open_perf_buffer(self._perf_cb, page_cnt=self.pages, lost_cb=self._lost_cb)
+
+    def _copy(self, data, size):
+        if self.record_size:
+            stride = self.record_size
+            dst = self._arena_addr + self._count * stride
+            if size < stride:
+                ct.memset(dst + size, 0, stride - size)
+            ct.memmove(dst, data, min(size, stride))
+            self._count += 1
+            if self._count >= self.max_batch:
+                self.flush()
+            return
+        if self._event_cls is None and self.decoder is None:
+            self._event_cls = type(self._table.event(data))
+        self._batch.append(ct.string_at(data, size))
+        if len(self._batch) >= self.max_batch:
+            self.flush()
+
+    def _perf_cb(self, cpu, data, size):
+        self._copy(data, size)
+
+    def _ringbuf_cb(self, ctx, data, size):
+        self._copy(data, size)
+        return 0
+
+    def _lost_cb(self, lost):
+        self._perf_lost += lost
+
+    def decode(self, raw: bytes):
+        if self.decoder is not None:
+            return self.decoder.decode(raw)
+        return self._event_cls.from_buffer_copy(raw)
+
+    def flush(self):
+        if self.record_size:
+            if self._count:
+                view = self._arena_view[:self._count * self.record_size]
+                self._count = 0
+                try:
+                    self._on_batch(view)
+                finally:
+                    view.release()
+            return
+        if self._batch:
+            batch, self._batch = self._batch, []
+            self._on_batch(batch)
+
+    def poll(self, timeout_ms: int = 100):
+        if self.transport == "ringbuf":
+            self.b.ring_buffer_poll(timeout_ms)
+        else:
+            self.b.perf_buffer_poll(timeout_ms)
+        self.flush()
+        if self.warn_interval and time.monotonic() >= self._next_warn:
+            self._next_warn = time.monotonic() + self.warn_interval
+            self.warn_lost()
+
+    def lost(self) -> int:
+        """Total samples dropped by the kernel since open()."""
+        if self.transport == "ringbuf":
+            return int(self.b["ringbuf_lost"].sum(0).value)
+        return self._perf_lost
+
+    def warn_lost(self):
+        total = self.lost()
+        if total > self._reported_lost:
+            print(f"[!] {total - self._reported_lost} events lost ({total} total); "
+                  f"consider --transport ringbuf or a larger --buffer-pages", file=sys.stderr)
+            self._reported_lost = total
+
+class LostEventsCollector:
+    """Prometheus collector exporting EventTransport.lost() as a counter."""
+
+    def __init__(self, transport: EventTransport, name: str, doc: str):
+        self.transport = transport
+        self.name = name
+        self.doc = doc
+
+    def collect(self):
+        from prometheus_client.core import CounterMetricFamily
+        fam = CounterMetricFamily(self.name, self.doc, labels=["transport"])
+        fam.add_metric([self.transport.transport], self.transport.lost())
+        yield fam
+
+
+FILTER_C = r"""
+struct filter_cfg_t {
+    u32 tgid;          // 0 = any
+    u32 src_ip;        // host-order IPv4, 0 = any
+    u32 dst_ip;
+    u16 src_port;      // 0 = any
+    u16 dst_port;
+    u32 active_only;   // keep only ESTABLISHED (1) and req/resp (-1) samples
+};
+BPF_ARRAY(filter_cfg, struct filter_cfg_t, 1);
+
+static __always_inline int filtered_out(u32 tgid, u32 src_ip, u32 dst_ip, u16 src_port, u16 dst_port, int state) {
+    int zero = 0;
+    struct filter_cfg_t *f = filter_cfg.lookup(&zero);
+    if (!f) return 0;
+    if (f->tgid && f->tgid != tgid) return 1;
+    if (f->src_ip && f->src_ip != src_ip) return 1;
+    if (f->dst_ip && f->dst_ip != dst_ip) return 1;
+    if (f->src_port && f->src_port != src_port) return 1;
+    if (f->dst_port && f->dst_port != dst_port) return 1;
+    if (f->active_only && state != 1 && state != -1) return 1;
+    return 0;
+}
+"""
+
+def with_filter_config(text: str) -> str:
+    """Expand the FILTER_CONFIG placeholder into the filter map and helper."""
+    return text.replace("FILTER_CONFIG", FILTER_C, 1)
+
+def ip_to_u32(ip: str) -> int:
+    """Dotted IPv4 -> the host-order integer the programs store (inverse of format_ip)."""
+    return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+def ipv4_arg(value: str) -> str:
+    """argparse type: validate a dotted IPv4 address and return it unchanged."""
+    try:
+        ip_to_u32(value)
+    except OSError:
+        raise argparse.ArgumentTypeError(f"invalid IPv4 address: {value!r}")
+    return value
+
+def set_filter_config(b, pid=None, src_ip=None, dst_ip=None, src_port=None, dst_port=None,
+                      active_only=False):
+    """Write the filter_cfg map; takes effect for the next event, no reload needed."""
+    table = b["filter_cfg"]
+    cfg = table.Leaf()
+    cfg.tgid = pid or 0
+    cfg.src_ip = ip_to_u32(src_ip) if src_ip else 0
+    cfg.dst_ip = ip_to_u32(dst_ip) if dst_ip else 0
+    cfg.src_port = src_port or 0
+    cfg.dst_port = dst_port or 0
+    cfg.active_only = 1 if active_only else 0
+    table[ct.c_int(0)] = cfg
+
+def set_filter_config_from_args(b, args):
+    set_filter_config(b, args.pid, args.src_ip, args.dst_ip, args.src_port, args.dst_port,
+                      args.active_only)
+
+TARGET_C = r"""
+// tgid / cgroup id -> instance tag (1..n); maintained by TargetSet.sync()
+BPF_HASH(target_pids, u32, u32, 4096);
+BPF_HASH(target_cgroups, u64, u32, 4096);    // every cgroup at or below a --cgroup
+
+static __always_inline u32 target_tag(u64 pid_tgid) {
+    u32 tgid = pid_tgid >> 32;
+    u32 *tag = target_pids.lookup(&tgid);
+    if (tag) return *tag;
+#ifdef TARGET_CGROUPS
+    u64 cgroup_id = bpf_get_current_cgroup_id();
+    tag = target_cgroups.lookup(&cgroup_id);
+    if (tag) return *tag;
+#endif
+    return 0;
+}
+"""
+
+def with_target_config(text: str, cgroups: bool = False) -> str:
+    """Expand the TARGET_CONFIG placeholder into the target maps and target_tag()."""
+    return text.replace("TARGET_CONFIG", ("#define TARGET_CGROUPS\n" if cgroups else "") + TARGET_C, 1)
+
+def pid_list(value: str):
+    """argparse type: '123' or '123,456' -> [123, 456]."""
+    try:
+        pids = [int(v) for v in value.split(",") if v.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid pid list: {value!r}")
+    if not pids or any(pid <= 0 for pid in pids):
+        raise argparse.ArgumentTypeError(f"invalid pid list: {value!r}")
+    return pids
+
+def add_target_args(p, default_unit: str):
+    """Register --pid/--unit/--cgroup/--rescan (see TargetSet)."""
+    p.add_argument("--pid", type=pid_list, action="append", default=[],
+                   help="Target process id(s); repeat or comma-separate")
+    p.add_argument("--unit", action="append", default=[],
+                   help=f"systemd unit glob whose MainPID is a target; repeatable "
+                        f"(default: {default_unit} when no --pid/--cgroup is given)")
+    p.add_argument("--cgroup", action="append", default=[],
+                   help="cgroup v2 directory whose tasks, including those in child cgroups, are targets "
+                        "(path, or relative to /sys/fs/cgroup)")
+    p.add_argument("--rescan", type=float, default=5.0,
+                   help="Seconds between re-discovering targets as instances start and stop (0=never)")
+
+def cgroup_v2_root(root: str = "/sys/fs/cgroup") -> str:
+    """The cgroup v2 mount: root itself, or root/unified on a hybrid hierarchy.
+
+    cgroup ids (bpf_get_current_cgroup_id, the 0:: line of /proc/<pid>/cgroup)
+    are inodes and paths of this tree.
+    """
+    unified = os.path.join(root, "unified")
+    return unified if os.path.isdir(unified) else root
+
+def unit_main_pids(patterns) -> dict:
+    """{unit: MainPID} for running systemd services matching the globs."""
+    import subprocess
+    try:
+        listed = subprocess.run(["systemctl", "list-units", "--type=service", "--state=running", "--plain",
+                                 "--no-legend", "--no-pager", *patterns],
+                                capture_output=True, text=True, timeout=10).stdout
+        units = [line.split()[0] for line in listed.splitlines() if line.strip()]
+        if not units:
+            return {}
+        shown = subprocess.run(["systemctl", "show", "-p", "Id", "-p", "MainPID", "--no-pager", *units],
+                               capture_output=True, text=True, timeout=10).stdout
+    except (OSError, subprocess.SubprocessError):
+        return {}
+    out = {}
+    for block in shown.split("\n\n"):
+        props = dict(line.split("=", 1) for line in block.splitlines() if "=" in line)
+        pid = int(props.get("MainPID") or 0)
+        if pid > 0:
+            out[props.get("Id", f"pid {pid}")] = pid
+    return out
+
+class TargetSet:
+    """The processes and cgroups to trace, discovered from --pid/--unit/--cgroup.
+
+    Every instance (a unit, an explicit pid or a cgroup) gets a small tag that
+    stays the same for its name across restarts; programs copy the tag into
+    their records and name() turns it back into a label. sync() re-runs
+    discovery and writes only the differences into target_pids/target_cgroups,
+    so one compiled program follows instances as they start and stop.
+    """
+
+    def __init__(self, pids=(), units=(), cgroups=(), cgroup_root: str = None):
+        self.pids = list(pids)
+        self.units = list(units)
+        self.cgroups = list(cgroups)
+        self.cgroup_root = cgroup_root or cgroup_v2_root()
+        self.current_pids = {}      # tgid -> tag
+        self.current_cgroups = {}   # cgroup id -> tag
+        self._tags = {}             # instance name -> tag
+        self._names = {}
+
+    @classmethod
+    def from_args(cls, args, default_unit: str):
+        pids = [pid for group in args.pid for pid in group]
+        units = args.unit or ([] if pids or args.cgroup else [default_unit])
+        return cls(pids, units, args.cgroup)
+
+    def tag(self, name: str) -> int:
+        tag = self._tags.get(name)
+        if tag is None:
+            tag = self._tags[name] = len(self._tags) + 1
+            self._names[tag] = name
+        return tag
+
+    def name(self, tag: int) -> str:
+        return self._names.get(tag, f"#{tag}")
+
+    def discover(self):
+        """({tgid: instance name}, {cgroup id: instance name}) as of now."""
+        pids = {}
+        for pid in self.pids:
+            try:
+                with open(f"/proc/{pid}/comm") as f:
+                    pids[pid] = f"{f.read().strip()}[{pid}]"
+            except OSError:
+                continue    # not running (yet)
+        if self.units:
+            for unit, pid in unit_main_pids(self.units).items():
+                pids[pid] = unit
+        cgroups = {}
+        for path in self.cgroups:
+            full = os.path.normpath(path if path.startswith("/sys/")
+                                    else os.path.join(self.cgroup_root, path.strip("/")))
+            # named by the path below the v2 root: a/app and b/app are two instances
+            name = os.path.relpath(full, self.cgroup_root)
+            if name.startswith(".."):
+                name = full
+            # bpf_get_current_cgroup_id() is the task's leaf cgroup and v2 keeps
+            # processes in leaves, so the whole subtree has to be in the map
+            for directory, _subdirs, _files in os.walk(full):
+                try:
+                    cgroups[os.stat(directory).st_ino] = name
+                except OSError:
+                    continue    # removed while walking
+        return pids, cgroups
+
+    def sync(self, b=None):
+        """Re-discover; update the BPF maps (if b) and return (added, removed) instance names."""
+        pids, cgroups = self.discover()
+        want_pids = {pid: self.tag(name) for pid, name in pids.items()}
+        want_cgroups = {cg: self.tag(name) for cg, name in cgroups.items()}
+        added, removed = [], []
+        # a pid is one instance (a restart is reported as gone + new); a cgroup
+        # instance spans its subtree and is reported when its first/last id comes/goes
+        for current, want, map_name, key_type, per_key in (
+                (self.current_pids, want_pids, "target_pids", ct.c_uint32, True),
+                (self.current_cgroups, want_cgroups, "target_cgroups", ct.c_uint64, False)):
+            table = b[map_name] if b is not None else None
+            before = set(current.values())
+            for key in [k for k in current if current[k] != want.get(k)]:
+                if table is not None:
+                    try:
+                        del table[key_type(key)]
+                    except KeyError:
+                        pass
+                tag = current.pop(key)
+                if per_key:
+                    removed.append(self.name(tag))
+            for key, tag in want.items():
+                if key not in current:
+                    if table is not None:
+                        table[key_type(key)] = ct.c_uint32(tag)
+                    current[key] = tag
+                    if per_key:
+                        added.append(self.name(tag))
+            if not per_key:
+                after = set(current.values())
+                added += [self.name(tag) for tag in sorted(after - before)]
+                removed += [self.name(tag) for tag in sorted(before - after)]
+        return added, removed
+
+    @property
+    def tags(self) -> set:
+        return set(self.current_pids.values()) | set(self.current_cgroups.values())
+
+RECORD_VERSION = 3      # 1: strings in every record; 2: no kernel timestamp
+REC_TASK = 1            # kinds >= 2 belong to the individual programs
+
+TASK_C = r"""
+// Every record starts with (version, kind). Per-task strings are sent once, as
+// a REC_TASK record, the first time a thread shows up (and again when its comm
+// or cgroup changes); the other records carry only the tid.
+#define REC_VERSION 3
+#define REC_TASK 1
+#ifndef TASK_ENTRIES
+#define TASK_ENTRIES 16384
+#endif
+
+struct task_rec_t {
+    u8  version;
+    u8  kind;          // REC_TASK
+    u16 pad;
+    u32 tid;
+    u64 cgroup_id;
+    u32 tgid;
+    u32 ppid;
+    u32 uid;
+    char comm[TASK_COMM_LEN];
+};
+struct task_seen_t {
+    u64 cgroup_id;
+    u64 comm[2];
+};
+BPF_TABLE("lru_hash", u32, struct task_seen_t, task_seen, TASK_ENTRIES);
+
+static __always_inline void announce_task(void *ctx) {
+    u64 id = bpf_get_current_pid_tgid();
+    u32 tid = id;
+    if (!tid) return;               // idle task (softirq); user space names it "swapper"
+    struct task_seen_t now = {};
+    now.cgroup_id = bpf_get_current_cgroup_id();
+    bpf_get_current_comm(&now.comm, sizeof(now.comm));
+    struct task_seen_t *seen = task_seen.lookup(&tid);
+    if (seen && seen->cgroup_id == now.cgroup_id &&
+        seen->comm[0] == now.comm[0] && seen->comm[1] == now.comm[1])
+        return;
+    task_seen.update(&tid, &now);
+
+    struct task_rec_t rec = {};
+    rec.version = REC_VERSION;
+    rec.kind = REC_TASK;
+    rec.tid = tid;
+    rec.tgid = id >> 32;
+    rec.uid = bpf_get_current_uid_gid();
+    rec.cgroup_id = now.cgroup_id;
+    __builtin_memcpy(&rec.comm, now.comm, sizeof(rec.comm));
+    struct task_struct *task = (struct task_struct *)bpf_get_current_task();
+    if (task && task->real_parent)
+        bpf_probe_read_kernel(&rec.ppid, sizeof(rec.ppid), &task->real_parent->tgid);
+    SUBMIT_EVENT(ctx, rec);
+}
+"""
+
+def with_task_dictionary(text: str, enabled: bool = True) -> str:
+    """Expand the TASK_DICTIONARY placeholder (before apply_transport, which expands its
+    SUBMIT_EVENT); disabled, it expands to nothing for builds that never call announce_task()."""
+    return text.replace("TASK_DICTIONARY", TASK_C if enabled else "", 1)
+
+class TaskRecord(ct.Structure):
+    """ctypes mirror of struct task_rec_t."""
+    _fields_ = [
+        ("version", ct.c_uint8), ("kind", ct.c_uint8), ("pad", ct.c_uint16), ("tid", ct.c_uint32),
+        ("cgroup_id", ct.c_uint64), ("tgid", ct.c_uint32), ("ppid", ct.c_uint32), ("uid", ct.c_uint32),
+        ("comm", ct.c_char * 16),
+    ]
+
+# struct task_rec_t for struct.iter_unpack/unpack_from (no alignment codes, so the tail padding is spelled out)
+TASK_STRUCT = struct.Struct("=BBHIQIII16s4x")
+
+def task_record(tid: int, tgid: int, ppid: int = 0, uid: int = 0, cgroup_id: int = 0,
+                comm: bytes = b"") -> TaskRecord:
+    """A REC_TASK record, for replays that have to announce their tasks themselves."""
+    return TaskRecord(RECORD_VERSION, REC_TASK, 0, tid, cgroup_id, tgid, ppid, uid, comm)
+
+class RecordDecoder:
+    """Raw record -> ctypes struct by its (version, kind) header.
+
+    Records of another layout version or an unknown kind are counted in
+    `rejected` and decode to None rather than being misread.
+    """
+
+    def __init__(self, kinds: dict, version: int = RECORD_VERSION):
+        self.kinds = kinds
+        self.version = version
+        self.rejected = 0
+
+    def decode(self, raw: bytes):
+        cls = self.kinds.get(raw[1]) if len(raw) >= 2 and raw[0] == self.version else None
+        if cls is None or len(raw) < ct.sizeof(cls):
+            self.rejected += 1
+            return None
+        return cls.from_buffer_copy(raw)
+
+class TaskDictionary:
+    """tid -> (tgid, ppid, uid, cgroup_id, comm) built from REC_TASK records.
+
+    Bounded LRU, larger than the kernel's task_seen map so an entry the kernel
+    still considers announced is normally still here. A tid that was never
+    announced (its REC_TASK record was lost, or the thread predates a restart
+    of this process) is filled from /proc once and counted in `misses`.
+    """
+
+    def __init__(self, max_entries: int = 65536):
+        self.max_entries = max_entries
+        self.misses = 0
+        self._tasks = OrderedDict()
+        self._tasks[0] = (0, 0, 0, 0, "swapper")
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def learn(self, rec):
+        self.add(rec.tid, rec.tgid, rec.ppid, rec.uid, rec.cgroup_id, rec.comm)
+
+    def add(self, tid: int, tgid: int, ppid: int, uid: int, cgroup_id: int, comm: bytes):
+        """One REC_TASK record's fields (comm as the raw, NUL-padded bytes)."""
+        self._put(tid, (tgid, ppid, uid, cgroup_id, comm.split(b"\0", 1)[0].decode(errors="ignore")))
+
+    def _put(self, tid, task):
+        self._tasks[tid] = task
+        self._tasks.move_to_end(tid)
+        if len(self._tasks) > self.max_entries:
+            self._tasks.popitem(last=False)
+
+    def get(self, tid: int, tgid: int = 0):
+        task = self._tasks.get(tid)
+        if task is not None:
+            return task
+        self.misses += 1
+        comm, ppid, uid = "?", 0, 0
+        try:
+            with open(f"/proc/{tid}/comm") as f:
+                comm = f.read().strip()
+            with open(f"/proc/{tid}/status") as f:
+                for line in f:
+                    if line.startswith("Tgid:") and not tgid:
+                        tgid = int(line.split()[1])
+                    elif line.startswith("PPid:"):
+                        ppid = int(line.split()[1])
+                    elif line.startswith("Uid:"):
+                        uid = int(line.split()[1])
+                        break
+        except (OSError, ValueError, IndexError):
+            pass
+        task = (tgid, ppid, uid, 0, comm)
+        self._put(tid, task)
+        return task
+
+def add_reorder_args(p):
+    """Register --reorder-ms/--reorder-max: re-sequence per-CPU event streams by kernel timestamp."""
+    p.add_argument("--reorder-ms", type=float, default=50.0,
+                   help="Hold events this long to merge per-CPU streams in timestamp order "
+                        "(0: only sort within each poll)")
+    p.add_argument("--reorder-max", type=int, default=65536,
+                   help="Events held for reordering before the oldest is released early")
+
+class KernelClock:
+    """bpf_ktime_get_ns() (CLOCK_MONOTONIC) -> wall-clock nanoseconds.
+
+    The offset is taken from the tightest of a few monotonic/wall/monotonic
+    reads and refreshed every recalibrate seconds, so NTP slewing of the wall
+    clock is followed without a syscall per event.
+    """
+
+    def __init__(self, recalibrate: float = 60.0, samples: int = 5):
+        self.recalibrate = recalibrate
+        self.samples = samples
+        self.offset_ns = 0
+        self.uncertainty_ns = 0
+        self._next = 0.0
+        self.calibrate()
+
+    def calibrate(self):
+        best = None
+        for _ in range(self.samples):
+            m0 = time.monotonic_ns()
+            wall = time.time_ns()
+            m1 = time.monotonic_ns()
+            if best is None or m1 - m0 < best[0]:
+                best = (m1 - m0, wall - (m0 + m1) // 2)
+        self.uncertainty_ns = best[0] // 2
+        self.offset_ns = best[1]
+        self._next = time.monotonic() + self.recalibrate
+
+    def maybe_recalibrate(self):
+        if self.recalibrate and time.monotonic() >= self._next:
+            self.calibrate()
+
+    def wall_ns(self, ktime_ns: int) -> int:
+        return ktime_ns + self.offset_ns
+
+    def ktime_ns(self, wall_ns: int) -> int:
+        return wall_ns - self.offset_ns
+
+class ReorderBuffer:
+    """Bounded min-heap that merges per-CPU event streams by kernel timestamp.
+
+    Perf buffers are per CPU, so a batch interleaves runs from each CPU and a
+    CPU whose wakeup lands in the next poll delivers records older than ones
+    already read. push() every record; pop_ready() yields, in timestamp
+    order, those at least window_ns older than the newest timestamp seen (or
+    than now_ns, so a stream that goes quiet still drains); drain() yields
+    the rest. Beyond max_items the oldest record is released early (`forced`);
+    a record older than one already released still goes out, counted as `late`.
+    """
+
+    def __init__(self, window_ns: int, max_items: int = 65536):
+        self.window_ns = max(0, int(window_ns))
+        self.max_items = max(1, max_items)
+        self.newest = 0
+        self.released = 0           # timestamp of the last record handed out
+        self.forced = 0
+        self.late = 0
+        self._heap = []
+        self._seq = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, ts: int, item):
+        if ts > self.newest:
+            self.newest = ts
+        elif ts < self.released:
+            self.late += 1
+        self._seq += 1
+        heapq.heappush(self._heap, (ts, self._seq, item))
+
+    def pop_ready(self, now_ns: int = None):
+        heap = self._heap
+        watermark = self.newest - self.window_ns
+        if now_ns is not None:
+            watermark = max(watermark, now_ns - self.window_ns)
+        while heap:
+            if heap[0][0] > watermark:
+                if len(heap) <= self.max_items:
+                    return
+                self.forced += 1
+            ts, _, item = heapq.heappop(heap)
+            if ts > self.released:
+                self.released = ts
+            yield item
+
+    def drain(self):
+        while self._heap:
+            ts, _, item = heapq.heappop(self._heap)
+            if ts > self.released:
+                self.released = ts
+            yield item
+
+def add_dedup_args(p, default_window: int):
+    p.add_argument("--dedup-window", type=int, default=default_window,
+                   help="Distinct recent events remembered for de-duplication (0=off)")
+    p.add_argument("--dedup-ttl", type=float, default=0.0,
+                   help="Also forget remembered events after N seconds (0=count bound only)")
+
+class DedupWindow:
+    """Recently seen event keys, bounded by count and (optionally) age.
+
+    seen(key) is O(1) regardless of window size. A repeat does not refresh
+    the key's position, matching the deque behaviour it replaces: a key is
+    suppressed until max_keys newer distinct keys (or ttl seconds) pass.
+    """
+
+    def __init__(self, max_keys: int = 8000, ttl: float = 0.0):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.admitted = 0
+        self.suppressed = 0
+        self._seen = OrderedDict()   # key -> first-seen monotonic time
+
+    def __len__(self):
+        return len(self._seen)
+
+    def seen(self, key) -> bool:
+        """True (and counted as suppressed) if key is in the window; else remember it."""
+        if self.max_keys <= 0:
+            self.admitted += 1
+            return False
+        seen = self._seen
+        now = 0.0
+        if self.ttl:
+            now = time.monotonic()
+            horizon = now - self.ttl
+            while seen:
+                oldest = next(iter(seen.values()))
+                if oldest >= horizon:
+                    break
+                seen.popitem(last=False)
+        if key in seen:
+            self.suppressed += 1
+            return True
+        seen[key] = now
+        if len(seen) > self.max_keys:
+            seen.popitem(last=False)
+        self.admitted += 1
+        return False
+
+class FuncCounterCollector:
+    """Prometheus collector exposing a zero-argument callable as a counter."""
+
+    def __init__(self, name: str, doc: str, func):
+        self.name = name
+        self.doc = doc
+        self.func = func
+
+    def collect(self):
+        from prometheus_client.core import CounterMetricFamily
+        yield CounterMetricFamily(self.name, self.doc, value=self.func())
+
+class MapOccupancyCollector:
+    """Prometheus gauges for BPF map fill: <prefix>_bpf_map_entries/_capacity{map}.
+
+    Counting a BCC table walks its keys (one syscall each), so the counts are
+    refreshed at most every min_interval seconds and reused between scrapes.
+    """
+
+    def __init__(self, b, maps, prefix: str, min_interval: float = 15.0):
+        self.b = b
+        self.maps = list(maps)
+        self.prefix = prefix
+        self.min_interval = min_interval
+        self._counts = {}
+        self._at = float("-inf")
+        self._lock = threading.Lock()
+
+    def counts(self) -> dict:
+        with self._lock:
+            if time.monotonic() - self._at >= self.min_interval:
+                counts = {}
+                for name in self.maps:
+                    table = self.b[name]
+                    counts[name] = (sum(1 for _ in table.keys()), int(getattr(table, "max_entries", 0)))
+                self._counts = counts
+                self._at = time.monotonic()
+            return self._counts
+
+    def collect(self):
+        from prometheus_client.core import GaugeMetricFamily
+        entries = GaugeMetricFamily(f"{self.prefix}_bpf_map_entries", "Entries in a BPF map",
+                                    labels=["map"])
+        capacity = GaugeMetricFamily(f"{self.prefix}_bpf_map_capacity", "max_entries of a BPF map",
+                                     labels=["map"])
+        for name, (n, cap) in self.counts().items():
+            entries.add_metric([name], n)
+            capacity.add_metric([name], cap)
+        yield entries
+        yield capacity
+
+DROP_POLICIES = ("newest", "oldest", "block")
+
+def add_log_args(p):
+    """Register the AsyncLogWriter tuning flags on an argparse parser."""
+    p.add_argument("--log-max-bytes", type=int, default=100 * 1024 * 1024,
+                   help="Rotate the log once it exceeds this size (0=never)")
+    p.add_argument("--log-rotate-secs", type=float, default=0,
+                   help="Rotate the log every N seconds (0=never)")
+    p.add_argument("--log-backups", type=int, default=5, help="Rotated logs to keep")
+    p.add_argument("--log-compress", action="store_true", help="gzip rotated logs")
+    p.add_argument("--log-queue", type=int, default=65536, help="Lines buffered before the drop policy applies")
+    p.add_argument("--log-drop-policy", choices=DROP_POLICIES, default="newest",
+                   help="When the queue is full: drop the new line, drop the oldest queued line, or block")
+
+def log_writer_from_args(path: str, header: str, args) -> "AsyncLogWriter":
+    return AsyncLogWriter(path, header=header, queue_size=args.log_queue,
+                          max_bytes=args.log_max_bytes, rotate_interval=args.log_rotate_secs,
+                          backups=args.log_backups, compress=args.log_compress,
+                          drop_policy=args.log_drop_policy)
+
+class AsyncLogWriter:
+    """Line-oriented file sink running on a background thread.
+
+    write() only enqueues; the writer thread appends up to batch_lines per
+    write() syscall and flushes at least every flush_interval seconds. Once
+    the queue is drained it sleeps for linger seconds rather than blocking in
+    get(): a blocked get() is woken by every write(), and each of those
+    wakeups takes the GIL away from the producer.
+    Counters: written, dropped, rotations, errors.
+    """
+
+    def __init__(self, path: str, header: str = "", queue_size: int = 65536, batch_lines: int = 1024,
+                 flush_interval: float = 1.0, max_bytes: int = 0, rotate_interval: float = 0,
+                 backups: int = 5, compress: bool = False, drop_policy: str = "newest",
+                 linger: float = 0.05):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"unknown drop policy {drop_policy!r}")
+        self.path = path
+        self.header = header
+        self.batch_lines = batch_lines
+        self.flush_interval = flush_interval
+        self.linger = linger
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backups = max(1, backups)
+        self.compress = compress
+        self.drop_policy = drop_policy
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+        self.errors = 0
+        self._q = queue.Queue(maxsize=max(1, queue_size))
+        self._stop = object()
+        self._f = None
+        self._size = 0
+        self._rotate_at = 0.0
+        self._compressor = None
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, line: str) -> bool:
+        """Queue one line (without newline). Returns False if it was dropped."""
+        if self.drop_policy == "block":
+            self._q.put(line)
+            return True
+        try:
+            self._q.put_nowait(line)
+            return True
+        except queue.Full:
+            pass
+        if self.drop_policy == "oldest":
+            try:
+                self._q.get_nowait()
+            except queue.Empty:
+                pass
+            self.dropped += 1
+            try:
+                self._q.put_nowait(line)
+                return True
+            except queue.Full:
+                pass
+        self.dropped += 1
+        return False
+
+    def close(self, timeout: float = 5.0):
+        """Flush what is queued and stop the writer thread."""
+        self._q.put(self._stop)
+        self._thread.join(timeout)
+        if self._compressor is not None:
+            self._compressor.join(timeout)
+
+    def _open(self):
+        self._f = open(self.path, "a", buffering=1024 * 1024)
+        self._size = self._f.tell()
+        if self._size == 0 and self.header:
+            self._f.write(self.header)
+            self._size = len(self.header)
+        self._rotate_at = time.monotonic() + self.rotate_interval if self.rotate_interval else 0.0
+
+    def _rotate(self):
+        self._f.close()
+        self._f = None
+        if self._compressor is not None:
+            self._compressor.join()
+        suffix = ".gz" if self.compress else ""
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{i}{suffix}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}{suffix}")
+        os.replace(self.path, f"{self.path}.1")
+        if self.compress:
+            self._compressor = threading.Thread(target=self._gzip, args=(f"{self.path}.1",),
+                                                name="log-compress", daemon=True)
+            self._compressor.start()
+        self.rotations += 1
+        self._open()
+
+    @staticmethod
+    def _gzip(src: str):
+        try:
+            with open(src, "rb") as fin, gzip.open(src + ".gz", "wb") as fout:
+                shutil.copyfileobj(fin, fout)
+            os.remove(src)
+        except OSError as e:
+            print(f"Log compression failed for {src}: {e}", file=sys.stderr)
+
+    def _run(self):
+        stopping = False
+        next_flush = time.monotonic() + self.flush_interval
+        while not stopping:
+            batch = []
+            try:
+                while len(batch) < self.batch_lines:
+                    item = self._q.get_nowait()
+                    if item is self._stop:
+                        stopping = True
+                        break
+                    batch.append(item)
+            except queue.Empty:
+                pass
+            try:
+                if self._f is None:
+                    self._open()
+                if batch:
+                    chunk = "\n".join(batch) + "\n"
+                    self._f.write(chunk)
+                    self._size += len(chunk)
+                    self.written += len(batch)
+                now = time.monotonic()
+                if now >= next_flush or stopping:
+                    self._f.flush()
+                    next_flush = now + self.flush_interval
+                if ((self.max_bytes and self._size >= self.max_bytes)
+                        or (self._rotate_at and now >= self._rotate_at)):
+                    self._rotate()
+            except OSError as e:
+                self.errors += 1
+                self.dropped += len(batch)
+                print(f"Log write failed: {e}", file=sys.stderr)
+                if self._f is not None:
+                    try:
+                        self._f.close()
+                    except OSError:
+                        pass
+                self._f = None
+                time.sleep(self.flush_interval)
+                continue
+            if not stopping and len(batch) < self.batch_lines:
+                time.sleep(min(self.linger, max(0.0, next_flush - time.monotonic())))
+        if self._f is not None:
+            self._f.close()
+
+class LogWriterCollector:
+    """Prometheus collector exporting AsyncLogWriter counters."""
+
+    def __init__(self, writer: AsyncLogWriter, prefix: str):
+        self.writer = writer
+        self.prefix = prefix
+
+    def collect(self):
+        from prometheus_client.core import CounterMetricFamily
+        for name, doc, value in (
+            ("log_lines_written", "Lines written to the event log", self.writer.written),
+            ("log_lines_dropped", "Lines dropped because the log writer fell behind", self.writer.dropped),
+            ("log_rotations", "Event log rotations", self.writer.rotations),
+        ):
+            yield CounterMetricFamily(f"{self.prefix}_{name}", doc, value=value)
+
+def add_replay_args(p):
+    """Register --replay* flags: run the user-space pipeline without a kernel."""
+    p.add_argument("--replay", metavar="SOURCE", default=None,
+                   help="Feed events from a --capture file or 'synthetic[:N]' instead of BPF "
+                        "(no root/bcc needed; for benchmarks and regression runs)")
+    p.add_argument("--replay-rate", type=float, default=0,
+                   help="Replay at N events/sec (0 = as fast as the pipeline goes)")
+    p.add_argument("--replay-loops", type=int, default=1, help="Times to replay the source")
+    p.add_argument("--replay-report", metavar="FILE", default=None,
+                   help="Write a JSON report (events/sec, per-stage latency, memory) when the replay ends")
+    p.add_argument("--replay-tracemalloc", action="store_true",
+                   help="Also measure Python heap bytes per event (slows the run)")
+
+def replay_filter(args, pid_field: str):
+    """Python twin of filtered_out() for replayed records (the kernel is not in the loop)."""
+    pid = args.pid or 0
+    src_ip = ip_to_u32(args.src_ip) if args.src_ip else 0
+    dst_ip = ip_to_u32(args.dst_ip) if args.dst_ip else 0
+    src_port, dst_port = args.src_port or 0, args.dst_port or 0
+    active_only = args.active_only
+
+    def keep(ev) -> bool:
+        return not (
+            (pid and getattr(ev, pid_field) != pid) or
+            (src_ip and ev.src_ip != src_ip) or
+            (dst_ip and ev.dst_ip != dst_ip) or
+            (src_port and ev.src_port != src_port) or
+            (dst_port and ev.dst_port != dst_port) or
+            (active_only and ev.state not in (1, -1))
+        )
+    return keep
+
+def replay_records(source: str, synthesize, from_row, keep=None):
+    """Raw records for a replay: 'synthetic[:N]' calls synthesize(i, rng) N times,
+    anything else is read as a capture file through from_row(dict)."""
+    import random
+    if source.startswith("synthetic"):
+        _, _, count = source.partition(":")
+        rng = random.Random(42)
+        events = (synthesize(i, rng) for i in range(int(count or 100000)))
+    else:
+        from event_capture import CaptureReader
+        reader = CaptureReader(source)
+
+        def rows():
+            for block in reader.iter_blocks():
+                cols = reader.columns(block)
+                for i in range(block[1]):
+                    yield from_row({n: cols[n][i] for n in reader.names})
+        events = rows()
+    return [bytes(ev) for ev in events if keep is None or keep(ev)]
+
+class StageTimer:
+    """Accumulates nanoseconds per pipeline stage: start(), then mark(stage) after each."""
+
+    def __init__(self):
+        self.totals = {}
+        self.counts = {}
+        self._last = 0
+
+    def start(self):
+        self._last = time.perf_counter_ns()
+
+    def mark(self, stage: str):
+        now = time.perf_counter_ns()
+        self.totals[stage] = self.totals.get(stage, 0) + now - self._last
+        self.counts[stage] = self.counts.get(stage, 0) + 1
+        self._last = now
+
+    def summary(self) -> dict:
+        return {stage: {"events": self.counts[stage], "total_s": round(ns / 1e9, 6),
+                        "mean_us": round(ns / self.counts[stage] / 1e3, 3)}
+                for stage, ns in self.totals.items()}
+
+class ReplayTransport:
+    """EventTransport stand-in that feeds pre-built raw records to on_batch().
+
+    Same open/poll/decode/flush/lost interface, plus `done` once every loop has
+    been delivered. Records are built before the clock starts, so the report
+    measures only the user-space pipeline. `timer` is a StageTimer the
+    monitors mark between stages (None when no report was requested).
+    record_size delivers memoryview batches, as for EventTransport. With
+    versioned records, REC_TASK announcements are delivered like any record
+    but reported apart, so events and events/sec count only events.
+    """
+
+    def __init__(self, event_cls, records, rate: float = 0, loops: int = 1, max_batch: int = 4096,
+                 report: bool = False, tracemalloc_on: bool = False, decoder=None, record_size: int = 0,
+                 versioned: bool = False):
+        self.transport = "replay"
+        self.event_cls = event_cls
+        self.decoder = decoder
+        self.record_size = record_size
+        if record_size:
+            # the same fixed-stride layout EventTransport builds in its arena
+            self._blob = memoryview(b"".join(r[:record_size].ljust(record_size, b"\0") for r in records))
+        self.records = records
+        self.rate = rate
+        self.loops = max(1, loops)
+        self.max_batch = max_batch
+        self.timer = StageTimer() if report else None
+        self.tracemalloc_on = tracemalloc_on
+        self.delivered = 0          # records, task announcements included
+        self.tasks_delivered = 0
+        task_header = bytes((RECORD_VERSION, REC_TASK))
+        self._task_pos = [i for i, r in enumerate(records) if r[:2] == task_header] if versioned else []
+        self.done = not records
+        self._on_batch = None
+        self._pos = 0
+        self._loop = 0
+        self._started = None
+        self._finished = None
+        self._mem0 = 0
+        self._blocks0 = 0
+        self._transient = 0         # sum over batches of the heap high-water mark above the batch's start
+
+    def open(self, on_batch):
+        self._on_batch = on_batch
+        if self.tracemalloc_on:
+            import tracemalloc
+            tracemalloc.start()
+            self._mem0 = tracemalloc.get_traced_memory()[0]
+            self._blocks0 = sys.getallocatedblocks()
+        self._started = time.perf_counter()
+
+    def decode(self, raw: bytes):
+        if self.decoder is not None:
+            return self.decoder.decode(raw)
+        return self.event_cls.from_buffer_copy(raw)
+
+    def flush(self):
+        pass
+
+    def poll(self, timeout_ms: int = 100):
+        if self.done:
+            return
+        n = self.max_batch
+        if self.rate:
+            due = int((time.perf_counter() - self._started) * self.rate) - self.delivered
+            if due <= 0:
+                time.sleep(min(timeout_ms / 1000.0, 1.0 / self.rate))
+                return
+            n = min(n, due)
+        if self.record_size:
+            end = min(self._pos + n, len(self.records))
+            batch = self._blob[self._pos * self.record_size:end * self.record_size]
+            count = end - self._pos
+        else:
+            batch = self.records[self._pos:self._pos + n]
+            count = len(batch)
+        if self._task_pos:
+            self.tasks_delivered += (bisect.bisect_left(self._task_pos, self._pos + count)
+                                     - bisect.bisect_left(self._task_pos, self._pos))
+        self._pos += count
+        if self._pos >= len(self.records):
+            self._pos = 0
+            self._loop += 1
+            self.done = self._loop >= self.loops
+        self.delivered += count
+        if self.tracemalloc_on:
+            import tracemalloc
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            self._on_batch(batch)
+            self._transient += tracemalloc.get_traced_memory()[1] - before
+        else:
+            self._on_batch(batch)
+        if self.done:
+            self._finished = time.perf_counter()
+
+    def lost(self) -> int:
+        return 0
+
+    def warn_lost(self):
+        pass
+
+    def report(self, source: str, **extra) -> dict:
+        elapsed = ((self._finished or time.perf_counter()) - self._started) if self._started else 0.0
+        events = self.delivered - self.tasks_delivered
+        out = {
+            "source": source,
+            "events": events,
+            "task_records": self.tasks_delivered,
+            "seconds": round(elapsed, 6),
+            "events_per_sec": round(events / elapsed, 1) if elapsed else 0.0,
+        }
+        if self.timer is not None:
+            out["stages"] = self.timer.summary()
+        try:
+            import resource
+            out["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        except ImportError:
+            pass
+        if self.tracemalloc_on:
+            import tracemalloc
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            if events:
+                out["retained_bytes_per_event"] = round((current - self._mem0) / events, 1)
+                out["retained_blocks_per_event"] = round(
+                    (sys.getallocatedblocks() - self._blocks0) / events, 3)
+                # bytes live at once per event while a batch is handled: what the hot path allocates
+                out["transient_bytes_per_event"] = round(self._transient / events, 1)
+                out["peak_heap_bytes"] = peak
+        out.update(extra)
+        return out
+
+    def write_report(self, path: str, source: str, **extra):
+        import json
+        report = self.report(source, **extra)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        return report
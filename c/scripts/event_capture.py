@@ -0,0 +1,207 @@
+"""
+event_capture.py — compact columnar capture files for the socket monitors.
+
+The monitors append one fixed-width row per event (`--capture FILE`); rows are
+buffered and written as column blocks, so a capture is a fraction of the size
+of the JSON log and can be scanned with mmap without loading it into memory.
+sample-capture-query.py is the offline reader.
+
+File layout (native byte order, recorded in the header):
+
+    header   b"EVCAP\\x00\\x01\\x00" | u32 len | JSON {version, byteorder, schema, block_rows, source, created_ns}
+    block*   b"BLK1" | u32 rows | i64 ts_min | i64 ts_max | column 0 .. column N
+             (column i is rows * itemsize(schema[i]) bytes)
+    index    b"IDX1" | u32 blocks | blocks * (u64 offset, u32 rows, i64 ts_min, i64 ts_max)
+    trailer  u64 index_offset | b"EVCAPEND"
+
+The schema is a list of [name, code] where code is an array-module typecode
+("B", "H", "I", "i", "Q", "q") or "<n>s" for fixed-width bytes. Column 0 is
+always ts_ns (epoch nanoseconds). The index and trailer are written on close;
+a capture cut short by a crash is still readable by walking the block headers.
+"""
+
+import json
+import mmap
+import struct
+import sys
+import time
+from array import array
+
+MAGIC = b"EVCAP\x00\x01\x00"
+TRAILER_MAGIC = b"EVCAPEND"
+VERSION = 1
+BLOCK = struct.Struct("<4sIqq")
+INDEX_HDR = struct.Struct("<4sI")
+INDEX_ENTRY = struct.Struct("<QIqq")
+TRAILER = struct.Struct("<Q8s")
+
+# Columns shared by the latency and socket monitors; names match the JSON log.
+LATENCY_SCHEMA = [
+    ["ts_ns", "q"], ["pid", "I"], ["tid", "I"], ["ppid", "I"], ["uid", "I"], ["cgroup_id", "Q"],
+    ["src_ip", "I"], ["dst_ip", "I"], ["src_port", "H"], ["dst_port", "H"], ["state", "i"],
+    ["connect_latency_ns", "Q"], ["rr_latency_ns", "Q"], ["srtt_us", "I"], ["rttvar_us", "I"],
+    ["retransmits", "I"], ["comm", "16s"],
+]
+SOCKET_SCHEMA = [
+    ["ts_ns", "q"], ["pid", "I"], ["ppid", "I"], ["uid", "I"],
+    ["src_ip", "I"], ["dst_ip", "I"], ["src_port", "H"], ["dst_port", "H"], ["state", "i"],
+    ["comm", "16s"],
+]
+
+def itemsize(code: str) -> int:
+    if code.endswith("s"):
+        return int(code[:-1] or 1)
+    return array(code).itemsize
+
+class CaptureWriter:
+    """Append rows (tuples in schema order) and write them as column blocks."""
+
+    def __init__(self, path: str, schema, block_rows: int = 8192, source: str = ""):
+        if not schema or schema[0] != ["ts_ns", "q"]:
+            raise ValueError("capture schema must start with ['ts_ns', 'q']")
+        self.path = path
+        self.schema = [list(c) for c in schema]
+        self.block_rows = block_rows
+        self.rows = 0
+        self._pending = []
+        self._index = []
+        self._f = open(path, "wb")
+        header = json.dumps({
+            "version": VERSION, "byteorder": sys.byteorder, "schema": self.schema,
+            "block_rows": block_rows, "source": source, "created_ns": time.time_ns(),
+        }).encode()
+        self._f.write(MAGIC + struct.pack("<I", len(header)) + header)
+
+    def append(self, row):
+        self._pending.append(row)
+        if len(self._pending) >= self.block_rows:
+            self.flush()
+
+    def flush(self):
+        rows, self._pending = self._pending, []
+        if not rows:
+            return
+        cols = list(zip(*rows))
+        ts = cols[0]
+        parts = [BLOCK.pack(b"BLK1", len(rows), min(ts), max(ts))]
+        for (name, code), col in zip(self.schema, cols):
+            if code.endswith("s"):
+                width = itemsize(code)
+                parts.append(b"".join(bytes(v)[:width].ljust(width, b"\0") for v in col))
+            else:
+                parts.append(array(code, col).tobytes())
+        offset = self._f.tell()
+        self._f.write(b"".join(parts))
+        self._f.flush()
+        self._index.append((offset, len(rows), min(ts), max(ts)))
+        self.rows += len(rows)
+
+    def close(self):
+        if self._f is None:
+            return
+        self.flush()
+        index_offset = self._f.tell()
+        self._f.write(INDEX_HDR.pack(b"IDX1", len(self._index)))
+        for entry in self._index:
+            self._f.write(INDEX_ENTRY.pack(*entry))
+        self._f.write(TRAILER.pack(index_offset, TRAILER_MAGIC))
+        self._f.close()
+        self._f = None
+
+class FixedBytesColumn:
+    """Row access into a fixed-width bytes column without copying the block."""
+
+    def __init__(self, mv: memoryview, width: int):
+        self.mv = mv
+        self.width = width
+
+    def __len__(self):
+        return len(self.mv) // self.width
+
+    def __getitem__(self, i):
+        w = self.width
+        return bytes(self.mv[i * w:(i + 1) * w]).rstrip(b"\0")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class CaptureReader:
+    """mmap-backed reader; blocks are located through the index or a header walk."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._f = open(path, "rb")
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mv = memoryview(self._mm)
+        if self._mm[:8] != MAGIC:
+            raise ValueError(f"{path}: not an event capture")
+        (hlen,) = struct.unpack_from("<I", self._mm, 8)
+        self.header = json.loads(bytes(self._mm[12:12 + hlen]))
+        if self.header.get("byteorder") != sys.byteorder:
+            raise ValueError(f"{path}: written on a {self.header.get('byteorder')}-endian host")
+        self.schema = [tuple(c) for c in self.header["schema"]]
+        self.names = [name for name, _ in self.schema]
+        self._sizes = [itemsize(code) for _, code in self.schema]
+        self.row_size = sum(self._sizes)
+        self._data_start = 12 + hlen
+        self.complete = False
+        self.blocks = self._read_index() or self._walk_blocks()
+
+    def _read_index(self):
+        if len(self._mm) < self._data_start + TRAILER.size:
+            return None
+        index_offset, magic = TRAILER.unpack_from(self._mm, len(self._mm) - TRAILER.size)
+        if magic != TRAILER_MAGIC:
+            return None
+        tag, count = INDEX_HDR.unpack_from(self._mm, index_offset)
+        if tag != b"IDX1":
+            return None
+        pos = index_offset + INDEX_HDR.size
+        self.complete = True
+        return [INDEX_ENTRY.unpack_from(self._mm, pos + i * INDEX_ENTRY.size) for i in range(count)]
+
+    def _walk_blocks(self):
+        blocks, pos, end = [], self._data_start, len(self._mm)
+        while pos + BLOCK.size <= end:
+            tag, rows, ts_min, ts_max = BLOCK.unpack_from(self._mm, pos)
+            if tag != b"BLK1" or pos + BLOCK.size + rows * self.row_size > end:
+                break
+            blocks.append((pos, rows, ts_min, ts_max))
+            pos += BLOCK.size + rows * self.row_size
+        return blocks
+
+    @property
+    def rows(self) -> int:
+        return sum(b[1] for b in self.blocks)
+
+    def iter_blocks(self, since_ns=None, until_ns=None):
+        """Yield block entries overlapping [since_ns, until_ns]."""
+        for blk in self.blocks:
+            _, _, ts_min, ts_max = blk
+            if since_ns is not None and ts_max < since_ns:
+                continue
+            if until_ns is not None and ts_min > until_ns:
+                continue
+            yield blk
+
+    def columns(self, block, names=None):
+        """{name: column} for one block; numeric columns are cast memoryviews."""
+        offset, rows, _, _ = block
+        pos = offset + BLOCK.size
+        out = {}
+        for (name, code), size in zip(self.schema, self._sizes):
+            span = rows * size
+            if names is None or name in names:
+                mv = self._mv[pos:pos + span]
+                out[name] = FixedBytesColumn(mv, size) if code.endswith("s") else mv.cast(code)
+            pos += span
+        return out
+
+    def close(self):
+        try:
+            self._mv.release()
+            self._mm.close()
+        except BufferError:
+            pass    # a caller still holds a column view; the map goes with it
+        self._f.close()
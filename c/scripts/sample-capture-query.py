@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+capture_query.py — filter and aggregate socket monitor captures offline
+
+Reads the columnar captures written by sample-latency-monitor.py and
+sample-socket-monitor.py (`--capture FILE`). The file is mmap'd and scanned
+block by block; blocks outside --since/--until are skipped via the time index,
+so multi-GB captures are processed in constant memory.
+
+Examples:
+  ./capture_query.py capture.evcap --info
+  ./capture_query.py capture.evcap --pid 2987 --dst-port 7777 --limit 20
+  ./capture_query.py capture.evcap --since 2026-10-18T21:00 --until 2026-10-18T21:05 \\
+      --state ESTABLISHED --group-by dst_ip,dst_port --value connect_latency_ns
+  ./capture_query.py capture.evcap --ip 10.100.10.202 --group-by comm,state
+
+Dependencies:
+  - Python 3 (event_capture.py from this directory)
+"""
+
+import argparse
+import json
+import math
+import socket
+import struct
+import sys
+from collections import defaultdict
+from datetime import datetime
+
+from event_capture import CaptureReader
+
+TCP_STATES = {
+    -1: "REQRESP",
+    1: "ESTABLISHED",
+    2: "SYN_SENT",
+    3: "SYN_RECV",
+    4: "FIN_WAIT1",
+    5: "FIN_WAIT2",
+    6: "TIME_WAIT",
+    7: "CLOSED",
+    8: "CLOSE_WAIT",
+    9: "LAST_ACK",
+    10: "LISTEN",
+    11: "CLOSING",
+}
+STATE_CODES = {v: k for k, v in TCP_STATES.items()}
+
+def format_ip(ip_u32: int) -> str:
+    return ".".join(str((ip_u32 >> s) & 0xFF) for s in (24, 16, 8, 0))
+
+def parse_ip(ip: str) -> int:
+    return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+def parse_time(value: str) -> int:
+    """Epoch seconds or ISO-8601 (local time unless an offset is given) -> ns."""
+    try:
+        return int(float(value) * 1e9)
+    except ValueError:
+        return int(datetime.fromisoformat(value).timestamp() * 1e9)
+
+def parse_state(value: str) -> int:
+    if value.lstrip("-").isdigit():
+        return int(value)
+    try:
+        return STATE_CODES[value.upper()]
+    except KeyError:
+        raise argparse.ArgumentTypeError(f"unknown state {value!r}")
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Query socket monitor capture files")
+    p.add_argument("capture", help="Capture file written with --capture")
+    p.add_argument("--info", action="store_true", help="Print header, schema and block summary")
+    p.add_argument("--pid", type=int, help="Filter by TGID")
+    p.add_argument("--src-ip", type=parse_ip, help="Filter by source IPv4")
+    p.add_argument("--dst-ip", type=parse_ip, help="Filter by destination IPv4")
+    p.add_argument("--ip", type=parse_ip, help="Filter by source or destination IPv4")
+    p.add_argument("--src-port", type=int, help="Filter by source port")
+    p.add_argument("--dst-port", type=int, help="Filter by destination port")
+    p.add_argument("--port", type=int, help="Filter by source or destination port")
+    p.add_argument("--state", type=parse_state, action="append",
+                   help="TCP state name/number (repeatable); REQRESP selects req/resp samples")
+    p.add_argument("--comm", type=str, help="Filter by process name")
+    p.add_argument("--since", type=parse_time, help="Start of time window (epoch seconds or ISO-8601)")
+    p.add_argument("--until", type=parse_time, help="End of time window (epoch seconds or ISO-8601)")
+    p.add_argument("--group-by", type=str, help="Comma-separated columns to aggregate by")
+    p.add_argument("--value", type=str, help="Numeric column to summarise per group (e.g. rr_latency_ns)")
+    p.add_argument("--limit", type=int, default=0, help="Max rows/groups to print (0=all)")
+    return p.parse_args()
+
+class LogHistogram:
+    """Fixed-memory quantile sketch: 16 buckets per power of two (~4% error)."""
+
+    SUB = 16
+
+    def __init__(self):
+        self.buckets = defaultdict(int)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, v):
+        self.count += 1
+        self.total += v
+        self.min = v if self.min is None or v < self.min else self.min
+        self.max = v if self.max is None or v > self.max else self.max
+        self.buckets[int(math.log2(v) * self.SUB) if v > 0 else -1] += 1
+
+    def quantile(self, q: float):
+        rank, seen = q * self.count, 0
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen >= rank:
+                return 0 if b < 0 else min(self.max, 2 ** ((b + 1) / self.SUB))
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {}
+        return {
+            "min": self.min, "avg": self.total / self.count, "p50": self.quantile(0.50),
+            "p95": self.quantile(0.95), "p99": self.quantile(0.99), "max": self.max,
+        }
+
+def build_predicate(args, names):
+    """Return (needed columns, predicate(cols, i)) for the row filters."""
+    checks, needed = [], set()
+
+    def eq(col, value):
+        needed.add(col)
+        checks.append(lambda c, i: c[col][i] == value)
+
+    if args.pid is not None: eq("pid", args.pid)
+    if args.src_ip is not None: eq("src_ip", args.src_ip)
+    if args.dst_ip is not None: eq("dst_ip", args.dst_ip)
+    if args.src_port is not None: eq("src_port", args.src_port)
+    if args.dst_port is not None: eq("dst_port", args.dst_port)
+    if args.comm is not None: eq("comm", args.comm.encode())
+    if args.ip is not None:
+        needed.update(("src_ip", "dst_ip"))
+        checks.append(lambda c, i: c["src_ip"][i] == args.ip or c["dst_ip"][i] == args.ip)
+    if args.port is not None:
+        needed.update(("src_port", "dst_port"))
+        checks.append(lambda c, i: c["src_port"][i] == args.port or c["dst_port"][i] == args.port)
+    if args.state:
+        states = frozenset(args.state)
+        needed.add("state")
+        checks.append(lambda c, i: c["state"][i] in states)
+    if args.since is not None or args.until is not None:
+        lo = args.since if args.since is not None else -(1 << 63)
+        hi = args.until if args.until is not None else (1 << 63) - 1
+        needed.add("ts_ns")
+        checks.append(lambda c, i: lo <= c["ts_ns"][i] <= hi)
+
+    missing = needed - set(names)
+    if missing:
+        sys.exit(f"capture has no column(s): {', '.join(sorted(missing))}")
+    return needed, (lambda c, i: all(chk(c, i) for chk in checks))
+
+def render(name, value):
+    if name in ("src_ip", "dst_ip"):
+        return format_ip(value)
+    if name == "state":
+        return TCP_STATES.get(value, str(value))
+    if name == "comm":
+        return value.decode(errors="ignore")
+    if name == "ts_ns":
+        return datetime.fromtimestamp(value / 1e9).isoformat(timespec="microseconds")
+    return value
+
+def print_info(reader):
+    h = reader.header
+    print(f"file:       {reader.path}")
+    print(f"source:     {h.get('source') or '-'}")
+    print(f"created:    {datetime.fromtimestamp(h['created_ns'] / 1e9).isoformat()}")
+    print(f"rows:       {reader.rows} in {len(reader.blocks)} blocks"
+          f"{'' if reader.complete else ' (no index: recovered by walking blocks)'}")
+    print(f"row bytes:  {reader.row_size}")
+    if reader.blocks:
+        print(f"time range: {render('ts_ns', min(b[2] for b in reader.blocks))} .. "
+              f"{render('ts_ns', max(b[3] for b in reader.blocks))}")
+    print("schema:     " + ", ".join(f"{n}:{c}" for n, c in reader.schema))
+
+def main():
+    args = parse_args()
+    try:
+        reader = CaptureReader(args.capture)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+
+    if args.info:
+        print_info(reader)
+        return 0
+
+    needed, keep = build_predicate(args, reader.names)
+    group_cols = [g.strip() for g in args.group_by.split(",")] if args.group_by else []
+    for col in group_cols + ([args.value] if args.value else []):
+        if col not in reader.names:
+            sys.exit(f"capture has no column {col!r}")
+
+    groups = defaultdict(lambda: [0, LogHistogram()])   # key -> [rows, value histogram]
+    printed = 0
+    for block in reader.iter_blocks(args.since, args.until):
+        if group_cols:
+            cols = reader.columns(block, needed | set(group_cols) | ({args.value} if args.value else set()))
+        else:
+            cols = reader.columns(block)
+        for i in range(block[1]):
+            if not keep(cols, i):
+                continue
+            if group_cols:
+                grp = groups[tuple(cols[g][i] for g in group_cols)]
+                grp[0] += 1
+                if args.value and cols[args.value][i]:
+                    grp[1].add(cols[args.value][i])
+                continue
+            print(json.dumps({n: render(n, cols[n][i]) for n in reader.names}, separators=(",", ":")))
+            printed += 1
+            if args.limit and printed >= args.limit:
+                return 0
+
+    if group_cols:
+        ranked = sorted(groups.items(), key=lambda kv: kv[1][0], reverse=True)
+        for key, (rows, hist) in ranked[:args.limit or None]:
+            out = {g: render(g, v) for g, v in zip(group_cols, key)}
+            out["count"] = rows
+            if args.value:
+                out[args.value] = dict(samples=hist.count, **hist.summary())
+            print(json.dumps(out, separators=(",", ":")))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,75 +8,179 @@ Traces process execution in real-time using eBPF to detect which processes
 spawn others. Useful for container visibility, attack forensics, and process
 lineage tracking.
 
+fork/exec/exit tracepoints keep an in-memory pid -> container index up to date,
+so each event is a dict lookup; container names come from a lazily refreshed
+`docker ps` listing instead of one fork per containerised process.
+
 Example:
 --------
 sudo ./pidtree_trace.py
 sudo ./pidtree_trace.py --filter container1
+sudo ./pidtree_trace.py --transport ringbuf --buffer-pages 1024
 """
 
-from bcc import BPF
 import os
+import re
 import time
 import subprocess
 import psutil
 import argparse
 import signal
 
+from ebpf_common import EventTransport, add_transport_args, apply_transport, load_bpf, release_compiler
+
 bpf_text = """
 #include <linux/sched.h>
 #include <uapi/linux/ptrace.h>
 
+#define EV_FORK 0
+#define EV_EXEC 1
+#define EV_EXIT 2
+
 struct data_t {
+    u32 type;
     u32 ppid;
     u32 pid;
     char comm[16];
 };
 
-BPF_PERF_OUTPUT(events);
+EVENTS_OUTPUT
 
-int trace_exec(struct pt_regs *ctx, struct task_struct *p) {
+TRACEPOINT_PROBE(sched, sched_process_fork) {
     struct data_t data = {};
-    data.pid = p->pid;
-    data.ppid = p->real_parent->pid;
+    data.type = EV_FORK;
+    data.ppid = bpf_get_current_pid_tgid() >> 32;
+    data.pid = args->child_pid;
+    bpf_probe_read_kernel_str(&data.comm, sizeof(data.comm), args->child_comm);
+    SUBMIT_EVENT(args, data);
+    return 0;
+}
+
+TRACEPOINT_PROBE(sched, sched_process_exec) {
+    struct data_t data = {};
+    struct task_struct *task = (struct task_struct *)bpf_get_current_task();
+    data.type = EV_EXEC;
+    data.pid = bpf_get_current_pid_tgid() >> 32;
+    data.ppid = task->real_parent->tgid;
     bpf_get_current_comm(&data.comm, sizeof(data.comm));
-    events.perf_submit(ctx, &data, sizeof(data));
+    SUBMIT_EVENT(args, data);
+    return 0;
+}
+
+TRACEPOINT_PROBE(sched, sched_process_exit) {
+    // fork also fires for new threads, so report every task (tid) exit
+    struct data_t data = {};
+    data.type = EV_EXIT;
+    data.pid = (u32)bpf_get_current_pid_tgid();
+    SUBMIT_EVENT(args, data);
     return 0;
 }
 """
 
+EV_FORK, EV_EXEC, EV_EXIT = 0, 1, 2
+
 parser = argparse.ArgumentParser()
 parser.add_argument("--log", action="store_true", help="Print raw log format")
 parser.add_argument("--filter", type=str, help="Filter by container name or PID")
+parser.add_argument("--name-refresh", type=float, default=2.0,
+                    help="Min seconds between 'docker ps' refreshes for unknown container ids")
+add_transport_args(parser)
 args = parser.parse_args()
 
-b = BPF(text=bpf_text)
-b.attach_kprobe(event="do_execve", fn_name="trace_exec")
-
-def get_pid_container_map():
-    pid_map = {}
-    for pid in psutil.pids():
+try:
+    bpf_text = apply_transport(bpf_text, args.transport, args.buffer_pages)
+except ValueError as e:
+    parser.error(str(e))
+
+CID_RX = re.compile(r"([0-9a-f]{64})")
+
+def read_container_id(pid):
+    """Container id from /proc/<pid>/cgroup, or None for host processes."""
+    try:
+        with open(f"/proc/{pid}/cgroup") as f:
+            for line in f:
+                if "docker" in line or "kubepods" in line:
+                    m = CID_RX.search(line)
+                    return m.group(1) if m else line.strip().split('/')[-1]
+    except OSError:
+        pass
+    return None
+
+class ContainerIndex:
+    """pid -> container id, kept current by fork/exec/exit events.
+
+    /proc is scanned once at startup; afterwards forks inherit the parent's
+    container, execs re-read their own cgroup file (runc moves the container
+    init into its cgroup between fork and exec) and exits drop the pid.
+    Names come from one `docker ps` listing, refreshed only when an unknown
+    id shows up and at most every name_refresh seconds.
+    """
+
+    def __init__(self, name_refresh=2.0):
+        self.pid_cid = {}
+        self.names = {}
+        self.name_refresh = name_refresh
+        self._names_at = 0.0
+
+    def seed(self):
+        for pid in psutil.pids():
+            self.pid_cid[pid] = read_container_id(pid)
+
+    def on_fork(self, ppid, pid):
+        if ppid in self.pid_cid:
+            self.pid_cid[pid] = self.pid_cid[ppid]
+        else:
+            self.pid_cid[pid] = read_container_id(pid)
+
+    def on_exec(self, pid):
+        self.pid_cid[pid] = read_container_id(pid)
+
+    def on_exit(self, pid):
+        self.pid_cid.pop(pid, None)
+
+    def _refresh_names(self):
+        now = time.monotonic()
+        if now - self._names_at < self.name_refresh:
+            return
+        self._names_at = now
         try:
-            with open(f"/proc/{pid}/cgroup") as f:
-                for line in f:
-                    if "docker" in line or "kubepods" in line:
-                        cid = line.strip().split('/')[-1]
-                        name = subprocess.getoutput(f"docker ps --filter id={cid} --format '{{{{.Names}}}}'")
-                        if name:
-                            pid_map[pid] = name
-                        else:
-                            pid_map[pid] = cid[:12]
-        except:
-            continue
-    return pid_map
-
-def handler(cpu, data, size):
-    event = b["events"].event(data)
+            out = subprocess.run(["docker", "ps", "--no-trunc", "--format", "{{.ID}} {{.Names}}"],
+                                 capture_output=True, text=True, timeout=5).stdout
+        except (OSError, subprocess.SubprocessError):
+            return
+        for line in out.splitlines():
+            cid, _, name = line.partition(" ")
+            if cid and name:
+                self.names[cid] = name
+
+    def container(self, pid):
+        cid = self.pid_cid.get(pid)
+        if cid is None:
+            return "host"
+        if cid not in self.names:
+            self._refresh_names()
+        return self.names.get(cid) or cid[:12]
+
+b = load_bpf(bpf_text, label="pidtree")
+release_compiler(b)
+
+index = ContainerIndex(args.name_refresh)
+index.seed()
+
+def handler(event):
     pid = event.pid
     ppid = event.ppid
-    comm = event.comm.decode()
 
-    pid_map = get_pid_container_map()
-    container = pid_map.get(pid, "host")
+    if event.type == EV_FORK:
+        index.on_fork(ppid, pid)
+        return
+    if event.type == EV_EXIT:
+        index.on_exit(pid)
+        return
+
+    index.on_exec(pid)
+    comm = event.comm.decode(errors="ignore")
+    container = index.container(pid)
 
     if args.filter and args.filter not in container and args.filter != str(pid):
         return
@@ -88,8 +192,14 @@ def handler(cpu, data, size):
 
 print(f"{'Container':<20} {'PID':<6} {'<- PPID':<10} CMD")
 
+transport = EventTransport(b, args.transport, args.buffer_pages)
+
+def handle_batch(records):
+    for raw in records:
+        handler(transport.decode(raw))
+
 signal.signal(signal.SIGINT, lambda x, y: exit(0))
-b["events"].open_perf_buffer(handler)
+transport.open(handle_batch)
 
 while True:
-    b.perf_buffer_poll()
+    transport.poll()
@@ -8,61 +8,156 @@ Features
 - RTT internals: tcp_sock.srtt_us, mdev_us (rttvar)
 - Retransmits: tcp:tcp_retransmit_skb
 - Process/thread: TGID (pid), TID, PPID, UID, comm
+- Compact records: events carry a (version, kind) header, integer codes and a
+  tid (56 bytes, down from 120); comm/cgroup/uid/ppid are sent once per
+  thread as a task record and looked up in user space; each poll's records
+  land in one fixed-stride buffer and are decoded in bulk (struct.iter_unpack),
+  with IP strings and log timestamps cached
+- Kernel timestamps: every event carries bpf_ktime_get_ns(), converted to
+  wall-clock time through a calibrated offset ("ts_ns", no syscall per event);
+  events are held --reorder-ms (default 50) and merged across the per-CPU
+  buffers in timestamp order, so a flow's lifecycle comes out in sequence
 - Cgroup/Kubernetes enrichment: cgroup id, pod_uid, container_id (best effort from cgroup v2/v1 paths)
-- Optional user stacks: --stacks
+- Optional user stacks: --stacks, aggregated in-kernel per stack (count, latency
+  sum/max), symbolized through a per-process cache and written as folded stacks
+  for flamegraph.pl (--stacks-out)
 - Prometheus exporter: histograms + counters (low-cardinality by default)
-- Optional per-flow high-cardinality metrics: --per-flow (use sparingly)
+- Optional per-flow metrics: --per-flow, capped to the top-K flows (space-saving
+  sketch, --per-flow-top/--per-flow-capacity); everything else is labelled "other"
+- Aggregate mode (default): latency histograms are kept in BPF maps keyed by
+  cgroup_id/comm/role and read once per scrape; no per-event traffic to user space
+- Bounded state: per-sock maps are LRU (--flow-map-entries) and cleared on
+  TCP_CLOSE, user-space flow state expires after --flow-idle-ttl, and map
+  fill is exported as socket_bpf_map_entries/socket_bpf_map_capacity
 
 Requirements
 - Linux, root
 - bcc and matching kernel headers (apt install bpfcc-tools linux-headers-$(uname -r), or distro equivalent)
 - prometheus_client (pip install prometheus_client)
 
-# basic run with JSON output
-sudo ./socket_latency_ultra.py --json
+# default: in-kernel histograms, summary table every --interval seconds
+sudo ./socket_latency_ultra.py
+
+# per-event path with JSON output
+sudo ./socket_latency_ultra.py --mode events --json
+
+# keep a compact binary capture for offline analysis (sample-capture-query.py)
+sudo ./socket_latency_ultra.py --mode events --capture /var/tmp/latency.evcap
 
 # add Prometheus on port 9900 (default low-card labels)
 sudo ./socket_latency_ultra.py --prometheus-port 9900
 
-# high-cardinality per-flow labels (use sparingly!)
-sudo ./socket_latency_ultra.py --prometheus-port 9900 --per-flow
+# per-event metrics only: no stdout/log, so no entry dicts, timestamps or JSON are built
+sudo ./socket_latency_ultra.py --mode events --quiet --log-file "" --prometheus-port 9900
+
+# per-flow labels for the 50 slowest flows (the rest share src_ip="other")
+sudo ./socket_latency_ultra.py --prometheus-port 9900 --per-flow --per-flow-top 50 --per-flow-rank latency
+
+# shared ring buffer (5.8+) instead of per-CPU perf buffers, 16 MiB
+sudo ./socket_latency_ultra.py --mode events --transport ringbuf --buffer-pages 4096
+
+# where do connects/requests slower than 50ms come from? (needs symbols for pretty names)
+sudo ./socket_latency_ultra.py --stacks --stacks-min-ms 50 --stacks-out /tmp/slow.folded
+flamegraph.pl --countname=us /tmp/slow.folded > slow.svg
 
-# include user-space stacks (needs symbols for pretty names)
-sudo ./socket_latency_ultra.py --stacks --prometheus-port 9900
+# no kernel: push 200k synthetic (or recorded --capture) events through the
+# user-space pipeline and report events/sec + per-stage latency
+./socket_latency_ultra.py --replay synthetic:200000 --log-file /tmp/replay.log --replay-report report.json
 
 Tested on recent kernels with BCC 0.31+. Tracepoint field shapes vary; this code targets
 inet_sock_set_state with __u8[4] saddr/daddr (common on modern distros). Adjust noted spots if needed.
 """
 
 import argparse
+import ctypes as ct
 import hashlib
 import os
 import sys
 import socket
 import re
 import json
+import struct
+import threading
+import time
 from datetime import datetime
-from collections import deque, defaultdict
+from collections import defaultdict
+from functools import lru_cache
+
+from event_capture import LATENCY_SCHEMA, CaptureWriter
+from ebpf_common import (RECORD_VERSION, REC_TASK, TASK_STRUCT, DedupWindow, EventTransport, FuncCounterCollector,
+                         KernelClock, LogWriterCollector, LostEventsCollector, MapOccupancyCollector,
+                         ReorderBuffer, ReplayTransport, TaskDictionary, TaskRecord, add_dedup_args, add_log_args,
+                         add_reorder_args, add_replay_args, add_transport_args, apply_transport, cgroup_v2_root,
+                         load_bpf, log_writer_from_args, ipv4_arg, release_compiler, replay_filter, replay_records, set_filter_config_from_args,
+                         task_record, with_filter_config, with_task_dictionary)
 
 def parse_args():
     p = argparse.ArgumentParser(description="Ultimate Socket Latency Monitor + Prometheus")
     # filters
     p.add_argument("--pid", type=int, default=None, help="Filter by TGID (process id)")
-    p.add_argument("--src-ip", type=str, default=None, help="Filter by source IPv4")
-    p.add_argument("--dst-ip", type=str, default=None, help="Filter by destination IPv4")
+    p.add_argument("--src-ip", type=ipv4_arg, default=None, help="Filter by source IPv4")
+    p.add_argument("--dst-ip", type=ipv4_arg, default=None, help="Filter by destination IPv4")
     p.add_argument("--src-port", type=int, default=None, help="Filter by source port")
     p.add_argument("--dst-port", type=int, default=None, help="Filter by destination port")
     p.add_argument("--active-only", action="store_true", help="Only established/latency events")
     # telemetry/output
     p.add_argument("--log-file", default=os.environ.get("SOCKET_SNOOP_LOG", "/var/log/socket_monitor.log"))
-    p.add_argument("--json", action="store_true", help="Emit events as JSON lines to stdout")
+    add_log_args(p)
+    add_dedup_args(p, 8000)
+    p.add_argument("--capture", type=str, default=None,
+                   help="Also write raw events to a compact columnar capture (see sample-capture-query.py)")
+    p.add_argument("--json", action="store_true", help="Emit events as JSON lines to stdout (implies --mode events)")
+    p.add_argument("--quiet", action="store_true",
+                   help="Do not print events to stdout (log, capture and Prometheus still get them)")
+    # aggregation
+    p.add_argument("--mode", choices=["aggregate", "events"], default="aggregate",
+                   help="aggregate: histograms in BPF maps, read per scrape (default); events: one record per sample")
+    p.add_argument("--hist-scale", choices=["log2", "linear"], default="log2",
+                   help="In-kernel histogram slot scale (aggregate mode)")
+    p.add_argument("--hist-step-us", type=int, default=500, help="Linear slot width in microseconds")
+    p.add_argument("--hist-slots", type=int, default=64, help="Linear slot count; the last slot is overflow")
+    p.add_argument("--interval", type=float, default=10.0,
+                   help="Seconds between summary tables when Prometheus is disabled (aggregate mode) and --stacks-out rewrites")
     # stacks & cardinality
-    p.add_argument("--stacks", action="store_true", help="Collect user-space stacks (needs symbols for nice names)")
-    p.add_argument("--per-flow", action="store_true", help="Export per-flow (5-tuple) metrics (HIGH CARDINALITY)")
+    p.add_argument("--stacks", action="store_true",
+                   help="Attribute connect/request latency to user-space stacks (needs symbols for nice names)")
+    p.add_argument("--stacks-min-ms", type=float, default=0.0,
+                   help="Only charge samples at least this slow to their stack")
+    p.add_argument("--stacks-weight", choices=["latency", "count"], default="latency",
+                   help="Folded stack value: summed latency in microseconds, or sample count")
+    p.add_argument("--stacks-out", default=None,
+                   help="Rewrite folded stacks to this file every --interval seconds (default: print on exit)")
+    p.add_argument("--stack-storage", type=int, default=16384,
+                   help="Distinct stacks kept in-kernel (stack map and aggregation map size)")
+    p.add_argument("--cgroup-cache-size", type=int, default=4096,
+                   help="Max cgroup_id -> pod/container entries kept for enrichment")
+    p.add_argument("--cgroup-sweep", type=float, default=30.0,
+                   help="Seconds between sweeps that drop entries for removed cgroups")
+    p.add_argument("--per-flow", action="store_true",
+                   help="Export per-flow (5-tuple) metrics for the top flows (implies --mode events)")
+    p.add_argument("--per-flow-top", type=int, default=100,
+                   help="Flows exported with their own labels; the rest are aggregated as \"other\"")
+    p.add_argument("--per-flow-capacity", type=int, default=0,
+                   help="Flows tracked by the space-saving sketch (default: 4x --per-flow-top)")
+    p.add_argument("--per-flow-rank", choices=["events", "latency"], default="events",
+                   help="Rank flows by event count (heaviest) or summed latency (slowest)")
+    p.add_argument("--per-flow-refresh", type=float, default=10.0,
+                   help="Seconds between re-ranking the exported flow set")
+    p.add_argument("--flow-map-entries", type=int, default=65536,
+                   help="Capacity of each per-sock BPF map (LRU; the oldest entries go first when full)")
+    p.add_argument("--flow-idle-ttl", type=float, default=300.0,
+                   help="Seconds before user-space state of a flow with no events is dropped")
+    # transport
+    add_transport_args(p)
+    add_reorder_args(p)
+    add_replay_args(p)
     # prometheus
     p.add_argument("--prometheus-port", type=int, default=0, help="Port to expose Prometheus metrics (0=disabled)")
-    p.add_argument("--buckets", type=str, default="0.5,1,2.5,5,10,25,50,100,250,500,1000,2500",
-                   help="Histogram buckets in ms (comma-separated)")
+    p.add_argument("--buckets", type=str, default=None,
+                   help="Histogram buckets in ms (comma-separated; events mode default "
+                        "0.5,1,2.5,5,10,25,50,100,250,500,1000,2500). In aggregate mode the in-kernel "
+                        "slots are folded onto these bounds at export (a slot counts once its upper "
+                        "edge is <= le); unset exports the native slot ladder")
     return p.parse_args()
 
 BPF_PROGRAM = r"""
@@ -91,72 +186,159 @@ static __always_inline void fill_key(struct flow_key_t *k, u32 tgid, const __u8
     k->dport = bpf_ntohs(dport);
 }
 
-struct data_t {
+// REC_STATE / REC_REQRESP; the task's comm, cgroup, uid and ppid travel once
+// per thread in a REC_TASK record (TASK_DICTIONARY), keyed by tid.
+#define REC_STATE 2
+#define REC_REQRESP 3
+
+struct event_t {
+    u8  version;       // REC_VERSION
+    u8  kind;
+    s8  state;         // TCP state, -1 for req/resp
+    u8  pad;
+    u32 tid;
+    u64 ts_ns;         // bpf_ktime_get_ns() when the record was built
     u32 tgid;          // process (thread group id)
-    u32 pid;           // tid
-    u32 ppid;
-    u32 uid;
-    u64 cgroup_id;
-
-    char comm[TASK_COMM_LEN];
-
     u32 src_ip;
     u32 dst_ip;
     u16 src_port;
     u16 dst_port;
-
-    int state;         // TCP state or -1 for req/resp
-    char event[24];
-
-    // latency fields (ns)
-    u64 connect_latency_ns;   // SYN_SENT -> ESTABLISHED
-    u64 rr_latency_ns;        // send -> recv (copied to user)
+    u64 latency_ns;    // REC_STATE: SYN_SENT -> ESTABLISHED (0 otherwise); REC_REQRESP: send -> recv
 
     // TCP internals
-    u32 srtt_us;              // smoothed RTT
+    u32 srtt_us;       // smoothed RTT
     u32 rttvar_us;
-    u32 retransmits;          // observed retransmits on flow (monotonic)
-
-    // stacks
-    int have_stack;
-    u32 stack_id;
+    u32 retransmits;   // observed retransmits on flow (monotonic)
+    int stack_id;      // user stack of the connect()/send() caller, -1 if none
 };
 
-BPF_PERF_OUTPUT(events);
+EVENTS_OUTPUT
+TASK_DICTIONARY
 
 // state & timing
-BPF_HASH(conn_start_ts, struct flow_key_t, u64);
-BPF_HASH(last_send_ts, struct flow_key_t, u64);
-BPF_HASH(retrans_count, struct flow_key_t, u32);
-
-// stacks
-struct fd_key_t { u32 tgid; int fd; };
-BPF_STACK_TRACE(stack_traces, 8192);
-BPF_HASH(pending_connect_stack, struct fd_key_t, u32);
-BPF_HASH(pending_send_stack, struct fd_key_t, u32);
-
-TRACEPOINT_PROBE(syscalls, sys_enter_connect) {
-    struct fd_key_t fk = {};
-    u64 id = bpf_get_current_pid_tgid();
-    fk.tgid = id >> 32;
-    fk.fd = args->fd;
-    int stack_id = bpf_get_stackid(args, &stack_traces, BPF_F_USER_STACK);
-    if (stack_id >= 0) {
-        pending_connect_stack.update(&fk, &stack_id);
-    }
-    return 0;
+// SYN_SENT fires in the connecting task before the source port is bound, while
+// ESTABLISHED usually fires from softirq; key by sock and remember the owner.
+struct conn_start_t {
+    u64 ts;
+    u64 cgroup_id;
+    u32 tgid;
+    u32 pid;
+    int stack_id;      // user stack of the connect() caller, -1 without --stacks
+    char comm[TASK_COMM_LEN];
+};
+// first tcp_sendmsg of a request; later sends only move ts forward
+struct send_t {
+    u64 ts;
+    u32 tgid;
+    int stack_id;
+};
+// Per-sock state is keyed by the struct sock address and dropped on TCP_CLOSE;
+// LRU maps bound whatever is missed (sockets freed without a CLOSE transition,
+// fds that never reach tcp_sendmsg) so new flows are never refused.
+#ifndef FLOW_MAP_ENTRIES
+#define FLOW_MAP_ENTRIES 65536
+#endif
+BPF_TABLE("lru_hash", u64, struct conn_start_t, conn_start_ts, FLOW_MAP_ENTRIES);
+BPF_TABLE("lru_hash", u64, struct send_t, last_send_ts, FLOW_MAP_ENTRIES);
+BPF_TABLE("lru_hash", u64, u32, retrans_count, FLOW_MAP_ENTRIES);
+
+static __always_inline void forget_sock(u64 skaddr) {
+    conn_start_ts.delete(&skaddr);
+    last_send_ts.delete(&skaddr);
+    retrans_count.delete(&skaddr);
 }
-TRACEPOINT_PROBE(syscalls, sys_enter_sendto) {
-    struct fd_key_t fk = {};
-    u64 id = bpf_get_current_pid_tgid();
-    fk.tgid = id >> 32;
-    fk.fd = args->fd;
-    int stack_id = bpf_get_stackid(args, &stack_traces, BPF_F_USER_STACK);
-    if (stack_id >= 0) {
-        pending_send_stack.update(&fk, &stack_id);
-    }
-    return 0;
+
+FILTER_CONFIG
+
+#define KIND_CONNECT 0
+#define KIND_REQRESP 1
+#define ROLE_CLIENT 0
+#define ROLE_SERVER 1
+
+// --stacks: the user stack is taken where the task is the caller (SYN_SENT
+// runs inside connect(), tcp_sendmsg inside send()), carried in the per-sock
+// state and charged with the latency once it is known: stack_id -> count,
+// sum and max, read and symbolized by user space. Slower than STACK_MIN_NS only.
+#ifdef CAPTURE_STACKS
+#ifndef STACK_STORAGE
+#define STACK_STORAGE 16384
+#endif
+#ifndef STACK_MIN_NS
+#define STACK_MIN_NS 0
+#endif
+BPF_STACK_TRACE(stack_traces, STACK_STORAGE);
+
+struct stack_key_t {
+    u32 tgid;
+    int stack_id;
+    u32 kind;
+    u32 pad;
+};
+struct stack_val_t {
+    u64 count;
+    u64 sum_ns;
+    u64 max_ns;
+};
+BPF_HASH(stack_latency, struct stack_key_t, struct stack_val_t, STACK_STORAGE);
+
+static __always_inline void record_stack(u32 tgid, int stack_id, u32 kind, u64 ns) {
+    if (stack_id < 0 || ns < STACK_MIN_NS)
+        return;
+    struct stack_key_t key = {};
+    key.tgid = tgid;
+    key.stack_id = stack_id;
+    key.kind = kind;
+    struct stack_val_t zero = {};
+    struct stack_val_t *val = stack_latency.lookup_or_try_init(&key, &zero);
+    if (!val)
+        return;
+    __sync_fetch_and_add(&val->count, 1);
+    __sync_fetch_and_add(&val->sum_ns, ns);
+    if (ns > val->max_ns)
+        val->max_ns = ns;   // racy, good enough for a hint
 }
+#define CAPTURE_STACK(ctx) bpf_get_stackid(ctx, &stack_traces, BPF_F_USER_STACK)
+#else
+#define CAPTURE_STACK(ctx) -1
+#define record_stack(tgid, stack_id, kind, ns) do {} while (0)
+#endif
+
+#ifdef AGGREGATE
+struct hist_key_t {
+    u64 cgroup_id;
+    char comm[TASK_COMM_LEN];
+    u32 kind;
+    u32 role;
+    u64 slot;
+};
+BPF_HISTOGRAM(latency_hist, struct hist_key_t, 65536);
+BPF_HASH(latency_sum, struct hist_key_t, u64, 16384);   // slot == 0, sum of ns
+
+static __always_inline u64 latency_slot(u64 ns) {
+    u64 us = ns / 1000;
+#ifdef HIST_LINEAR
+    u64 slot = us / HIST_STEP_US;
+    return slot < HIST_SLOTS - 1 ? slot : HIST_SLOTS - 1;
+#else
+    return bpf_log2l(us);
+#endif
+}
+
+static __always_inline void record_latency(u64 cgroup_id, const char *comm, u32 kind, u32 role, u64 ns) {
+    struct hist_key_t key = {};
+    key.cgroup_id = cgroup_id;
+    __builtin_memcpy(&key.comm, comm, sizeof(key.comm));
+    key.kind = kind;
+    key.role = role;
+
+    u64 zero = 0;
+    u64 *sum = latency_sum.lookup_or_try_init(&key, &zero);
+    if (sum) __sync_fetch_and_add(sum, ns);
+
+    key.slot = latency_slot(ns);
+    latency_hist.atomic_increment(key);
+}
+#endif
 
 TRACEPOINT_PROBE(sock, inet_sock_set_state) {
     if (args->family != AF_INET)
@@ -169,38 +351,83 @@ TRACEPOINT_PROBE(sock, inet_sock_set_state) {
     struct flow_key_t key = {};
     fill_key(&key, tgid, args->saddr, args->daddr, args->sport, args->dport);
 
+    u64 skaddr = (u64)args->skaddr;
+
     if (args->newstate == TCP_SYN_SENT) {
-        u64 ts = bpf_ktime_get_ns();
-        conn_start_ts.update(&key, &ts);
+        struct conn_start_t start = {};
+        start.ts = bpf_ktime_get_ns();
+        start.cgroup_id = bpf_get_current_cgroup_id();
+        start.tgid = tgid;
+        start.pid = pid;
+        start.stack_id = CAPTURE_STACK(args);
+        bpf_get_current_comm(&start.comm, sizeof(start.comm));
+        conn_start_ts.update(&skaddr, &start);
+#ifdef EMIT_EVENTS
+        // the ESTABLISHED record is attributed to this task, usually from softirq
+        announce_task(args);
+#endif
         return 0;
     }
 
-    struct data_t data = {};
-    data.tgid = tgid;
-    data.pid  = pid;
-    data.uid  = bpf_get_current_uid_gid();
-    data.cgroup_id = bpf_get_current_cgroup_id();
-    bpf_get_current_comm(&data.comm, sizeof(data.comm));
-    u32 ppid = 0;
-    struct task_struct *task = (struct task_struct *)bpf_get_current_task();
-    if (task && task->real_parent) {
-        bpf_probe_read_kernel(&ppid, sizeof(ppid), &task->real_parent->tgid);
+#ifdef EMIT_EVENTS
+    u32 retransmits = 0;
+    u32 *rc = retrans_count.lookup(&skaddr);
+    if (rc) retransmits = *rc;
+#endif
+
+    u64 connect_latency_ns = 0;
+    struct conn_start_t *start = 0;
+    if (args->newstate == TCP_ESTABLISHED) {
+        start = conn_start_ts.lookup(&skaddr);
+        if (start)
+            connect_latency_ns = bpf_ktime_get_ns() - start->ts;
     }
-    data.ppid = ppid;
 
-    data.src_ip = ((u32)args->saddr[0] << 24) | ((u32)args->saddr[1] << 16) | ((u32)args->saddr[2] << 8) | ((u32)args->saddr[3]);
-    data.dst_ip = ((u32)args->daddr[0] << 24) | ((u32)args->daddr[1] << 16) | ((u32)args->daddr[2] << 8) | ((u32)args->daddr[3]);
-    data.src_port = bpf_ntohs(args->sport);
-    data.dst_port = bpf_ntohs(args->dport);
+    // the connection is gone (including connects that failed from SYN_SENT):
+    // nothing keyed by this sock is needed any more, filtered or not
+    int closing = args->newstate == TCP_CLOSE;
+
+    if (filtered_out(start ? start->tgid : tgid, key.saddr, key.daddr, key.sport, key.dport, args->newstate)) {
+        if (start) conn_start_ts.delete(&skaddr);
+        if (closing) forget_sock(skaddr);
+        return 0;
+    }
+
+#ifdef AGGREGATE
+    if (start)
+        record_latency(start->cgroup_id, start->comm, KIND_CONNECT, ROLE_CLIENT, connect_latency_ns);
+#endif
+    if (start)
+        record_stack(start->tgid, start->stack_id, KIND_CONNECT, connect_latency_ns);
+
+#ifndef EMIT_EVENTS
+    if (start) conn_start_ts.delete(&skaddr);
+    if (closing) forget_sock(skaddr);
+    return 0;
+#else
+
+    struct event_t data = {};
+    data.version = REC_VERSION;
+    data.kind = REC_STATE;
     data.state = args->newstate;
-    __builtin_memcpy(&data.event, "State Change", 13);
+    data.tid = pid;
+    data.ts_ns = bpf_ktime_get_ns();
+    data.tgid = tgid;
+    data.src_ip = key.saddr;
+    data.dst_ip = key.daddr;
+    data.src_port = key.sport;
+    data.dst_port = key.dport;
+    data.stack_id = -1;
 
-    if (args->newstate == TCP_ESTABLISHED) {
-        u64 *tsp = conn_start_ts.lookup(&key);
-        if (tsp) {
-            data.connect_latency_ns = bpf_ktime_get_ns() - *tsp;
-            conn_start_ts.delete(&key);
-        }
+    if (start) {
+        // attribute the handshake to the task that called connect(), not softirq
+        data.latency_ns = connect_latency_ns;
+        data.tgid = start->tgid;
+        data.tid = start->pid;
+        data.stack_id = start->stack_id;
+        conn_start_ts.delete(&skaddr);
+    } else {
+        announce_task(args);
     }
 
     if (args->skaddr) {
@@ -215,55 +442,36 @@ TRACEPOINT_PROBE(sock, inet_sock_set_state) {
         }
     }
 
-    u32 *rc = retrans_count.lookup(&key);
-    if (rc) data.retransmits = *rc;
+    data.retransmits = retransmits;
+    if (closing) forget_sock(skaddr);
 
-    data.have_stack = 0;
-    data.stack_id = -1;
-
-    events.perf_submit(args, &data, sizeof(data));
+    SUBMIT_EVENT(args, data);
     return 0;
+#endif
 }
 
 TRACEPOINT_PROBE(tcp, tcp_retransmit_skb) {
-    struct flow_key_t key = {};
-    key.tgid = 0; // kernel context; kept zero; keyed by 4-tuple
-    key.saddr = args->saddr;
-    key.daddr = args->daddr;
-    key.sport = args->sport;
-    key.dport = args->dport;
-
-    u32 *cnt = retrans_count.lookup(&key);
-    u32 one = 1;
-    if (!cnt) {
-        retrans_count.update(&key, &one);
-    } else {
-        __sync_fetch_and_add(cnt, 1);
-    }
+    // runs in softirq/timer context: key by sock like the other per-flow maps
+    u64 skaddr = (u64)args->skaddr;
+    u32 zero = 0;
+    u32 *cnt = retrans_count.lookup_or_try_init(&skaddr, &zero);
+    if (cnt) __sync_fetch_and_add(cnt, 1);
     return 0;
 }
 
 int kprobe__tcp_sendmsg(struct pt_regs *ctx, struct sock *sk, struct msghdr *msg, size_t size) {
-    u64 id = bpf_get_current_pid_tgid();
-    u32 tgid = id >> 32;
-
-    u16 sport = 0, dport = 0;
-    u32 saddr = 0, daddr = 0;
-    struct inet_sock *inet = (struct inet_sock *)sk;
-    bpf_probe_read_kernel(&sport, sizeof(sport), &inet->inet_sport);
-    bpf_probe_read_kernel(&dport, sizeof(dport), &inet->inet_dport);
-    bpf_probe_read_kernel(&saddr, sizeof(saddr), &inet->inet_saddr);
-    bpf_probe_read_kernel(&daddr, sizeof(daddr), &inet->inet_daddr);
-
-    struct flow_key_t key = {};
-    key.tgid = tgid;
-    key.saddr = saddr;
-    key.daddr = daddr;
-    key.sport = bpf_ntohs(sport);
-    key.dport = bpf_ntohs(dport);
-
+    u64 skaddr = (u64)sk;
     u64 ts = bpf_ktime_get_ns();
-    last_send_ts.update(&key, &ts);
+    struct send_t *prev = last_send_ts.lookup(&skaddr);
+    if (prev) {
+        prev->ts = ts;
+        return 0;
+    }
+    struct send_t send = {};
+    send.ts = ts;
+    send.tgid = bpf_get_current_pid_tgid() >> 32;
+    send.stack_id = CAPTURE_STACK(ctx);
+    last_send_ts.update(&skaddr, &send);
     return 0;
 }
 
@@ -281,31 +489,48 @@ int kprobe__tcp_cleanup_rbuf(struct pt_regs *ctx, struct sock *sk, int copied) {
     bpf_probe_read_kernel(&saddr, sizeof(saddr), &inet->inet_saddr);
     bpf_probe_read_kernel(&daddr, sizeof(daddr), &inet->inet_daddr);
 
-    struct flow_key_t key = {};
-    key.tgid = tgid;
-    key.saddr = saddr;
-    key.daddr = daddr;
-    key.sport = bpf_ntohs(sport);
-    key.dport = bpf_ntohs(dport);
-
-    u64 *tsp = last_send_ts.lookup(&key);
-    if (!tsp) return 0;
+    u64 skaddr = (u64)sk;
+    struct send_t *sendp = last_send_ts.lookup(&skaddr);
+    if (!sendp) return 0;
+    u64 rr_latency_ns = bpf_ktime_get_ns() - sendp->ts;
+    u32 send_tgid = sendp->tgid;
+    int stack_id = sendp->stack_id;
+
+    // inet_* fields are network order; events carry host order like the tracepoint path
+    u32 src_ip = bpf_ntohl(saddr);
+    u32 dst_ip = bpf_ntohl(daddr);
+    if (filtered_out(tgid, src_ip, dst_ip, bpf_ntohs(sport), bpf_ntohs(dport), -1)) {
+        last_send_ts.delete(&skaddr);
+        return 0;
+    }
 
-    struct data_t data = {};
+#ifdef AGGREGATE
+    {
+        char comm[TASK_COMM_LEN];
+        bpf_get_current_comm(&comm, sizeof(comm));
+        // heuristic: the side with the lower port is the listener
+        u32 role = bpf_ntohs(sport) < bpf_ntohs(dport) ? ROLE_SERVER : ROLE_CLIENT;
+        record_latency(bpf_get_current_cgroup_id(), comm, KIND_REQRESP, role, rr_latency_ns);
+    }
+#endif
+    record_stack(send_tgid, stack_id, KIND_REQRESP, rr_latency_ns);
+
+#ifdef EMIT_EVENTS
+    announce_task(ctx);
+    struct event_t data = {};
+    data.version = REC_VERSION;
+    data.kind = REC_REQRESP;
+    data.state = -1;
+    data.tid = (u32)id;
+    data.ts_ns = bpf_ktime_get_ns();
     data.tgid = tgid;
-    data.pid  = (u32)id;
-    data.uid  = bpf_get_current_uid_gid();
-    data.cgroup_id = bpf_get_current_cgroup_id();
-    bpf_get_current_comm(&data.comm, sizeof(data.comm));
-    data.src_ip = saddr;
-    data.dst_ip = daddr;
+    data.src_ip = src_ip;
+    data.dst_ip = dst_ip;
     data.src_port = bpf_ntohs(sport);
     data.dst_port = bpf_ntohs(dport);
-    data.state = -1;
-    __builtin_memcpy(&data.event, "ReqResp Latency", 16);
-    data.rr_latency_ns = bpf_ktime_get_ns() - *tsp;
+    data.latency_ns = rr_latency_ns;
 
-    u32 *rc = retrans_count.lookup(&key);
+    u32 *rc = retrans_count.lookup(&skaddr);
     if (rc) data.retransmits = *rc;
 
     struct tcp_sock *tp = (struct tcp_sock *)tcp_sk(sk);
@@ -317,12 +542,12 @@ int kprobe__tcp_cleanup_rbuf(struct pt_regs *ctx, struct sock *sk, int copied) {
         data.rttvar_us = rttvar_us;
     }
 
-    data.have_stack = 0;
-    data.stack_id = -1;
+    data.stack_id = stack_id;
 
-    events.perf_submit(ctx, &data, sizeof(data));
+    SUBMIT_EVENT(ctx, data);
+#endif
 
-    last_send_ts.delete(&key);
+    last_send_ts.delete(&skaddr);
     return 0;
 }
 """
@@ -340,56 +565,609 @@ TCP_STATES = {
     10: "LISTEN",
     11: "CLOSING",
 }
+TCP_CLOSE = 7
 
+@lru_cache(maxsize=65536)
 def format_ip(ip_u32: int) -> str:
-    return ".".join(str((ip_u32 >> s) & 0xFF) for s in (24, 16, 8, 0))
+    return socket.inet_ntoa(ip_u32.to_bytes(4, "big"))
+
+class TimestampCache:
+    """The log timestamp ("%b %d %Y %H:%M:%S.mmm") of a wall-clock ns value, formatted once per millisecond."""
+
+    def __init__(self):
+        self._ms = -1
+        self._text = ""
+
+    def text(self, wall_ns: int) -> str:
+        ms = wall_ns // 1000000
+        if ms != self._ms:
+            self._ms = ms
+            self._text = datetime.fromtimestamp(ms // 1000).strftime("%b %d %Y %H:%M:%S") + f".{ms % 1000:03d}"
+        return self._text
 
 def connection_id(src_ip, src_port, dst_ip, dst_port) -> str:
     unique = f"{src_ip}:{src_port}->{dst_ip}:{dst_port}"
     return hashlib.md5(unique.encode()).hexdigest()
 
+REC_STATE = 2
+REC_REQRESP = 3
+EVENT_NAMES = {REC_STATE: "State Change", REC_REQRESP: "ReqResp Latency"}
+
+class LatencyEvent(ct.Structure):
+    """ctypes mirror of struct event_t (REC_STATE and REC_REQRESP records)."""
+    _fields_ = [
+        ("version", ct.c_uint8), ("kind", ct.c_uint8), ("state", ct.c_int8), ("pad", ct.c_uint8),
+        ("tid", ct.c_uint32), ("ts_ns", ct.c_uint64), ("tgid", ct.c_uint32),
+        ("src_ip", ct.c_uint32), ("dst_ip", ct.c_uint32), ("src_port", ct.c_uint16), ("dst_port", ct.c_uint16),
+        ("latency_ns", ct.c_uint64),
+        ("srtt_us", ct.c_uint32), ("rttvar_us", ct.c_uint32), ("retransmits", ct.c_uint32),
+        ("stack_id", ct.c_int32),
+    ]
+
+JSON = json.JSONEncoder(separators=(",", ":"))   # json.dumps() builds a new encoder per call with separators
+
+# struct event_t, decoded in bulk with iter_unpack (Python-side fields are plain ints)
+EVENT_STRUCT = struct.Struct("=BBbBIQIIIHHQIIIi")
+
+SYNTHETIC_COMMS = [b"nginx", b"envoy", b"UnityServer", b"curl", b"python3", b"redis-server"]
+
+def synthetic_event(i: int, rng) -> LatencyEvent:
+    """Plausible record mix: mostly req/resp samples over ~2k flows, some connects/closes."""
+    flow = rng.randrange(2048)
+    ev = LatencyEvent(RECORD_VERSION)
+    ev.tgid = 1000 + flow % 64
+    ev.tid = ev.tgid + flow % 4
+    ev.src_ip = 0x0A000000 | flow
+    ev.dst_ip = 0x0A640000 | (flow % 16)
+    ev.src_port = 32768 + flow
+    ev.dst_port = (80, 443, 6379, 7777)[flow % 4]
+    kind = rng.random()
+    if kind < 0.8:
+        ev.kind, ev.state = REC_REQRESP, -1
+        ev.latency_ns = int(rng.lognormvariate(13.5, 1.0))
+    elif kind < 0.9:
+        ev.kind, ev.state = REC_STATE, 1
+        ev.latency_ns = int(rng.lognormvariate(12.5, 0.8))
+    else:
+        ev.kind, ev.state = REC_STATE, rng.choice((2, 4, 7))
+    ev.srtt_us = int(rng.lognormvariate(6.5, 0.6))
+    ev.rttvar_us = ev.srtt_us // 4
+    ev.retransmits = i // 5000 if flow == 7 else 0
+    ev.stack_id = -1
+    return ev
+
+def synthetic_task(tid: int, tgid: int) -> TaskRecord:
+    return task_record(tid, tgid, ppid=1, uid=0 if tgid % 3 else 1000,
+                       comm=SYNTHETIC_COMMS[tgid % len(SYNTHETIC_COMMS)])
+
+def event_from_row(row: dict) -> LatencyEvent:
+    """LATENCY_SCHEMA capture row -> LatencyEvent (capture pid/tid are tgid/tid)."""
+    ev = LatencyEvent(RECORD_VERSION)
+    ev.tgid, ev.tid = row["pid"], row["tid"]
+    ev.src_ip, ev.dst_ip, ev.src_port, ev.dst_port = row["src_ip"], row["dst_ip"], row["src_port"], row["dst_port"]
+    ev.state = row["state"]
+    if row["state"] == -1:
+        ev.kind, ev.latency_ns = REC_REQRESP, row["rr_latency_ns"]
+    else:
+        ev.kind, ev.latency_ns = REC_STATE, row["connect_latency_ns"]
+    ev.srtt_us, ev.rttvar_us, ev.retransmits = row["srtt_us"], row["rttvar_us"], row["retransmits"]
+    ev.stack_id = -1
+    return ev
+
+def replay_source(source: str, keep) -> list:
+    """Raw records for --replay: one REC_TASK record per tid, then the events."""
+    tasks = {}
+    clock = KernelClock()
+    t0 = time.monotonic_ns()
+
+    def synthesize(i, rng):
+        ev = synthetic_event(i, rng)
+        # 20us apart and up to 2ms out of order, like per-CPU buffers read in turn
+        ev.ts_ns = t0 + i * 20000 + rng.randrange(2000000)
+        if ev.tid not in tasks:
+            tasks[ev.tid] = synthetic_task(ev.tid, ev.tgid)
+        return ev
+
+    def from_row(row):
+        if row["tid"] not in tasks:
+            tasks[row["tid"]] = task_record(row["tid"], row["pid"], row["ppid"], row["uid"],
+                                            row["cgroup_id"], row["comm"])
+        ev = event_from_row(row)
+        ev.ts_ns = max(0, clock.ktime_ns(row["ts_ns"]))
+        return ev
+
+    events = replay_records(source, synthesize, from_row, keep)
+    return [bytes(task) for task in tasks.values()] + events
+
+class MetricChildren:
+    """The per-event metrics' children for one label tuple, bound once.
+
+    Metric.labels() validates and hashes the label values on every call; the
+    monitor looks its children up once per label tuple and keeps them here.
+    A child is bound the first time its metric is used for the tuple, since
+    labels() creates the series: a flow with no connect sample must not
+    export an empty connect histogram.
+    """
+
+    FIELDS = ("events", "connect", "reqresp", "srtt", "rttvar", "retrans")
+    __slots__ = FIELDS + ("_metrics", "_values")
+
+    def __init__(self, metrics, values):
+        self._metrics = dict(zip(self.FIELDS, metrics))
+        self._values = values
+
+    def __getattr__(self, name):
+        # only reached while the slot is still unset
+        try:
+            metric = self._metrics[name]
+        except KeyError:
+            raise AttributeError(name) from None
+        child = metric.labels(*self._values)
+        setattr(self, name, child)
+        return child
+
+OTHER_FLOW = ("other", "other", "other", "other")
+
+class FlowTopK:
+    """Top-K flows by weight with a Space-Saving sketch of bounded size.
+
+    offer() is O(log capacity): a new flow replaces the current minimum and
+    inherits its count as error, so heavy flows can never be missed. Which
+    flows get their own metric labels is decided only at refresh(), by
+    guaranteed count (count - error), so the exported set does not flap
+    between scrapes; refresh() returns the flows that dropped out so their
+    label children can be removed. children remembers every label tuple
+    emitted per exported flow.
+    """
+
+    def __init__(self, k: int = 100, capacity: int = 0, refresh_interval: float = 10.0):
+        self.k = max(1, k)
+        self.capacity = max(self.k, capacity or 4 * self.k)
+        self.refresh_interval = refresh_interval
+        self.counts = {}        # flow -> [count, error]
+        self.exported = set()
+        self.children = {}      # exported flow -> {label tuple, ...}
+        self.evictions = 0
+        self._heap = []         # (count, flow); stale entries skipped lazily
+        self._next_refresh = time.monotonic() + min(1.0, refresh_interval)
+
+    def offer(self, flow, weight: float = 1.0) -> bool:
+        """Count weight for flow; True if the flow currently has its own labels."""
+        import heapq
+        entry = self.counts.get(flow)
+        if entry is not None:
+            entry[0] += weight
+        elif len(self.counts) < self.capacity:
+            entry = self.counts[flow] = [weight, 0.0]
+        else:
+            while True:
+                count, victim = heapq.heappop(self._heap)
+                cur = self.counts.get(victim)
+                if cur is not None and cur[0] == count:
+                    break
+            del self.counts[victim]
+            self.evictions += 1
+            entry = self.counts[flow] = [count + weight, count]
+        heapq.heappush(self._heap, (entry[0], flow))
+        if len(self._heap) > 8 * self.capacity:
+            self._heap = [(c, f) for f, (c, _e) in self.counts.items()]
+            heapq.heapify(self._heap)
+        return flow in self.exported
+
+    def refresh(self, now: float = None) -> list:
+        """Re-rank if due; return flows that lost their labels."""
+        import heapq
+        now = time.monotonic() if now is None else now
+        if now < self._next_refresh:
+            return []
+        self._next_refresh = now + self.refresh_interval
+        ranked = heapq.nlargest(self.k, self.counts.items(), key=lambda kv: kv[1][0] - kv[1][1])
+        top = {flow for flow, (count, error) in ranked if count - error > 0}
+        removed = [flow for flow in self.exported if flow not in top]
+        self.exported = top
+        return removed
+
+class RetransDeltas:
+    """Last cumulative retransmit count per flow, to bump a counter by deltas.
+
+    A flow is forgotten when it reports TCP_CLOSE, and otherwise after
+    idle_ttl seconds without events (swept every sweep_interval seconds), so
+    the table tracks live flows rather than every flow ever seen.
+    """
+
+    def __init__(self, idle_ttl: float = 300.0, sweep_interval: float = 30.0):
+        from collections import OrderedDict
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self._flows = OrderedDict()     # flow -> (retransmits, last seen); oldest first
+        self._next_sweep = time.monotonic() + sweep_interval
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._flows)
+
+    def delta(self, flow, total: int, closed: bool = False) -> int:
+        """Retransmits since the flow's previous event."""
+        prev = self._flows.pop(flow, (0, 0.0))[0]
+        if not closed:
+            self._flows[flow] = (max(prev, total), time.monotonic())
+        return total - prev if total > prev else 0
+
+    def maybe_sweep(self):
+        now = time.monotonic()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.sweep_interval
+        cutoff = now - self.idle_ttl
+        while self._flows:
+            flow, (_total, seen) = next(iter(self._flows.items()))
+            if seen > cutoff:
+                break
+            del self._flows[flow]
+            self.expired += 1
+
+# per-sock BPF maps reported by socket_bpf_map_entries/_capacity
+FLOW_MAPS = ("conn_start_ts", "last_send_ts", "retrans_count")
+
+class StackSymbolizer:
+    """(tgid, stack_id) -> folded user stack, with per-process symbol caches.
+
+    BCC keeps one symbol table per pid; on top of that every resolved stack
+    is memoised per process. Processes are kept in LRU order: beyond max_pids
+    the least recently used one is dropped (with BCC's table), as is any
+    process found to have exited at a sweep, so long runs over many
+    short-lived processes do not accumulate symbol tables.
+    """
+
+    def __init__(self, b, max_pids: int = 256, sweep_interval: float = 60.0):
+        from collections import OrderedDict
+        self.b = b
+        self.max_pids = max(1, max_pids)
+        self.sweep_interval = sweep_interval
+        self._procs = OrderedDict()     # tgid -> (comm, {stack_id: "a;b;c"})
+        self._next_sweep = time.monotonic() + sweep_interval
+
+    def _proc(self, tgid: int):
+        proc = self._procs.get(tgid)
+        if proc is not None:
+            self._procs.move_to_end(tgid)
+            return proc
+        try:
+            with open(f"/proc/{tgid}/comm") as f:
+                comm = f.read().strip()
+        except OSError:
+            comm = f"[pid {tgid}]"
+        proc = self._procs[tgid] = (comm, {})
+        if len(self._procs) > self.max_pids:
+            self._forget(next(iter(self._procs)))
+        return proc
+
+    def _forget(self, tgid: int):
+        self._procs.pop(tgid, None)
+        getattr(self.b, "_sym_caches", {}).pop(tgid, None)
+
+    def comm(self, tgid: int) -> str:
+        return self._proc(tgid)[0]
+
+    def frames(self, tgid: int, stack_id: int) -> str:
+        """Frames root-first, ';'-joined (folded format without the value)."""
+        stacks = self._proc(tgid)[1]
+        folded = stacks.get(stack_id)
+        if folded is None:
+            try:
+                addrs = list(self.b["stack_traces"].walk(stack_id))
+            except KeyError:
+                addrs = []
+            names = [self.b.sym(addr, tgid).decode(errors="replace").replace(";", ":") for addr in addrs]
+            folded = stacks[stack_id] = ";".join(reversed(names)) or "[unknown]"
+        return folded
+
+    def maybe_sweep(self):
+        now = time.monotonic()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.sweep_interval
+        for tgid in list(self._procs):
+            if not os.path.exists(f"/proc/{tgid}"):
+                self._forget(tgid)
+
+def folded_stacks(b, symbols: StackSymbolizer, weight: str = "latency") -> dict:
+    """'comm;[kind];frame;...' -> count or summed latency (us) from stack_latency."""
+    out = defaultdict(int)
+    for k, v in b["stack_latency"].items():
+        kind = HIST_KINDS.get(k.kind, str(k.kind))
+        tgid, stack_id = int(k.tgid), int(k.stack_id)
+        line = f"{symbols.comm(tgid)};[{kind}];{symbols.frames(tgid, stack_id)}"
+        out[line] += int(v.count) if weight == "count" else int(v.sum_ns) // 1000
+    symbols.maybe_sweep()
+    return out
+
+def dump_stacks(b, symbols: StackSymbolizer, args, final: bool = False):
+    """Write folded stacks to --stacks-out (atomically), or print them on the final call."""
+    lines = [f"{stack} {value}" for stack, value in
+             sorted(folded_stacks(b, symbols, args.stacks_weight).items(), key=lambda kv: -kv[1])]
+    if args.stacks_out:
+        tmp = f"{args.stacks_out}.tmp"
+        with open(tmp, "w") as f:
+            f.writelines(line + "\n" for line in lines)
+        os.replace(tmp, args.stacks_out)
+        if final:
+            print(f"Folded stacks: {len(lines)} in {args.stacks_out}")
+    elif final:
+        print(f"--- folded stacks ({args.stacks_weight}) ---")
+        for line in lines:
+            print(line)
+
+LOG_HEADER = "Ultimate Socket Latency Log\n" + "=" * 60 + "\n"
+
 def ns_to_ms(ns: int) -> float:
     return round(ns / 1_000_000.0, 6)
 
+# --- In-kernel histogram readout (aggregate mode) ---
+HIST_KINDS = {0: "connect", 1: "reqresp"}
+HIST_ROLES = {0: "client", 1: "server"}
+HIST_METRICS = {
+    "connect": ("socket_connect_latency_seconds", "TCP connect latency (SYN_SENT->ESTABLISHED)"),
+    "reqresp": ("socket_reqresp_latency_seconds", "Request->Response latency (send->recv to user)"),
+}
+
+def slot_upper_us(slot: int, scale: str, step_us: int) -> float:
+    """Upper bound (exclusive) of a histogram slot in microseconds."""
+    if scale == "linear":
+        return float((slot + 1) * step_us)
+    return float(1 << slot)
+
+LOG2_SLOTS = 32     # log2 ladder: 1us .. 2^31us (~36 min); anything slower only counts in +Inf
+
+def read_histograms(b, scale: str, step_us: int, slots: int):
+    """Fold latency_hist/latency_sum into {(kind, role, cgroup_id, comm): (buckets, count, sum_s)}.
+
+    buckets is a sorted list of (upper_bound_seconds, cumulative_count) over
+    the full fixed ladder, zero-filled, so every series has the same `le` set
+    on every scrape (sum by (le) and histogram_quantile need that). The
+    overflow slot of a linear histogram is reported only through +Inf.
+    """
+    per_key = defaultdict(dict)
+    for k, v in b["latency_hist"].items():
+        ident = (HIST_KINDS.get(k.kind, str(k.kind)), HIST_ROLES.get(k.role, str(k.role)),
+                 int(k.cgroup_id), k.comm.decode(errors="ignore"))
+        per_key[ident][int(k.slot)] = int(v.value)
+    sums = {}
+    for k, v in b["latency_sum"].items():
+        ident = (HIST_KINDS.get(k.kind, str(k.kind)), HIST_ROLES.get(k.role, str(k.role)),
+                 int(k.cgroup_id), k.comm.decode(errors="ignore"))
+        sums[ident] = int(v.value) / 1e9
+
+    ladder = max(1, slots - 1) if scale == "linear" else LOG2_SLOTS
+    bounds = [slot_upper_us(slot, scale, step_us) / 1e6 for slot in range(ladder)]
+    out = {}
+    for ident, counts in per_key.items():
+        buckets, cum = [], 0
+        for slot, upper in enumerate(bounds):
+            cum += counts.get(slot, 0)
+            buckets.append((upper, cum))
+        out[ident] = (buckets, sum(counts.values()), sums.get(ident, 0.0))
+    return out
+
+def rebucket(buckets, bounds):
+    """Fold cumulative slot buckets onto requested upper bounds (seconds).
+
+    A slot counts toward le=bound only once its whole range lies below the
+    bound, so each folded bucket is a lower bound on the true count (exact
+    where a slot edge coincides with the bound). The ladder stays fixed.
+    """
+    out, i, cum = [], 0, 0
+    for bound in bounds:
+        while i < len(buckets) and buckets[i][0] <= bound * (1 + 1e-9):
+            cum = buckets[i][1]
+            i += 1
+        out.append((bound, cum))
+    return out
+
+def hist_quantile(buckets, count: int, q: float) -> float:
+    """Upper-bound estimate of quantile q (seconds) from cumulative buckets."""
+    if not count:
+        return 0.0
+    rank = q * count
+    for upper, cum in buckets:
+        if cum >= rank:
+            return upper
+    return float("inf")
+
+class HistogramCollector:
+    """Prometheus collector that reads the BPF histogram maps at scrape time."""
+
+    def __init__(self, b, resolver, scale: str, step_us: int, slots: int, bounds=None):
+        self.b = b
+        self.resolver = resolver
+        self.scale = scale
+        self.step_us = step_us
+        self.slots = slots
+        self.bounds = bounds    # --buckets in seconds; None exports the slot ladder as is
+
+    def collect(self):
+        from prometheus_client.core import HistogramMetricFamily
+        families = {
+            kind: HistogramMetricFamily(name, desc, labels=["role", "cgroup_id", "pod_uid", "container_id", "comm"])
+            for kind, (name, desc) in HIST_METRICS.items()
+        }
+        for (kind, role, cgroup_id, comm), (buckets, count, total) in \
+                read_histograms(self.b, self.scale, self.step_us, self.slots).items():
+            fam = families.get(kind)
+            if fam is None:
+                continue
+            if self.bounds:
+                buckets = rebucket(buckets, self.bounds)
+            prom_buckets = [(repr(upper), cum) for upper, cum in buckets] + [("+Inf", count)]
+            k8s = self.resolver.resolve(cgroup_id)
+            fam.add_metric([role, str(cgroup_id), k8s.get("pod_uid") or "", k8s.get("container_id") or "", comm],
+                           prom_buckets, total)
+        self.resolver.maybe_sweep()
+        yield from families.values()
+
+def print_hist_summary(b, scale: str, step_us: int, slots: int):
+    rows = read_histograms(b, scale, step_us, slots)
+    stamp = datetime.now().strftime("%b %d %Y %H:%M:%S")
+    print(f"--- {stamp} ---")
+    print(f"{'KIND':<8} {'ROLE':<7} {'CGROUP_ID':>12} {'COMM':<16} {'COUNT':>10} {'AVG_MS':>9} {'P50_MS':>9} {'P99_MS':>9}")
+    for (kind, role, cgroup_id, comm), (buckets, count, total) in sorted(
+            rows.items(), key=lambda kv: kv[1][1], reverse=True):
+        avg = total / count * 1000.0 if count else 0.0
+        p50 = hist_quantile(buckets, count, 0.50) * 1000.0
+        p99 = hist_quantile(buckets, count, 0.99) * 1000.0
+        print(f"{kind:<8} {role:<7} {cgroup_id:>12} {comm:<16} {count:>10} {avg:>9.3f} {p50:>9.3f} {p99:>9.3f}")
+
 # --- Kubernetes / cgroup enrichment (best-effort) ---
 CGRX_PATTERNS = [
-    # cgroup v2 pod path examples (containerd/crio)
-    re.compile(r".*kubepods.*pod([0-9a-fA-F\-]{36}).*?/[0-9a-fA-F]{64}$"),          # podUID + containerID (64)
-    re.compile(r".*kubepods.*pod([0-9a-fA-F\-]{36}).*?/(cri-containerd|docker)-([0-9a-fA-F]{64}).*$"),
+    # cgroup v2 pod path examples (containerd/crio; systemd driver uses '_' in the pod UID)
+    re.compile(r".*kubepods.*pod([0-9a-fA-F\-_]{36}).*?/([0-9a-fA-F]{64})$"),          # podUID + containerID (64)
+    re.compile(r".*kubepods.*pod([0-9a-fA-F\-_]{36}).*?/(cri-containerd|docker|crio)-([0-9a-fA-F]{64}).*$"),
     # docker legacy
     re.compile(r".*docker[-/].*?([0-9a-fA-F]{64}).*$"),
 ]
+CGRX_HINTS = ("kubepods", "docker")
 
-def k8s_enrich_from_pid(pid: int):
-    """Return dict with {'pod_uid', 'container_id'} if derivable from /proc/<pid>/cgroup."""
-    cgroup_path = f"/proc/{pid}/cgroup"
-    res = {}
+def k8s_ids_from_path(path: str, res: dict) -> dict:
+    """Fill {'pod_uid', 'container_id'} in res from one cgroup path."""
+    if not any(h in path for h in CGRX_HINTS):
+        return res
+    for rx in CGRX_PATTERNS:
+        m = rx.match(path)
+        if m:
+            groups = m.groups()
+            if len(groups) == 1:
+                res.setdefault("container_id", groups[0])
+            else:
+                res.setdefault("pod_uid", groups[0].replace("_", "-"))
+                res.setdefault("container_id", groups[-1])
+    return res
+
+def read_proc_cgroup(pid: int):
+    """Return (v2_path or None, ids) parsed from /proc/<pid>/cgroup."""
+    res, v2_path = {}, None
     try:
-        with open(cgroup_path, "r") as f:
+        with open(f"/proc/{pid}/cgroup", "r") as f:
             data = f.read()
-        # v2 line: 0::/kubepods.slice/.../pod<uuid>/<containerid>
-        # v1 lines include subsystems; we just scan every path component.
-        for line in data.splitlines():
-            parts = line.split(":")
-            if len(parts) < 3:
-                continue
-            path = parts[-1]
-            for rx in CGRX_PATTERNS:
-                m = rx.match(path)
-                if m:
-                    groups = m.groups()
-                    # try to map
-                    if len(groups) == 1:
-                        cont = groups[0]
-                        res.setdefault("container_id", cont)
-                    elif len(groups) >= 2:
-                        pod = groups[0]
-                        cont = groups[-1]
-                        res.setdefault("pod_uid", pod)
-                        res.setdefault("container_id", cont)
-        return res
-    except Exception:
-        return res
+    except OSError:
+        return None, res
+    # v2 line: 0::/kubepods.slice/.../pod<uuid>/<containerid>
+    # v1 lines include subsystems; we just scan every path component.
+    for line in data.splitlines():
+        parts = line.split(":", 2)
+        if len(parts) < 3:
+            continue
+        if parts[0] == "0" and parts[1] == "":
+            v2_path = parts[2]
+        k8s_ids_from_path(parts[2], res)
+    return v2_path, res
+
+def k8s_enrich_from_pid(pid: int):
+    """Return dict with {'pod_uid', 'container_id'} if derivable from /proc/<pid>/cgroup."""
+    return read_proc_cgroup(pid)[1]
+
+class CgroupResolver:
+    """cgroup_id -> {'pod_uid', 'container_id'} with a bounded LRU.
+
+    The first sighting of a cgroup_id reads /proc/<pid>/cgroup (or, without a
+    usable pid, finds the cgroup v2 directory whose inode is the id); every
+    later event is a dict hit. Host/non-container cgroups are cached too.
+    Entries are swept every sweep_interval seconds: a cgroup whose v2
+    directory is gone (container exited) is dropped, and entries with no
+    known path expire after ttl seconds.
+
+    The inode -> directory index is built by a background thread (at most one
+    walk of the tree every index_interval seconds), never on the thread that
+    handles events: an id missing from the index resolves to no ids for now
+    and is resolved again once the next walk has finished.
+    """
+
+    def __init__(self, max_entries: int = 4096, sweep_interval: float = 30.0, ttl: float = 300.0,
+                 cgroup_root: str = None, index_interval: float = 5.0):
+        from collections import OrderedDict
+        self.max_entries = max(1, max_entries)
+        self.sweep_interval = sweep_interval
+        self.ttl = ttl
+        # hybrid hierarchy: the v2 tree (and cgroup ids) live under unified/
+        self.cgroup_root = cgroup_root or cgroup_v2_root()
+        self._cache = OrderedDict()   # cgroup_id -> (v2_path, ids, resolved_at)
+        self.index_interval = index_interval
+        self._inode_index = {}          # replaced whole by the indexer thread
+        self._index_gen = 0             # bumped by the indexer after each walk
+        self._applied_gen = 0
+        self._index_wanted = threading.Event()
+        self._indexer = None
+        self._asked = set()             # ids that already requested a walk
+        self._waiting = set()           # ids cached unresolved until the next walk
+        self._next_sweep = time.monotonic() + sweep_interval
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, cgroup_id: int, pid: int = 0) -> dict:
+        hit = self._cache.get(cgroup_id)
+        if hit is not None:
+            self.hits += 1
+            self._cache.move_to_end(cgroup_id)
+            return hit[1]
+
+        self.misses += 1
+        v2_path, ids = read_proc_cgroup(pid) if pid else (None, {})
+        if v2_path is None and not ids and cgroup_id:
+            v2_path = self._path_from_inode(cgroup_id)
+            if v2_path is not None:
+                k8s_ids_from_path(v2_path, ids)
+        self._cache[cgroup_id] = (v2_path, ids, time.monotonic())
+        if len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return ids
+
+    def _path_from_inode(self, cgroup_id: int):
+        path = self._inode_index.get(cgroup_id)
+        if path is None and cgroup_id not in self._asked:
+            # one walk per new id: an id the walk does not find stays unresolved until ttl
+            if len(self._asked) >= self.max_entries:
+                self._asked.clear()
+            self._asked.add(cgroup_id)
+            self._waiting.add(cgroup_id)
+            if self._indexer is None:
+                self._indexer = threading.Thread(target=self._index_loop, name="cgroup-index", daemon=True)
+                self._indexer.start()
+            self._index_wanted.set()
+        return path
+
+    def _index_loop(self):
+        root_len = len(self.cgroup_root)
+        while True:
+            self._index_wanted.wait()
+            self._index_wanted.clear()
+            index = {}
+            for dirpath, _dirs, _files in os.walk(self.cgroup_root):
+                try:
+                    index[os.stat(dirpath).st_ino] = dirpath[root_len:] or "/"
+                except OSError:
+                    continue
+            self._inode_index = index
+            self._index_gen += 1
+            time.sleep(self.index_interval)
+
+    def maybe_sweep(self):
+        if self._index_gen != self._applied_gen:
+            # a walk finished: resolve the ids that were waiting for it again
+            self._applied_gen = self._index_gen
+            for cgroup_id in self._waiting:
+                entry = self._cache.get(cgroup_id)
+                if entry is not None and entry[0] is None and not entry[1]:
+                    del self._cache[cgroup_id]
+            self._waiting.clear()
+        now = time.monotonic()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.sweep_interval
+        for cgroup_id, (v2_path, _ids, resolved_at) in list(self._cache.items()):
+            if v2_path is not None:
+                if not os.path.isdir(self.cgroup_root + v2_path):
+                    del self._cache[cgroup_id]
+            elif now - resolved_at > self.ttl:
+                del self._cache[cgroup_id]
 
 def main():
     if os.uname().sysname.lower() != "linux":
@@ -397,18 +1175,24 @@ def main():
         sys.exit(1)
 
     args = parse_args()
+    if args.mode == "aggregate" and (args.json or args.per_flow or args.replay):
+        print("Note: --json/--per-flow/--replay need per-event records; switching to --mode events",
+              file=sys.stderr)
+        args.mode = "events"
 
     # buckets
     try:
-        buckets_ms = [float(x.strip()) for x in args.buckets.split(",") if x.strip()]
+        buckets_ms = sorted(float(x.strip()) for x in (args.buckets or "").split(",") if x.strip())
     except Exception:
+        buckets_ms = []
+    if not buckets_ms:
         buckets_ms = [0.5,1,2.5,5,10,25,50,100,250,500,1000,2500]
 
     log_file = args.log_file
     try:
         if log_file and not os.path.exists(log_file):
             with open(log_file, "w") as f:
-                f.write("Ultimate Socket Latency Log\n" + "=" * 60 + "\n")
+                f.write(LOG_HEADER)
     except PermissionError:
         print(f"Warning: cannot write to {log_file}; falling back to ./socket_monitor.log", file=sys.stderr)
         log_file = "./socket_monitor.log"
@@ -423,14 +1207,14 @@ def main():
             print(f"Prometheus disabled (prometheus_client not available): {e}", file=sys.stderr)
 
     # Histograms (low-cardinality labels)
-    if have_prom:
+    if have_prom and args.mode == "events":
         # shared labels for aggregated view
         common_labels = ["role"]  # "client" or "server" (best-effort), keep small
         k8s_labels = ["pod_uid", "container_id"]
         proc_labels = ["comm"]
         agg_labels = common_labels + k8s_labels + proc_labels
 
-        # per-flow labels (dangerously high cardinality)
+        # per-flow labels: only the top-K flows get their own values (FlowTopK)
         flow_labels = agg_labels + (["src_ip","src_port","dst_ip","dst_port"] if args.per_flow else [])
 
         def make_hist(name, desc):
@@ -451,51 +1235,100 @@ def main():
         G_RTTVAR  = make_gauge("socket_rttvar_seconds", "RTT variance (mdev) from tcp_sock")
         C_RETRANS = make_ctr("socket_retransmissions_total", "Retransmits observed for this flow")
         C_EVENTS  = make_ctr("socket_events_total", "Events emitted by type and flow")
+        # field order of MetricChildren
+        PER_EVENT_METRICS = (C_EVENTS, H_CONNECT, H_REQRESP, G_SRTT, G_RTTVAR, C_RETRANS)
+
+    cflags = [f"-DFLOW_MAP_ENTRIES={max(1024, args.flow_map_entries)}"]
+    if args.mode == "aggregate":
+        cflags.append("-DAGGREGATE")
+        if args.hist_scale == "linear":
+            cflags += ["-DHIST_LINEAR", f"-DHIST_STEP_US={max(1, args.hist_step_us)}ULL",
+                       f"-DHIST_SLOTS={max(2, args.hist_slots)}ULL"]
+    else:
+        cflags.append("-DEMIT_EVENTS")
+    if args.stacks:
+        cflags += ["-DCAPTURE_STACKS", f"-DSTACK_STORAGE={max(1024, args.stack_storage)}",
+                   f"-DSTACK_MIN_NS={int(args.stacks_min_ms * 1e6)}ULL"]
+
+    symbols = None      # --stacks symbolizer; needs the live BPF object
+    if args.replay:
+        try:
+            records = replay_source(args.replay, replay_filter(args, "tgid"))
+        except (OSError, ValueError) as e:
+            print(f"Error: cannot replay {args.replay}: {e}", file=sys.stderr)
+            sys.exit(2)
+        transport = ReplayTransport(LatencyEvent, records, args.replay_rate, args.replay_loops,
+                                    report=bool(args.replay_report), tracemalloc_on=args.replay_tracemalloc,
+                                    record_size=EVENT_STRUCT.size, versioned=True)
+    else:
+        try:
+            text = apply_transport(with_task_dictionary(with_filter_config(BPF_PROGRAM), args.mode == "events"),
+                                   args.transport, args.buffer_pages)
+        except ValueError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(2)
 
-    from bcc import BPF  # lazy import for bcc
-    b = BPF(text=BPF_PROGRAM)
-
-    recent_events = deque(maxlen=8000)
+        b = load_bpf(text, cflags, "latency")
+        release_compiler(b)     # every probe here is auto-attached
+        set_filter_config_from_args(b, args)
 
-    def role_guess(src_ip, dst_ip, state):
-        # crude: if state is ESTABLISHED and src_port >= 1024, call it client; else server
-        try:
-            return "client" if state in (1, -1) else "unknown"
-        except Exception:
-            return "unknown"
-
-    def labels_for(entry):
-        base = {
-            "role": role_guess(entry["src_ip"], entry["dst_ip"], entry.get("state_code", -1)),
-            "pod_uid": entry.get("pod_uid") or "",
-            "container_id": entry.get("container_id") or "",
-            "comm": entry.get("comm") or "",
-        }
-        if args.per_flow:
-            base.update({
-                "src_ip": entry["src_ip"], "src_port": str(entry["src_port"]),
-                "dst_ip": entry["dst_ip"], "dst_port": str(entry["dst_port"]),
-            })
-        return base
-
-    def emit_prom(entry):
-        if not have_prom:
+        if have_prom:
+            from prometheus_client.core import REGISTRY
+            REGISTRY.register(MapOccupancyCollector(
+                b, FLOW_MAPS + (("stack_traces", "stack_latency") if args.stacks else ())
+                + (("task_seen",) if args.mode == "events" else ()), "socket"))
+        if args.mode == "aggregate":
+            run_aggregate(b, args, have_prom, buckets_ms)
             return
-        lbl = labels_for(entry)
-        # counters/gauges/histograms
-        C_EVENTS.labels(**lbl).inc()
-        if entry["latency"]["connect_ms"] is not None:
-            H_CONNECT.labels(**lbl).observe(entry["latency"]["connect_ms"]/1000.0)
-        if entry["latency"]["req_resp_ms"] is not None:
-            H_REQRESP.labels(**lbl).observe(entry["latency"]["req_resp_ms"]/1000.0)
-        if entry["latency"]["srtt_ms"] is not None:
-            G_SRTT.labels(**lbl).set(entry["latency"]["srtt_ms"]/1000.0)
-        if entry["latency"]["rttvar_ms"] is not None:
-            G_RTTVAR.labels(**lbl).set(entry["latency"]["rttvar_ms"]/1000.0)
-        if entry["tcp"]["retransmits"] is not None:
-            # we don't know deltas per event; just add 0 (no-op) and rely on event counts for trend,
-            # or convert to gauge; here we track increments when we see larger cumulative values.
-            pass
+        transport = EventTransport(b, args.transport, args.buffer_pages, record_size=EVENT_STRUCT.size)
+        symbols = StackSymbolizer(b) if args.stacks else None
+    timer = getattr(transport, "timer", None)   # per-stage timing, replay reports only
+
+    tasks = TaskDictionary()
+    clock = KernelClock()
+    stamps = TimestampCache()
+    # per-CPU streams merged by kernel timestamp; task records apply on arrival
+    reorder = ReorderBuffer(args.reorder_ms * 1e6, args.reorder_max)
+    out = []            # stdout lines of the current batch
+    rejected = 0        # records of an unknown version/kind
+    recent_events = DedupWindow(args.dedup_window, args.dedup_ttl)
+    resolver = CgroupResolver(args.cgroup_cache_size, args.cgroup_sweep)
+    topk = FlowTopK(args.per_flow_top, args.per_flow_capacity, args.per_flow_refresh) \
+        if have_prom and args.per_flow else None
+
+    def role_guess(state):
+        # crude: ESTABLISHED and req/resp samples come from the side that initiated; the rest is unknown
+        return "client" if state in (1, -1) else "unknown"
+
+    children = {}       # label values -> MetricChildren
+
+    def metric_children(state_code, k8s, comm, src_ip_u32, src_port, dst_ip_u32, dst_port, weight_ns):
+        values = (role_guess(state_code), k8s.get("pod_uid") or "", k8s.get("container_id") or "", comm)
+        if args.per_flow:
+            flow = (format_ip(src_ip_u32), str(src_port), format_ip(dst_ip_u32), str(dst_port))
+            if topk is not None:
+                weight = weight_ns / 1e6 if args.per_flow_rank == "latency" else 1.0
+                exported = topk.offer(flow, weight) if weight else flow in topk.exported
+                if not exported:
+                    flow = OTHER_FLOW
+            values += flow
+            if flow is not OTHER_FLOW and topk is not None:
+                topk.children.setdefault(flow, set()).add(values)
+        bound = children.get(values)
+        if bound is None:
+            bound = children[values] = MetricChildren(PER_EVENT_METRICS, values)
+        return bound
+
+    def prune_flows():
+        # drop label children of flows that fell out of the top-K
+        for flow in topk.refresh():
+            for values in topk.children.pop(flow, ()):
+                children.pop(values, None)
+                for metric in PER_EVENT_METRICS:
+                    try:
+                        metric.remove(*values)
+                    except KeyError:
+                        pass
 
     # start exporter
     if have_prom and args.prometheus_port:
@@ -503,115 +1336,240 @@ def main():
         start_http_server(args.prometheus_port)
         print(f"[prometheus] exporting on :{args.prometheus_port}")
 
-    # aux
-    def write_log(s: str):
-        try:
-            with open(log_file, "a") as f:
-                f.write(s + "\n")
-        except Exception as e:
-            print(f"Log write failed: {e}", file=sys.stderr)
+    # aux: file I/O happens on the writer thread, never in the buffer callback
+    log_sink = log_writer_from_args(log_file, LOG_HEADER, args) if log_file else None
+    capture = CaptureWriter(args.capture, LATENCY_SCHEMA, source="sample-latency-monitor") if args.capture else None
+    if log_sink and have_prom:
+        from prometheus_client.core import REGISTRY
+        REGISTRY.register(LogWriterCollector(log_sink, "socket"))
 
     # retransmit delta tracker (so we can increment the counter)
-    last_retx = {}
-
-    def handle_event(cpu, data, size):
-        event = b["events"].event(data)
-        timestamp = datetime.now().strftime("%b %d %Y %H:%M:%S.%f")[:-3]
-
-        src_ip = format_ip(event.src_ip)
-        dst_ip = format_ip(event.dst_ip)
-
-        if args.pid and event.tgid != args.pid: return
-        if args.src_ip and src_ip != args.src_ip: return
-        if args.dst_ip and dst_ip != args.dst_ip: return
-        if args.src_port and event.src_port != args.src_port: return
-        if args.dst_port and event.dst_port != args.dst_port: return
-        if args.active_only and event.state not in (1, -1): return
-
-        # de-dup spam
-        event_key = (
-            src_ip, int(event.src_port), dst_ip, int(event.dst_port),
-            int(event.tgid), int(event.state), event.event.decode(errors="ignore"),
-            int(event.connect_latency_ns != 0), int(event.rr_latency_ns != 0),
-            int(event.srtt_us), int(event.rttvar_us)
-        )
-        if event_key in recent_events:
-            return
-        recent_events.append(event_key)
-
-        # k8s enrichment
-        k8s = k8s_enrich_from_pid(int(event.tgid))
-        pod_uid = k8s.get("pod_uid")
-        container_id = k8s.get("container_id")
+    last_retx = RetransDeltas(args.flow_idle_ttl)
 
-        state_code = int(event.state)
-        state_str = TCP_STATES.get(state_code, "N/A") if state_code != -1 else "N/A"
+    # which sinks need what: the entry dict (timestamp, JSON) only for stdout/log,
+    # k8s enrichment for the entry or Prometheus labels
+    want_entry = not args.quiet or log_sink is not None
+    want_enrich = want_entry or have_prom
 
+    def make_entry(kind, state_code, tid, tgid, src_ip_u32, dst_ip_u32, src_port, dst_port,
+                   connect_ns, rr_ns, srtt_us, rttvar_us, retransmits, stack_id, task, k8s, wall_ns):
+        _, ppid, uid, cgroup_id, comm = task
         entry = {
-            "timestamp": timestamp,
-            "event": event.event.decode(errors="ignore"),
-            "src_ip": src_ip,
-            "dst_ip": dst_ip,
-            "src_port": int(event.src_port),
-            "dst_port": int(event.dst_port),
+            "timestamp": stamps.text(wall_ns),
+            "ts_ns": wall_ns,
+            "event": EVENT_NAMES[kind],
+            "src_ip": format_ip(src_ip_u32),
+            "dst_ip": format_ip(dst_ip_u32),
+            "src_port": src_port,
+            "dst_port": dst_port,
             "protocol": "TCP",
-            "state": state_str,
+            "state": TCP_STATES.get(state_code, "N/A") if state_code != -1 else "N/A",
             "state_code": state_code,
-            "pid": int(event.tgid),
-            "tid": int(event.pid),
-            "ppid": int(event.ppid),
-            "uid": int(event.uid),
-            "cgroup_id": int(event.cgroup_id),
-            "comm": event.comm.decode(errors="ignore"),
-            "pod_uid": pod_uid,
-            "container_id": container_id,
+            "pid": tgid,
+            "tid": tid,
+            "ppid": ppid,
+            "uid": uid,
+            "cgroup_id": cgroup_id,
+            "comm": comm,
+            "pod_uid": k8s.get("pod_uid"),
+            "container_id": k8s.get("container_id"),
             "latency": {
-                "connect_ms": ns_to_ms(int(event.connect_latency_ns)) if event.connect_latency_ns else None,
-                "req_resp_ms": ns_to_ms(int(event.rr_latency_ns)) if event.rr_latency_ns else None,
-                "srtt_ms": round(float(event.srtt_us) / 1000.0, 6) if event.srtt_us else None,
-                "rttvar_ms": round(float(event.rttvar_us) / 1000.0, 6) if event.rttvar_us else None,
+                "connect_ms": ns_to_ms(connect_ns) if connect_ns else None,
+                "req_resp_ms": ns_to_ms(rr_ns) if rr_ns else None,
+                "srtt_ms": round(srtt_us / 1000.0, 6) if srtt_us else None,
+                "rttvar_ms": round(rttvar_us / 1000.0, 6) if rttvar_us else None,
             },
             "tcp": {
-                "retransmits": int(event.retransmits) if event.retransmits else 0,
+                "retransmits": retransmits,
             },
         }
+        if symbols and stack_id >= 0:
+            # the stack belongs to the connect()/send() caller
+            entry["stack"] = symbols.frames(tgid, stack_id)
+        return entry
+
+    def handle_event(rec):
+        (_version, kind, state_code, _pad, tid, ts_ns, tgid, src_ip_u32, dst_ip_u32, src_port, dst_port,
+         latency_ns, srtt_us, rttvar_us, retransmits, stack_id) = rec
+        wall_ns = ts_ns + clock.offset_ns
+        connect_ns = latency_ns if kind == REC_STATE else 0
+        rr_ns = latency_ns if kind == REC_REQRESP else 0
+        if timer: timer.mark("prepare")
+
+        # --pid/--src-ip/--dst-ip/--src-port/--dst-port/--active-only run in-kernel (filter_cfg)
+
+        if capture:
+            _, ppid, uid, cgroup_id, comm = tasks.get(tid, tgid)
+            capture.append((
+                wall_ns, tgid, tid, ppid, uid, cgroup_id,
+                src_ip_u32, dst_ip_u32, src_port, dst_port, state_code,
+                connect_ns, rr_ns, srtt_us, rttvar_us, retransmits, comm.encode(),
+            ))
+            if timer: timer.mark("capture")
 
-        # Increment retrans counter by delta (per flow)
-        if have_prom:
-            flow_delta_key = (entry["src_ip"], entry["src_port"], entry["dst_ip"], entry["dst_port"])
-            prev = last_retx.get(flow_delta_key, 0)
-            cur = entry["tcp"]["retransmits"]
-            if cur > prev:
-                # increment counter by delta
-                from prometheus_client import Counter
-                # build labels and inc
-                lbl = labels_for(entry)
-                # define/use a separate bare counter for deltas to avoid double registration
-                # Reuse C_RETRANS with .inc(delta) since it's already Counter; safe as long as labels are identical.
-                C_RETRANS.labels(**lbl).inc(cur - prev)
-                last_retx[flow_delta_key] = cur
-
-        # output
-        if args.json:
-            print(json.dumps(entry, separators=(",", ":")))
-        else:
-            print(entry)
-        if log_file:
-            write_log(json.dumps(entry))
-
-        # prometheus hist/gauges
-        emit_prom(entry)
+        # de-dup spam
+        duplicate = recent_events.seen((
+            src_ip_u32, src_port, dst_ip_u32, dst_port, tgid, state_code, kind, latency_ns != 0,
+            srtt_us, rttvar_us,
+        ))
+        if timer: timer.mark("dedup")
+        if duplicate:
+            return
 
-    b["events"].open_perf_buffer(handle_event)
+        task = tasks.get(tid, tgid)
+        # k8s enrichment
+        if want_enrich:
+            k8s = resolver.resolve(task[3], tgid)
+            resolver.maybe_sweep()
+        if timer: timer.mark("enrich")
+
+        if want_entry:
+            entry = make_entry(kind, state_code, tid, tgid, src_ip_u32, dst_ip_u32, src_port, dst_port,
+                               connect_ns, rr_ns, srtt_us, rttvar_us, retransmits, stack_id, task, k8s,
+                               wall_ns)
+            if timer: timer.mark("format")
+
+            # output: serialize once for stdout and the log; stdout is written per batch
+            if args.json or log_sink:
+                line = JSON.encode(entry)
+                if args.json and not args.quiet:
+                    out.append(line)
+                if log_sink:
+                    log_sink.write(line)
+            if not args.json and not args.quiet:
+                out.append(repr(entry))
+            if timer: timer.mark("output")
 
-    print("Monitoring sockets + latency. Ctrl-C to stop.")
+        if have_prom:
+            bound = metric_children(state_code, k8s, task[4], src_ip_u32, src_port, dst_ip_u32, dst_port,
+                                    rr_ns or connect_ns)
+            # Increment retrans counter by delta (per flow)
+            delta = last_retx.delta((src_ip_u32, src_port, dst_ip_u32, dst_port), retransmits,
+                                    closed=state_code == TCP_CLOSE)
+            if delta:
+                bound.retrans.inc(delta)
+            bound.events.inc()
+            if connect_ns:
+                bound.connect.observe(connect_ns / 1e9)
+            if rr_ns:
+                bound.reqresp.observe(rr_ns / 1e9)
+            if srtt_us:
+                bound.srtt.set(srtt_us / 1e6)
+            if rttvar_us:
+                bound.rttvar.set(rttvar_us / 1e6)
+            if timer: timer.mark("prometheus")
+
+    def handle_batch(view):
+        nonlocal rejected
+        # one memoryview per batch, every record EVENT_STRUCT.size bytes; REC_TASK
+        # records share the stride and are re-read with TASK_STRUCT
+        for i, rec in enumerate(EVENT_STRUCT.iter_unpack(view)):
+            if timer: timer.start()
+            if rec[0] != RECORD_VERSION:
+                rejected += 1
+                continue
+            kind = rec[1]
+            if kind == REC_TASK:
+                _, _, _, tid, cgroup_id, tgid, ppid, uid, comm = TASK_STRUCT.unpack_from(view, i * EVENT_STRUCT.size)
+                tasks.add(tid, tgid, ppid, uid, cgroup_id, comm)
+                continue
+            if kind not in EVENT_NAMES:
+                rejected += 1
+                continue
+            reorder.push(rec[5], rec)
+            if timer: timer.mark("decode")
+
+    def release(records):
+        for rec in records:
+            if timer: timer.start()
+            handle_event(rec)
+        if out:
+            out.append("")
+            sys.stdout.write("\n".join(out))
+            out.clear()
+
+    transport.open(handle_batch)
+    if have_prom:
+        from prometheus_client.core import REGISTRY
+        REGISTRY.register(LostEventsCollector(
+            transport, "socket_events_lost", "Samples dropped by the kernel before user space read them"))
+        REGISTRY.register(FuncCounterCollector(
+            "socket_events_deduplicated", "Events suppressed as repeats within the dedup window",
+            lambda: recent_events.suppressed))
+        if topk is not None:
+            REGISTRY.register(FuncCounterCollector(
+                "socket_flow_evictions", "Flows evicted from the per-flow top-K sketch",
+                lambda: topk.evictions))
+            Gauge("socket_flows_exported", "Flows currently exported with their own labels") \
+                .set_function(lambda: len(topk.exported))
+        Gauge("socket_flow_state_entries", "Flows with retransmit state held in user space") \
+            .set_function(lambda: len(last_retx))
+
+    print(f"Monitoring sockets + latency ({args.transport} transport). Ctrl-C to stop.")
     if log_file:
         print(f"Logging to {log_file}")
 
+    next_stacks = time.monotonic() + args.interval
+    try:
+        while not transport.done:
+            transport.poll()
+            # replays carry their own timestamps: only the event-time watermark applies
+            release(reorder.pop_ready(None if args.replay else time.monotonic_ns()))
+            clock.maybe_recalibrate()
+            if topk is not None:
+                prune_flows()
+            last_retx.maybe_sweep()
+            if symbols and args.stacks_out and time.monotonic() >= next_stacks:
+                dump_stacks(b, symbols, args)
+                next_stacks = time.monotonic() + args.interval
+    except KeyboardInterrupt:
+        pass
+    release(reorder.drain())
+    if symbols:
+        dump_stacks(b, symbols, args, final=True)
+    dropped = 0
+    if capture:
+        capture.close()
+        print(f"Capture: {capture.rows} events in {args.capture}")
+    if log_sink:
+        log_sink.close()
+        dropped = log_sink.dropped
+    if args.replay_report:
+        transport.write_report(args.replay_report, args.replay, duplicates=recent_events.suppressed,
+                               log_lines_dropped=dropped, cgroup_cache_misses=resolver.misses)
+        print(f"Replay report: {args.replay_report}")
+    if reorder.late or reorder.forced:
+        print(f"{reorder.late} events arrived after --reorder-ms, "
+              f"{reorder.forced} released early (--reorder-max)", file=sys.stderr)
+    if rejected or tasks.misses:
+        print(f"{rejected} records of an unknown version/kind skipped, "
+              f"{tasks.misses} tasks looked up in /proc", file=sys.stderr)
+    print(f"\nStopping monitoring... {transport.lost()} events lost, {recent_events.suppressed} duplicates "
+          f"suppressed, {dropped} log lines dropped. Bye!")
+
+def run_aggregate(b, args, have_prom, buckets_ms):
+    if have_prom:
+        from prometheus_client import start_http_server
+        from prometheus_client.core import REGISTRY
+        resolver = CgroupResolver(args.cgroup_cache_size, args.cgroup_sweep)
+        bounds = [ms / 1000.0 for ms in buckets_ms] if args.buckets else None
+        REGISTRY.register(HistogramCollector(b, resolver, args.hist_scale, args.hist_step_us, args.hist_slots, bounds))
+        start_http_server(args.prometheus_port)
+        print(f"[prometheus] exporting on :{args.prometheus_port}")
+
+    symbols = StackSymbolizer(b) if args.stacks else None
+    print("Aggregating socket latency in-kernel. Ctrl-C to stop.")
     try:
         while True:
-            b.perf_buffer_poll()
+            time.sleep(args.interval)
+            if not have_prom:
+                print_hist_summary(b, args.hist_scale, args.hist_step_us, args.hist_slots)
+            if symbols and args.stacks_out:
+                dump_stacks(b, symbols, args)
     except KeyboardInterrupt:
+        print_hist_summary(b, args.hist_scale, args.hist_step_us, args.hist_slots)
+        if symbols:
+            dump_stacks(b, symbols, args, final=True)
         print("\nStopping monitoring... Bye!")
 
 if __name__ == "__main__":
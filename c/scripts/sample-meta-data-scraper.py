@@ -7,8 +7,19 @@ Usage:
   ./meta-scrape.py                     # summary (Markdown)
   ./meta-scrape.py --format json       # summary (JSON)
   ./meta-scrape.py --full > full.json  # full dump (JSON)
+  ./meta-scrape.py --full --crawl      # walk the whole meta-data tree in parallel
+  ./meta-scrape.py --workers 16        # concurrent IMDS requests (default 8)
+  ./meta-scrape.py --no-cache          # always go to IMDS (skip the local cache)
   ./meta-scrap.py -v                  # verbose
 
+Caching:
+  Summary/full fields and the IMDSv2 token are cached under --cache-dir
+  (default ~/.cache/meta-scrape, mode 0600) keyed by instance id + boot id,
+  so repeated runs from sidecars/cron are served locally. Static fields live
+  for the whole boot; addresses and the IAM role name expire sooner (FIELD_TTLS).
+  The token is requested for --token-ttl seconds (default 5 minutes) and reused
+  only within that lifetime. Credentials and --crawl results are never cached.
+
 Exit codes:
   0 = success
   2 = metadata unreachable / not on EC2
@@ -24,7 +35,11 @@ from __future__ import annotations
 import argparse
 import json
 import logging
+import os
 import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, asdict, field
 from typing import Any, Dict, Optional, Tuple, List
 
@@ -43,6 +58,30 @@ LINK_LOCAL = "http://169.254.169.254"
 AWS_ROOT = f"{LINK_LOCAL}/latest"
 DEFAULT_CONNECT_TIMEOUT = 0.5
 DEFAULT_READ_TIMEOUT = 1.5
+DEFAULT_WORKERS = 8
+CRAWL_MAX_DEPTH = 12
+CRAWL_MAX_REQUESTS = 2000
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "meta-scrape")
+# the cached token reaches IMDS (IAM credentials included) for its whole
+# lifetime, so keep it short; longer lifetimes are an explicit --token-ttl
+DEFAULT_TOKEN_TTL = 300
+MAX_TOKEN_TTL = 21600              # IMDSv2 maximum
+TOKEN_TTL_HEADER = "X-aws-ec2-metadata-token-ttl-seconds"
+TOKEN_EXPIRY_MARGIN = 30           # renew this many seconds before the token expires
+BOOT = float("inf")                # valid until the instance reboots (new cache key)
+FIELD_TTLS = {
+    "/meta-data/instance-id": BOOT,
+    "/meta-data/instance-type": BOOT,
+    "/meta-data/placement/availability-zone": BOOT,
+    "/dynamic/instance-identity/document": BOOT,
+    "/meta-data/hostname": 3600,
+    "/meta-data/local-ipv4": 3600,
+    "/meta-data/public-ipv4": 300,   # EIP association can change it
+    "/meta-data/iam/security-credentials/": 300,
+}
+DEFAULT_FIELD_TTL = 300
 
 SENSITIVE_KEY_FRAGMENTS = [
     "accesskey", "secret", "token", "password", "privatekey",
@@ -50,9 +89,14 @@ SENSITIVE_KEY_FRAGMENTS = [
 ]
 
 class HTTPClient:
-    """requests.Session with retries, timeouts, and minimal logging."""
+    """requests.Session with retries, timeouts, and minimal logging.
+
+    The connection pool is sized for pool_size concurrent requests so the
+    fetch workers reuse keep-alive connections instead of opening new ones.
+    """
 
-    def __init__(self, timeout: Tuple[float, float], verbose: bool = False) -> None:
+    def __init__(self, timeout: Tuple[float, float], verbose: bool = False,
+                 pool_size: int = DEFAULT_WORKERS) -> None:
         self.timeout = timeout
         self.verbose = verbose
         self.session = requests.Session()
@@ -76,7 +120,7 @@ class HTTPClient:
                 method_whitelist=retry_methods,
                 raise_on_status=False,
             )
-        adapter = HTTPAdapter(max_retries=retries)
+        adapter = HTTPAdapter(max_retries=retries, pool_connections=1, pool_maxsize=max(1, pool_size))
         self.session.mount("http://", adapter)
         self.session.mount("https://", adapter)
 
@@ -148,15 +192,167 @@ def _redact(obj: Any) -> Any:
     else:
         return obj
 
+def _json_text(text: Optional[str]) -> Optional[Dict[str, Any]]:
+    if not text:
+        return None
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+def _read_first(paths: List[str]) -> Optional[str]:
+    for path in paths:
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value:
+            return value
+    return None
+
+def local_instance_key() -> Optional[str]:
+    """Identify this instance + boot without IMDS (DMI asset tag / Xen uuid, boot_id)."""
+    boot_id = _read_first(["/proc/sys/kernel/random/boot_id"])
+    if not boot_id:
+        return None
+    instance = _read_first([
+        "/sys/devices/virtual/dmi/id/board_asset_tag",   # Nitro: i-0123...
+        "/sys/hypervisor/uuid",                          # Xen: ec2...
+    ]) or "unknown"
+    return "".join(c for c in f"{instance}-{boot_id}" if c.isalnum() or c in "-_")
+
+class MetadataCache:
+    """JSON file cache of IMDS fields and the IMDSv2 token for one instance boot.
+
+    Entries are (fetched_at, value); a value of None records a 404 so absent
+    fields (e.g. public-ipv4 on private instances) are not re-requested.
+    Writes go through a 0600 temp file + os.replace, so concurrent runs never
+    see a torn file; the last writer wins.
+    """
+
+    VERSION = 1
+
+    def __init__(self, cache_dir: str, key: str) -> None:
+        self.dir = cache_dir
+        self.key = key
+        self.path = os.path.join(cache_dir, f"imds-{key}.json")
+        self.fields: Dict[str, List[Any]] = {}
+        self.token_entry: Optional[List[Any]] = None
+        self.dirty = False
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION and data.get("key") == key:
+                self.fields = data.get("fields") or {}
+                self.token_entry = data.get("token")
+        except (OSError, ValueError):
+            pass
+
+    @classmethod
+    def open(cls, cache_dir: str) -> Optional["MetadataCache"]:
+        key = local_instance_key()
+        if key is None:
+            logging.debug("cache disabled: no boot_id")
+            return None
+        return cls(cache_dir, key)
+
+    @staticmethod
+    def _fresh(fetched_at: float, ttl: float, now: float) -> bool:
+        return fetched_at <= now and now - fetched_at < ttl
+
+    def get_many(self, paths: List[str]) -> Dict[str, Optional[str]]:
+        """Fresh cached values for paths (missing/expired paths are omitted)."""
+        now, out = time.time(), {}
+        for path in paths:
+            entry = self.fields.get(path)
+            if entry and self._fresh(entry[0], FIELD_TTLS.get(path, DEFAULT_FIELD_TTL), now):
+                out[path] = entry[1]
+        return out
+
+    def put_many(self, values: Dict[str, Optional[str]]) -> None:
+        now = time.time()
+        for path, value in values.items():
+            self.fields[path] = [now, value]
+        self.dirty = self.dirty or bool(values)
+
+    def token(self) -> Optional[str]:
+        if self.token_entry and time.time() < self.token_entry[0]:
+            return self.token_entry[1]
+        return None
+
+    def put_token(self, token: str, ttl: int) -> None:
+        self.token_entry = [time.time() + max(0, ttl - TOKEN_EXPIRY_MARGIN), token]
+        self.dirty = True
+
+    def drop_token(self) -> None:
+        if self.token_entry is not None:
+            self.token_entry = None
+            self.dirty = True
+
+    def save(self) -> None:
+        if not self.dirty:
+            return
+        try:
+            os.makedirs(self.dir, mode=0o700, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(prefix=".imds-", dir=self.dir)
+            try:
+                os.fchmod(fd, 0o600)
+                with os.fdopen(fd, "w") as f:
+                    json.dump({"version": self.VERSION, "key": self.key,
+                               "fields": self.fields, "token": self.token_entry}, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+            self.dirty = False
+            self._prune()
+        except OSError as e:
+            logging.debug("cache write failed for %s: %s", self.path, e)
+
+    def _prune(self) -> None:
+        """Drop cache files from previous boots/instances."""
+        for name in os.listdir(self.dir):
+            if name.startswith("imds-") and name.endswith(".json") and \
+                    os.path.join(self.dir, name) != self.path:
+                try:
+                    os.unlink(os.path.join(self.dir, name))
+                except OSError:
+                    pass
+
 class AWSMetadata:
     ROOT = AWS_ROOT
-    HDR_TOKEN_TTL = {"X-aws-ec2-metadata-token-ttl-seconds": "60"}
+
+    SUMMARY_PATHS = [
+        "/meta-data/instance-id",
+        "/meta-data/instance-type",
+        "/meta-data/hostname",
+        "/meta-data/local-ipv4",
+        "/meta-data/public-ipv4",
+        "/meta-data/placement/availability-zone",
+        "/meta-data/iam/security-credentials/",
+        "/dynamic/instance-identity/document",
+    ]
 
     @staticmethod
-    def _token(client: HTTPClient) -> Optional[str]:
-        r = client.put(f"{AWSMetadata.ROOT}/api/token", headers=AWSMetadata.HDR_TOKEN_TTL)
+    def _token(client: HTTPClient, ttl: int = DEFAULT_TOKEN_TTL,
+               cache: Optional[MetadataCache] = None) -> Optional[str]:
+        if cache is not None:
+            token = cache.token()
+            if token:
+                return token
+        r = client.put(f"{AWSMetadata.ROOT}/api/token", headers={TOKEN_TTL_HEADER: str(ttl)})
         if r and r.status_code == 200:
-            return r.text.strip()
+            token = r.text.strip()
+            if cache is not None:
+                try:
+                    granted = int(r.headers.get(TOKEN_TTL_HEADER, ttl))
+                except ValueError:
+                    granted = ttl
+                cache.put_token(token, min(ttl, granted))
+            return token
         return None
 
     @staticmethod
@@ -164,19 +360,47 @@ class AWSMetadata:
         return {"X-aws-ec2-metadata-token": token} if token else {}
 
     @staticmethod
-    def reachable(client: HTTPClient) -> bool:
-        token = AWSMetadata._token(client)
-        hdr = AWSMetadata._hdr(token)
-        r = client.get(f"{AWSMetadata.ROOT}/meta-data/", headers=hdr)
+    def fetch_many(client: HTTPClient, paths: List[str], hdr: Dict[str, str],
+                   workers: int = DEFAULT_WORKERS) -> Dict[str, Optional[Response]]:
+        """GET every path concurrently over the client's pooled session."""
+        if not paths:
+            return {}
+        if workers <= 1 or len(paths) == 1:
+            return {p: client.get(f"{AWSMetadata.ROOT}{p}", headers=hdr) for p in paths}
+        with ThreadPoolExecutor(max_workers=min(workers, len(paths))) as pool:
+            resps = pool.map(lambda p: client.get(f"{AWSMetadata.ROOT}{p}", headers=hdr), paths)
+            return dict(zip(paths, resps))
+
+    @staticmethod
+    def fetch_texts(client: HTTPClient, paths: List[str], token: Optional[str],
+                    workers: int = DEFAULT_WORKERS,
+                    cache: Optional[MetadataCache] = None) -> Tuple[Dict[str, Optional[str]], bool]:
+        """Text for each path, served from cache where fresh; returns (texts, went_to_imds)."""
+        out = cache.get_many(paths) if cache is not None else {}
+        missing = [p for p in paths if p not in out]
+        if not missing:
+            return out, False
+        resps = AWSMetadata.fetch_many(client, missing, AWSMetadata._hdr(token), workers)
+        for path, resp in resps.items():
+            out[path] = _safe_text(resp)
+        if cache is not None:
+            # cache answers (200/404), not transport errors or throttling
+            cache.put_many({p: out[p] for p, resp in resps.items()
+                            if resp is not None and resp.status_code in (200, 404)})
+        return out, True
+
+    @staticmethod
+    def reachable(client: HTTPClient, token: Optional[str] = None) -> bool:
+        r = client.get(f"{AWSMetadata.ROOT}/meta-data/", headers=AWSMetadata._hdr(token))
         return bool(r and r.status_code == 200)
 
     @staticmethod
-    def summary(client: HTTPClient) -> Summary:
-        token = AWSMetadata._token(client)
-        hdr = AWSMetadata._hdr(token)
+    def summary(client: HTTPClient, token: Optional[str] = None,
+                workers: int = DEFAULT_WORKERS, cache: Optional[MetadataCache] = None) -> Summary:
+        r, fetched = AWSMetadata.fetch_texts(client, AWSMetadata.SUMMARY_PATHS, token, workers, cache)
 
         def get(path: str) -> Optional[str]:
-            return _safe_text(client.get(f"{AWSMetadata.ROOT}{path}", headers=hdr))
+            return r.get(path)
 
         s = Summary()
         s.instance_id = get("/meta-data/instance-id")
@@ -185,48 +409,106 @@ class AWSMetadata:
         s.private_ip = get("/meta-data/local-ipv4")
         s.public_ip = get("/meta-data/public-ipv4")
 
-        ident = _json(client.get(f"{AWSMetadata.ROOT}/dynamic/instance-identity/document", headers=hdr)) or {}
+        ident = _json_text(r.get("/dynamic/instance-identity/document")) or {}
         s.region = ident.get("region")
         s.account_id = ident.get("accountId")
 
         s.zone = get("/meta-data/placement/availability-zone")
 
-        role_name = _safe_text(client.get(f"{AWSMetadata.ROOT}/meta-data/iam/security-credentials/", headers=hdr))
+        role_name = get("/meta-data/iam/security-credentials/")
         if role_name:
             s.service_identity = role_name.splitlines()[0].strip()
             s.notes.append("IAM role detected (credentials redacted).")
 
-        if token is None:
+        if token is None and fetched:
             s.notes.append("IMDSv2 token unavailable; IMDSv1 used (less secure).")
 
         return s
 
     @staticmethod
-    def full(client: HTTPClient, redact: bool = True) -> Dict[str, Any]:
-        token = AWSMetadata._token(client)
+    def crawl(client: HTTPClient, hdr: Dict[str, str], roots: Tuple[str, ...] = ("/meta-data/",),
+              workers: int = DEFAULT_WORKERS) -> Dict[str, Dict[str, Any]]:
+        """Walk the metadata trees under roots breadth-first, fetching each level in parallel.
+
+        All roots share each level's fetch, so at most `workers` requests are
+        in flight (the session's pool size). Directory listings end in '/',
+        leaves are fetched as text (JSON leaves such as credentials are parsed
+        so redaction can see their keys). Returns {root: tree}.
+        """
+        trees: Dict[str, Dict[str, Any]] = {root: {} for root in roots}
+        nodes: Dict[str, Dict[str, Any]] = dict(trees)
+        budget = CRAWL_MAX_REQUESTS * len(roots)
+        pending, requests_made = list(roots), 0
+        for _depth in range(CRAWL_MAX_DEPTH):
+            if not pending or requests_made >= budget:
+                break
+            batch = pending[:budget - requests_made]
+            requests_made += len(batch)
+            pending = pending[len(batch):]
+            for path, resp in AWSMetadata.fetch_many(client, batch, hdr, workers).items():
+                text = _safe_text(resp)
+                if path.endswith("/"):
+                    node = nodes[path]
+                    for entry in (text or "").splitlines():
+                        entry = entry.strip()
+                        if not entry:
+                            continue
+                        if "=" in entry and not entry.endswith("/"):
+                            entry = entry.split("=", 1)[0] + "/"   # public-keys/0=name
+                        child = path + entry
+                        if entry.endswith("/"):
+                            node[entry.rstrip("/")] = nodes[child] = {}
+                        else:
+                            node[entry] = None
+                        pending.append(child)
+                else:
+                    parent, _, leaf = path.rpartition("/")
+                    value: Any = text
+                    if text and text.startswith("{"):
+                        value = _json(resp) or text
+                    nodes[parent + "/"][leaf] = value
+        for path in pending:
+            for root, tree in trees.items():
+                if path.startswith(root):
+                    tree["_truncated"] = True
+        return trees
+
+    @staticmethod
+    def full(client: HTTPClient, token: Optional[str] = None, redact: bool = True,
+             workers: int = DEFAULT_WORKERS, crawl: bool = False,
+             cache: Optional[MetadataCache] = None) -> Dict[str, Any]:
         hdr = AWSMetadata._hdr(token)
         data: Dict[str, Any] = {"notes": []}
-
-        data["meta-data"] = {
-            "instance-id": _safe_text(client.get(f"{AWSMetadata.ROOT}/meta-data/instance-id", headers=hdr)),
-            "instance-type": _safe_text(client.get(f"{AWSMetadata.ROOT}/meta-data/instance-type", headers=hdr)),
-            "hostname": _safe_text(client.get(f"{AWSMetadata.ROOT}/meta-data/hostname", headers=hdr)),
-            "local-ipv4": _safe_text(client.get(f"{AWSMetadata.ROOT}/meta-data/local-ipv4", headers=hdr)),
-            "public-ipv4": _safe_text(client.get(f"{AWSMetadata.ROOT}/meta-data/public-ipv4", headers=hdr)),
-            "placement": {
-                "availability-zone": _safe_text(client.get(f"{AWSMetadata.ROOT}/meta-data/placement/availability-zone", headers=hdr)),
-            },
-        }
-
-        ident = _json(client.get(f"{AWSMetadata.ROOT}/dynamic/instance-identity/document", headers=hdr)) or {}
-        data["dynamic"] = {"instance-identity": {"document": ident}}
-
-        role_name = _safe_text(client.get(f"{AWSMetadata.ROOT}/meta-data/iam/security-credentials/", headers=hdr))
-        if role_name:
-            role_name = role_name.splitlines()[0].strip()
-            data["meta-data"]["iam"] = {"role": role_name, "credentials": "present (redacted)"}
-
-        if token is None:
+        fetched = True
+
+        if crawl:
+            # one walk over both trees: two concurrent walks would each run
+            # `workers` requests against a pool sized for `workers`
+            trees = AWSMetadata.crawl(client, hdr, ("/meta-data/", "/dynamic/"), workers)
+            data["meta-data"] = trees["/meta-data/"]
+            data["dynamic"] = trees["/dynamic/"]
+        else:
+            r, fetched = AWSMetadata.fetch_texts(client, AWSMetadata.SUMMARY_PATHS, token, workers, cache)
+            data["meta-data"] = {
+                "instance-id": r["/meta-data/instance-id"],
+                "instance-type": r["/meta-data/instance-type"],
+                "hostname": r["/meta-data/hostname"],
+                "local-ipv4": r["/meta-data/local-ipv4"],
+                "public-ipv4": r["/meta-data/public-ipv4"],
+                "placement": {
+                    "availability-zone": r["/meta-data/placement/availability-zone"],
+                },
+            }
+
+            ident = _json_text(r["/dynamic/instance-identity/document"]) or {}
+            data["dynamic"] = {"instance-identity": {"document": ident}}
+
+            role_name = r["/meta-data/iam/security-credentials/"]
+            if role_name:
+                role_name = role_name.splitlines()[0].strip()
+                data["meta-data"]["iam"] = {"role": role_name, "credentials": "present (redacted)"}
+
+        if token is None and fetched:
             data["notes"].append("IMDSv2 token unavailable; IMDSv1 used (less secure).")
 
         return _redact(data) if redact else data
@@ -261,6 +543,17 @@ def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
                    help="Per-request read timeout (seconds). Connect timeout defaults to 0.5s.")
     p.add_argument("--connect-timeout", type=float, default=None,
                    help="Override connect timeout (seconds).")
+    p.add_argument("--crawl", action="store_true",
+                   help="With --full: walk the entire meta-data/dynamic tree in parallel")
+    p.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                   help="Concurrent IMDS requests (default: %(default)s)")
+    p.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                   help="Metadata/token cache directory (default: %(default)s)")
+    p.add_argument("--no-cache", action="store_true",
+                   help="Do not read or write the local metadata cache")
+    p.add_argument("--token-ttl", type=int, default=DEFAULT_TOKEN_TTL,
+                   help="Requested IMDSv2 token lifetime in seconds, 1-21600; the token is cached "
+                        "on disk for this long (default: %(default)s)")
     p.add_argument("--no-redact", action="store_true",
                    help="Do not redact sensitive fields in full dumps")
     p.add_argument("--verbose", "-v", action="store_true", help="Verbose logging to stderr")
@@ -276,15 +569,33 @@ def main(argv: Optional[List[str]] = None) -> int:
 
     connect_timeout = args.connect_timeout if args.connect_timeout is not None else DEFAULT_CONNECT_TIMEOUT
     read_timeout = args.timeout if args.timeout is not None else DEFAULT_READ_TIMEOUT
-    client = HTTPClient(timeout=(connect_timeout, read_timeout), verbose=args.verbose)
+    client = HTTPClient(timeout=(connect_timeout, read_timeout), verbose=args.verbose,
+                        pool_size=args.workers)
+
+    cache = None if args.no_cache else MetadataCache.open(args.cache_dir)
+    token_ttl = min(max(args.token_ttl, 1), MAX_TOKEN_TTL)
 
     try:
-        if not AWSMetadata.reachable(client):
-            sys.stderr.write("ERROR: AWS EC2 metadata service not reachable. Are you on EC2?\n")
-            return 2
+        token = None
+        cached = cache is not None and not args.crawl and \
+            len(cache.get_many(AWSMetadata.SUMMARY_PATHS)) == len(AWSMetadata.SUMMARY_PATHS)
+        if not cached:
+            # one IMDSv2 token for the whole run (reused across runs via the cache)
+            cached_token = cache.token() if cache is not None else None
+            token = AWSMetadata._token(client, token_ttl, cache)
+            ok = AWSMetadata.reachable(client, token)
+            if not ok and cached_token:
+                # cached token rejected (e.g. IMDS restarted): get a fresh one
+                cache.drop_token()
+                token = AWSMetadata._token(client, token_ttl, cache)
+                ok = AWSMetadata.reachable(client, token)
+            if not ok:
+                sys.stderr.write("ERROR: AWS EC2 metadata service not reachable. Are you on EC2?\n")
+                return 2
 
         if args.full:
-            data = AWSMetadata.full(client, redact=not args.no_redact)
+            data = AWSMetadata.full(client, token, redact=not args.no_redact,
+                                    workers=args.workers, crawl=args.crawl, cache=cache)
             fmt = args.format or "json"
             if fmt == "json":
                 print(json.dumps(data, indent=2, sort_keys=True))
@@ -294,7 +605,7 @@ def main(argv: Optional[List[str]] = None) -> int:
                 print(json.dumps(data, indent=2, sort_keys=True))
                 print("```")
         else:
-            s = AWSMetadata.summary(client)
+            s = AWSMetadata.summary(client, token, workers=args.workers, cache=cache)
             fmt = args.format or "md"
             if fmt == "json":
                 print(json.dumps(asdict(s), indent=2, sort_keys=True))
@@ -304,6 +615,9 @@ def main(argv: Optional[List[str]] = None) -> int:
     except Exception as e:
         logging.exception("Unhandled error: %s", e)
         return 3
+    finally:
+        if cache is not None:
+            cache.save()
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+monitor_bench.py — benchmark the monitors' user-space pipeline without a kernel
+
+Runs sample-latency-monitor.py and sample-socket-monitor.py in --replay mode
+(synthetic records, or a --capture file) across a few output configurations
+and collects their --replay-report: events/sec, mean per-stage latency
+(decode, prepare, capture, dedup, enrich, format, output, prometheus) and
+memory per event: bytes and allocator blocks still held at the end, and the
+heap high-water mark per event while a batch is handled (what the hot path
+allocates). Needs neither root nor bcc, so it runs on any Linux CI box.
+
+Examples:
+  ./monitor_bench.py                                  # all scenarios, 100k synthetic events each
+  ./monitor_bench.py --events 500000 --only latency   # scenarios whose name contains "latency"
+  ./monitor_bench.py --out bench.json
+  ./monitor_bench.py --baseline bench.json --max-regression 15   # exit 1 on >15% events/sec drop
+
+Dependencies:
+  - Python 3 (prometheus_client for the prometheus scenario; skipped without it)
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LATENCY = os.path.join(HERE, "sample-latency-monitor.py")
+SOCKET = os.path.join(HERE, "sample-socket-monitor.py")
+
+# name -> (script, extra args); every run gets --replay/--log-file/--replay-report.
+# {port} is a free TCP port for the exporter, so the Prometheus path really runs.
+SCENARIOS = {
+    "latency-print": (LATENCY, []),
+    "latency-json": (LATENCY, ["--json"]),
+    "latency-json-prometheus": (LATENCY, ["--json", "--prometheus-port", "{port}"]),
+    "latency-prometheus-only": (LATENCY, ["--quiet", "--log-file", "", "--prometheus-port", "{port}"]),
+    "latency-capture": (LATENCY, ["--json", "--capture", "{tmp}/latency.evcap"]),
+    "latency-nodedup": (LATENCY, ["--json", "--dedup-window", "0"]),
+    "socket-print": (SOCKET, []),
+    "socket-capture": (SOCKET, ["--capture", "{tmp}/socket.evcap"]),
+}
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Replay benchmark for the monitors' user-space pipeline")
+    p.add_argument("--events", type=int, default=100000, help="Synthetic events per scenario")
+    p.add_argument("--source", default=None,
+                   help="Replay this capture instead of synthetic events (only scenarios for its monitor run)")
+    p.add_argument("--only", default=None, help="Run scenarios whose name contains this substring")
+    p.add_argument("--repeat", type=int, default=1, help="Runs per scenario; the best events/sec is kept")
+    p.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc pass (memory per event)")
+    p.add_argument("--out", default=None, help="Write all reports as JSON")
+    p.add_argument("--baseline", default=None, help="Earlier --out file to compare events/sec against")
+    p.add_argument("--max-regression", type=float, default=None,
+                   help="Exit 1 if any scenario's events/sec drops more than this percent vs --baseline")
+    return p.parse_args()
+
+def have_prometheus() -> bool:
+    try:
+        import prometheus_client  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def capture_source(path: str):
+    """Which monitor wrote a capture ('sample-latency-monitor' / 'sample-socket-monitor')."""
+    from event_capture import CaptureReader
+    reader = CaptureReader(path)
+    try:
+        return reader.header.get("source", "")
+    finally:
+        reader.close()
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def run_one(script, extra, source, tmp, tracemalloc_on=False):
+    report_path = os.path.join(tmp, "report.json")
+    cmd = [sys.executable, script, "--replay", source, "--log-file", os.path.join(tmp, "bench.log"),
+           "--replay-report", report_path] + [a.format(tmp=tmp, port=free_port()) for a in extra]
+    if tracemalloc_on:
+        cmd.append("--replay-tracemalloc")
+    res = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if res.returncode != 0:
+        raise RuntimeError(f"{os.path.basename(script)} failed ({res.returncode}): {res.stderr.strip()[-400:]}")
+    with open(report_path) as f:
+        return json.load(f)
+
+def run_scenario(name, script, extra, args):
+    source = args.source or f"synthetic:{args.events}"
+    with tempfile.TemporaryDirectory(prefix="monitor-bench-") as tmp:
+        best = None
+        for _ in range(max(1, args.repeat)):
+            report = run_one(script, extra, source, tmp)
+            if best is None or report["events_per_sec"] > best["events_per_sec"]:
+                best = report
+        if not args.no_memory:
+            # tracemalloc slows everything down; a smaller pass is enough for bytes/event
+            mem_source = args.source or f"synthetic:{max(1000, args.events // 5)}"
+            mem = run_one(script, extra, mem_source, tmp, tracemalloc_on=True)
+            for key in ("retained_bytes_per_event", "retained_blocks_per_event", "transient_bytes_per_event",
+                        "peak_heap_bytes"):
+                best[key] = mem.get(key)
+    best["scenario"] = name
+    return best
+
+def print_table(reports):
+    stages = []
+    for r in reports:
+        for s in r.get("stages", {}):
+            if s not in stages:
+                stages.append(s)
+    header = (f"{'scenario':<26}{'events/s':>11}" + "".join(f"{s[:10]:>11}" for s in stages)
+              + f"{'B/event':>10}{'blk/event':>11}{'hot B/ev':>10}")
+    print(header)
+    print("-" * len(header))
+    for r in reports:
+        cells = "".join(f"{r['stages'][s]['mean_us']:>9.2f}us" if s in r.get("stages", {}) else f"{'-':>11}"
+                        for s in stages)
+        mem = [r.get(k) for k in ("retained_bytes_per_event", "retained_blocks_per_event",
+                                  "transient_bytes_per_event")]
+        mem = [("-" if v is None else v) for v in mem]
+        print(f"{r['scenario']:<26}{r['events_per_sec']:>11.0f}{cells}{mem[0]:>10}{mem[1]:>11}{mem[2]:>10}")
+
+def compare(reports, baseline_path, max_regression):
+    with open(baseline_path) as f:
+        base = {r["scenario"]: r for r in json.load(f)["reports"]}
+    failed = []
+    print("\nvs baseline:")
+    for r in reports:
+        b = base.get(r["scenario"])
+        if not b or not b.get("events_per_sec"):
+            continue
+        change = (r["events_per_sec"] - b["events_per_sec"]) / b["events_per_sec"] * 100
+        flag = ""
+        if max_regression is not None and change < -max_regression:
+            failed.append(r["scenario"])
+            flag = "  REGRESSION"
+        print(f"  {r['scenario']:<26}{b['events_per_sec']:>11.0f} -> {r['events_per_sec']:>9.0f} "
+              f"({change:+.1f}%){flag}")
+    return failed
+
+def main():
+    args = parse_args()
+    scenarios = dict(SCENARIOS)
+    if not have_prometheus():
+        scenarios = {n: s for n, s in scenarios.items() if "prometheus" not in n}
+    if args.source:
+        monitor = capture_source(args.source)
+        script = LATENCY if "latency" in monitor else SOCKET
+        scenarios = {n: s for n, s in scenarios.items() if s[0] == script}
+    if args.only:
+        scenarios = {n: s for n, s in scenarios.items() if args.only in n}
+    if not scenarios:
+        sys.exit("no scenarios selected")
+
+    reports = []
+    for name, (script, extra) in scenarios.items():
+        print(f"[bench] {name} ...", file=sys.stderr)
+        try:
+            reports.append(run_scenario(name, script, extra, args))
+        except RuntimeError as e:
+            print(f"[bench] {name}: {e}", file=sys.stderr)
+            return 2
+
+    print_table(reports)
+    rc = 0
+    if args.baseline:
+        if compare(reports, args.baseline, args.max_regression):
+            rc = 1
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"events": args.events, "source": args.source, "reports": reports}, f, indent=2)
+            f.write("\n")
+    return rc
+
+if __name__ == "__main__":
+    sys.exit(main())
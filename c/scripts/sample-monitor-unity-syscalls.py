@@ -3,116 +3,472 @@
 """
 unity_syscall_trace.py — Trace all system calls made by the Unity process with verbosity
 
-This script uses eBPF to attach to specific syscall entry points invoked by the Unity server.
-It logs syscall names, originating thread PIDs, and arguments (when available), and writes to a log file.
+This script uses eBPF to trace the system calls made by the Unity servers on a host. One
+raw_syscalls:sys_enter/sys_exit program pair covers every syscall and every instance: the
+target check (TGID or cgroup in a BPF hash) and an in-kernel allowlist (syscall number -> slot, filled from --syscalls) reject
+everything else before any work is done, so probe overhead does not grow with the
+number of syscalls selected and nothing depends on arch-specific __x64_sys_* symbols.
+
+By default it counts calls and entry->exit latency in-kernel and prints a top-like table
+every --interval seconds plus a per-thread summary at the end; --mode events logs one
+line per call (syscall name, originating thread) to a log file instead.
+
+Targets are every running unityserver*.service (MainPID) by default, or --pid/--unit/
+--cgroup; they are re-discovered every --rescan seconds, so instances that start or stop
+are followed without recompiling, and all output is tagged with the instance name.
+
+Aggregate mode keeps per-CPU maps keyed by (tid, syscall) with count/total/max ns and a
+per-CPU log2 latency histogram per syscall, so nothing crosses to user space per call
+and a busy game tick (hundreds of thousands of epoll_wait/recvfrom/sendto per second)
+is not perturbed by the tracer.
 
 ---
 
 Options:
-  --pid <PID>            Manually specify Unity PID (default: autodetect via unityserver.service)
+  --pid <PID[,PID..]>    Target PIDs; repeatable (default: MainPID of each unityserver*.service)
+  --unit <glob>          systemd unit glob whose MainPIDs are targets; repeatable
+  --cgroup <path>        cgroup v2 directory whose tasks (and child cgroups' tasks) are targets; repeatable
+  --rescan <seconds>     Re-discover targets this often (default: 5, 0 = never)
   --duration <seconds>   How long to trace (default: 10s)
+  --syscalls <names>     Comma-separated syscall names, or "all" (default: socket/file I/O + epoll)
+  --mode aggregate|events  In-kernel counts/histograms (default) or one record per call
+  --interval <seconds>   Seconds between top tables in aggregate mode (default: 2)
+  --top <N>              Rows per table (default: 15)
   --logfile <path>       Optional output file for logs (default: ./unity_syscalls.log)
+  --transport perf|ringbuf  Kernel->user channel in events mode (default: perf)
+  --buffer-pages <N>     Perf pages per CPU / ring buffer pages (power of two)
+  --reorder-ms <ms>      Events mode: hold lines this long to print them in kernel-timestamp order (default: 50)
 
 Dependencies:
   - BCC (Python bindings)
   - Python3 + psutil
 
 Example:
-  sudo ./unity_syscall_trace.py --duration 15 --logfile trace.log
+  sudo ./unity_syscall_trace.py --duration 60 --interval 5
+  sudo ./unity_syscall_trace.py --unit 'unityserver@*.service' --duration 300
+  sudo ./unity_syscall_trace.py --pid 2987,3011 --cgroup unity.slice
+  sudo ./unity_syscall_trace.py --syscalls epoll_pwait,futex,clock_nanosleep,sched_yield
+  sudo ./unity_syscall_trace.py --mode events --duration 15 --logfile trace.log
 
 """
 
-from bcc import BPF
+from bcc.syscall import syscalls as SYSCALL_TABLE
 import argparse
-import subprocess
+import ctypes as ct
 import signal
 import time
 import psutil
+from collections import defaultdict
 from datetime import datetime
 
+from ebpf_common import (REC_TASK, EventTransport, KernelClock, RecordDecoder, ReorderBuffer, TargetSet,
+                         TaskDictionary, TaskRecord, add_reorder_args, add_target_args, add_transport_args,
+                         apply_transport, load_bpf, release_compiler, with_target_config, with_task_dictionary)
+
+DEFAULT_UNIT = "unityserver*.service"
+DEFAULT_SYSCALLS = ("read,write,recvfrom,sendto,openat,close,accept,accept4,connect,"
+                    "recvmsg,sendmsg,epoll_wait,epoll_pwait")
+
 parser = argparse.ArgumentParser()
-parser.add_argument("--pid", type=int, help="Unity server PID")
+add_target_args(parser, DEFAULT_UNIT)
 parser.add_argument("--duration", type=int, default=10, help="Duration in seconds")
+parser.add_argument("--syscalls", default=DEFAULT_SYSCALLS,
+                    help='Comma-separated syscall names to trace, or "all"')
+parser.add_argument("--mode", choices=["aggregate", "events"], default="aggregate",
+                    help="aggregate: counts and latency histograms in BPF maps (default); events: one line per call")
+parser.add_argument("--interval", type=float, default=2.0, help="Seconds between top tables (aggregate mode)")
+parser.add_argument("--top", type=int, default=15, help="Rows per table (aggregate mode)")
+parser.add_argument("--max-threads", type=int, default=16384,
+                    help="(thread, syscall) pairs tracked in-kernel per interval (aggregate mode)")
 parser.add_argument("--logfile", type=str, default="unity_syscalls.log", help="Path to log file")
+add_transport_args(parser)
+add_reorder_args(parser)
 args = parser.parse_args()
 
-def get_unity_pid():
-    try:
-        output = subprocess.getoutput("systemctl show --property=MainPID unityserver.service")
-        pid = int(output.strip().split('=')[1])
-        return pid if pid > 0 else None
-    except:
-        return None
-
-unity_pid = args.pid or get_unity_pid()
-if not unity_pid:
-    print("[!] Could not determine Unity PID. Use --pid manually.")
+def resolve_syscalls(spec, strict=True):
+    """'read,write' / 'all' -> [(nr, name)] through this architecture's syscall table.
+
+    Unknown names are an error when strict, otherwise skipped (the default set
+    names some syscalls, e.g. epoll_wait, that not every architecture has).
+    """
+    by_name = {name.decode(): nr for nr, name in SYSCALL_TABLE.items()}
+    if spec.strip() == "all":
+        return sorted((nr, name) for name, nr in by_name.items())
+    selected, unknown = [], []
+    for name in (n.strip() for n in spec.split(",")):
+        if not name:
+            continue
+        if name not in by_name:
+            unknown.append(name)
+        elif (by_name[name], name) not in selected:
+            selected.append((by_name[name], name))
+    if unknown and strict:
+        print(f"[!] Unknown syscall(s) on this architecture: {', '.join(unknown)}")
+        exit(1)
+    return selected
+
+targets = TargetSet.from_args(args, DEFAULT_UNIT)
+
+selected = resolve_syscalls(args.syscalls, strict=args.syscalls != DEFAULT_SYSCALLS)
+if not selected:
+    print("[!] No syscalls selected.")
     exit(1)
+syscall_names = [name for _, name in selected]     # slot -> name
 
-print(f"[+] Tracing selected syscalls from Unity PID {unity_pid} for {args.duration} seconds...\n")
+
+HIST_SLOTS = 64     # log2(ns) slots per syscall
 
 bpf_text = f'''
 #include <uapi/linux/ptrace.h>
 #include <linux/sched.h>
 
-struct data_t {{
-    u32 pid;
-    char comm[TASK_COMM_LEN];
-    char syscall[16];
+// events mode: 24 bytes per call; the thread's pid/comm are sent once per
+// thread as a REC_TASK record (TASK_DICTIONARY)
+#define REC_SYSCALL 2
+struct event_t {{
+    u8  version;       // REC_VERSION
+    u8  kind;          // REC_SYSCALL
+    u16 slot;          // index into the selected syscalls
+    u32 tid;
+    u64 ts_ns;         // bpf_ktime_get_ns() at entry
+    u32 tag;           // instance (TargetSet)
+    u32 pad;
 }};
 
-BPF_PERF_OUTPUT(events);
-'''
+EVENTS_OUTPUT
+TARGET_CONFIG
+TASK_DICTIONARY
+
+// syscall number -> slot; only numbers present here are traced
+BPF_HASH(sc_allow, u32, u32, {len(selected)});
 
-trace_fns = ""
-syscalls_to_trace = [
-    "__x64_sys_read", "__x64_sys_write", "__x64_sys_recvfrom", "__x64_sys_sendto",
-    "__x64_sys_openat", "__x64_sys_close", "__x64_sys_accept", "__x64_sys_connect",
-    "__x64_sys_recvmsg", "__x64_sys_sendmsg", "__x64_sys_epoll_wait"
-]
-
-for i, syscall in enumerate(syscalls_to_trace):
-    fn_name = f"trace_fn_{i}"
-    bpf_text += f'''
-int {fn_name}(struct pt_regs *ctx) {{
-    u32 pid = bpf_get_current_pid_tgid() >> 32;
-    if (pid != {unity_pid}) return 0;
-
-    struct data_t data = {{}};
-    data.pid = pid;
-    bpf_get_current_comm(&data.comm, sizeof(data.comm));
-    __builtin_strncpy(data.syscall, "{syscall}", sizeof(data.syscall));
-    events.perf_submit(ctx, &data, sizeof(data));
+#ifdef AGGREGATE
+struct stat_key_t {{
+    u32 tid;
+    u32 sc;            // slot
+    u32 tag;
+}};
+struct stat_val_t {{
+    u64 count;
+    u64 total_ns;
+    u64 max_ns;
+}};
+// per-CPU: sys_exit updates without atomics or cross-CPU cache traffic
+BPF_PERCPU_HASH(sc_stats, struct stat_key_t, struct stat_val_t, MAX_THREADS);
+BPF_PERCPU_ARRAY(sc_hist, u64, {len(selected) * HIST_SLOTS});
+// a thread is in at most one syscall at a time; LRU because exit/exit_group
+// (and a successful execve) never reach sys_exit with the entry we stored
+BPF_TABLE("lru_hash", u32, u64, sc_entry_ts, MAX_THREADS);
+#endif
+
+TRACEPOINT_PROBE(raw_syscalls, sys_enter) {{
+    u64 id = bpf_get_current_pid_tgid();
+    u32 tag = target_tag(id);
+    if (!tag) return 0;
+    u32 nr = args->id;
+    u32 *slot = sc_allow.lookup(&nr);
+    if (!slot) return 0;
+    u32 tid = id;
+#ifdef AGGREGATE
+    u64 ts = bpf_ktime_get_ns();
+    sc_entry_ts.update(&tid, &ts);
+#else
+    announce_task(args);
+    struct event_t data = {{}};
+    data.version = REC_VERSION;
+    data.kind = REC_SYSCALL;
+    data.slot = *slot;
+    data.tid = tid;
+    data.ts_ns = bpf_ktime_get_ns();
+    data.tag = tag;
+    SUBMIT_EVENT(args, data);
+#endif
     return 0;
 }}
+
+#ifdef AGGREGATE
+TRACEPOINT_PROBE(raw_syscalls, sys_exit) {{
+    u64 id = bpf_get_current_pid_tgid();
+    u32 tag = target_tag(id);
+    if (!tag) return 0;
+    u32 tid = id;
+    u64 *tsp = sc_entry_ts.lookup(&tid);
+    if (!tsp) return 0;     // not selected, or entered before attach
+    u64 delta = bpf_ktime_get_ns() - *tsp;
+    sc_entry_ts.delete(&tid);
+    u32 nr = args->id;
+    u32 *slotp = sc_allow.lookup(&nr);
+    if (!slotp) return 0;
+    u32 sc = *slotp;
+
+    struct stat_key_t key = {{}};
+    key.tid = tid;
+    key.sc = sc;
+    key.tag = tag;
+    struct stat_val_t zero = {{}};
+    struct stat_val_t *val = sc_stats.lookup_or_try_init(&key, &zero);
+    if (val) {{
+        val->count++;
+        val->total_ns += delta;
+        if (delta > val->max_ns) val->max_ns = delta;
+    }}
+
+    u32 slot = bpf_log2l(delta);
+    if (slot >= {HIST_SLOTS}) slot = {HIST_SLOTS - 1};
+    int idx = sc * {HIST_SLOTS} + slot;
+    u64 *cnt = sc_hist.lookup(&idx);
+    if (cnt) (*cnt)++;
+    return 0;
+}}
+#endif
 '''
 
-b = BPF(text=bpf_text)
+try:
+    bpf_text = apply_transport(with_task_dictionary(with_target_config(bpf_text, bool(args.cgroup)),
+                                                    args.mode == "events"),
+                               args.transport, args.buffer_pages)
+except ValueError as e:
+    print(f"[!] {e}")
+    exit(1)
 
-for i, syscall in enumerate(syscalls_to_trace):
-    try:
-        b.attach_kprobe(event=syscall, fn_name=f"trace_fn_{i}")
-    except Exception as e:
-        print(f"[!] Failed to attach to {syscall}: {e}")
-        continue
+cflags = [f"-DMAX_THREADS={max(1024, args.max_threads)}"]
+if args.mode == "aggregate":
+    cflags.append("-DAGGREGATE")
+# TRACEPOINT_PROBE attaches itself on load: one program pair whatever --syscalls says.
+# The text only depends on the number of syscalls selected; pids and the
+# syscall numbers themselves are map contents.
+b = load_bpf(bpf_text, cflags, "unity-syscalls")
+release_compiler(b)
+
+allow = b["sc_allow"]
+for slot, (nr, _name) in enumerate(selected):
+    allow[ct.c_uint32(nr)] = ct.c_uint32(slot)
 
 log_file = open(args.logfile, "w")
 
-def print_event(cpu, data, size):
-    event = b["events"].event(data)
-    ts = datetime.now().strftime("%H:%M:%S")
-    msg = f"[{ts}] PID {event.pid} ({event.comm.decode(errors='ignore')}) called {event.syscall.decode(errors='ignore')}"
+def sync_targets():
+    added, removed = targets.sync(b)
+    for name in added:
+        print(f"[+] Tracing instance {name}")
+    for name in removed:
+        print(f"[-] Instance {name} is gone")
+
+sync_targets()
+if not targets.tags:
+    if not args.rescan:
+        print("[!] No target processes found. Use --pid, --unit or --cgroup.")
+        exit(1)
+    print(f"[!] No target processes yet; looking again every {args.rescan:g}s")
+print(f"[+] Tracing {len(selected)} syscalls for {args.duration} seconds...\n")
+
+# --- aggregate mode: periodic top table from the per-CPU maps ---
+thread_comms = {}
+hist_seen = {}      # sc_hist index -> cumulative count at the last read
+
+def thread_comm(tid):
+    comm = thread_comms.get(tid)
+    if comm is None:
+        try:
+            with open(f"/proc/{tid}/comm") as f:
+                comm = f.read().strip()
+        except OSError:
+            comm = "?"      # thread already gone
+        thread_comms[tid] = comm
+    return comm
+
+batch_delete = True     # BPF_MAP_LOOKUP_AND_DELETE_BATCH usable (kernel 5.6+, recent BCC)
+
+def drain(table):
+    """[(key, per-CPU values)], each entry removed as it is read so no update is lost."""
+    global batch_delete
+    out = []
+    if batch_delete:
+        try:
+            for k, v in table.items_lookup_and_delete_batch():
+                out.append((k, v))
+            return out
+        except Exception:
+            batch_delete = False
+    # fallback: delete each key right after reading it (what is left of the map)
+    for k in list(table.keys()):
+        try:
+            v = table[k]
+            del table[k]
+        except KeyError:
+            continue
+        out.append((k, v))
+    return out
+
+def read_interval():
+    """Counts since the last call: ({(tag, tid, sc): [count, total_ns, max_ns]}, {sc: [per-slot counts]})."""
+    stats = {}
+    for k, per_cpu in drain(b["sc_stats"]):
+        stats[(k.tag, k.tid, k.sc)] = [sum(v.count for v in per_cpu), sum(v.total_ns for v in per_cpu),
+                                max(v.max_ns for v in per_cpu)]
+    # the histogram array is cumulative (per-CPU arrays cannot be deleted from);
+    # diff against the previous read
+    hist = defaultdict(lambda: [0] * HIST_SLOTS)
+    for k, per_cpu in b["sc_hist"].items():
+        n = sum(per_cpu)
+        delta = n - hist_seen.get(k.value, 0)
+        if delta:
+            hist_seen[k.value] = n
+            hist[k.value // HIST_SLOTS][k.value % HIST_SLOTS] = delta
+    return stats, hist
+
+def hist_quantile_us(counts, q):
+    """Upper bound of quantile q from log2(ns) slots, in microseconds."""
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank, acc = q * total, 0
+    for slot, n in enumerate(counts):
+        acc += n
+        if acc >= rank:
+            return (1 << slot) / 1000.0
+    return (1 << (HIST_SLOTS - 1)) / 1000.0
+
+def emit(line):
+    print(line)
+    log_file.write(line + "\n")
+
+def print_top(stats, hist, elapsed):
+    per_sc = defaultdict(lambda: [0, 0, 0])
+    per_instance = defaultdict(lambda: [0, 0, defaultdict(int)])
+    per_thread = defaultdict(lambda: [0, 0])
+    for (tag, tid, sc), (count, total, peak) in stats.items():
+        agg = per_sc[sc]
+        agg[0] += count
+        agg[1] += total
+        agg[2] = max(agg[2], peak)
+        inst = per_instance[tag]
+        inst[0] += count
+        inst[1] += total
+        inst[2][sc] += total
+        per_thread[(tag, tid)][0] += count
+        per_thread[(tag, tid)][1] += total
+
+    emit(f"--- {datetime.now().strftime('%H:%M:%S')}  {len(targets.tags)} instance(s)  ({elapsed:.1f}s) ---")
+    emit(f"{'SYSCALL':<14} {'COUNT':>10} {'RATE/s':>10} {'AVG_US':>9} {'P50_US':>9} {'P99_US':>9} {'MAX_US':>10}")
+    for sc, (count, total, peak) in sorted(per_sc.items(), key=lambda kv: -kv[1][1])[:args.top]:
+        counts = hist.get(sc, [0] * HIST_SLOTS)
+        emit(f"{syscall_names[sc]:<14} {count:>10} {count / elapsed:>10.0f} "
+             f"{total / count / 1000.0:>9.1f} {hist_quantile_us(counts, 0.50):>9.1f} "
+             f"{hist_quantile_us(counts, 0.99):>9.1f} {peak / 1000.0:>10.1f}")
+    emit(f"{'INSTANCE':<28} {'CALLS':>10} {'RATE/s':>10} {'SYSCALL_MS':>11}  TOP")
+    for tag, (count, total, by_sc) in sorted(per_instance.items(), key=lambda kv: -kv[1][1])[:args.top]:
+        top_sc = max(by_sc, key=by_sc.get)
+        emit(f"{targets.name(tag):<28} {count:>10} {count / elapsed:>10.0f} {total / 1e6:>11.2f}  "
+             f"{syscall_names[top_sc]}")
+    emit(f"{'INSTANCE':<28} {'TID':>8} {'THREAD':<16} {'CALLS':>10} {'SYSCALL_MS':>11}")
+    for (tag, tid), (count, total) in sorted(per_thread.items(), key=lambda kv: -kv[1][1])[:args.top]:
+        emit(f"{targets.name(tag):<28} {tid:>8} {thread_comm(tid):<16} {count:>10} {total / 1e6:>11.2f}")
+    emit("")
+
+def print_thread_summary(totals, elapsed):
+    """Whole-run view: per thread, its busiest syscalls by time spent."""
+    per_thread = defaultdict(list)
+    for (tag, tid, sc), (count, total, peak) in totals.items():
+        per_thread[(tag, tid)].append((total, count, peak, sc))
+    emit(f"=== per-thread summary, {elapsed:.1f}s ===")
+    ranked = sorted(per_thread.items(), key=lambda kv: -sum(t for t, _, _, _ in kv[1]))
+    for (tag, tid), rows in ranked[:args.top]:
+        calls = sum(c for _, c, _, _ in rows)
+        spent = sum(t for t, _, _, _ in rows)
+        emit(f"{targets.name(tag)} {tid:>8} {thread_comm(tid):<16} {calls:>10} calls "
+             f"{spent / 1e6:>10.2f} ms in syscalls")
+        for total, count, peak, sc in sorted(rows, reverse=True)[:5]:
+            emit(f"{'':>10}{syscall_names[sc]:<14} {count:>10} "
+                 f"avg {total / count / 1000.0:>8.1f} us  max {peak / 1000.0:>9.1f} us")
+
+def run_aggregate():
+    totals = defaultdict(lambda: [0, 0, 0])
+    start = last = next_scan = time.time()
+    deadline = start + args.duration
+    try:
+        while time.time() < deadline:
+            time.sleep(max(0.0, min(args.interval, deadline - time.time())))
+            if args.rescan and time.time() >= next_scan:
+                sync_targets()
+                next_scan = time.time() + args.rescan
+            stats, hist = read_interval()
+            now = time.time()
+            print_top(stats, hist, max(now - last, 1e-6))
+            last = now
+            for key, (count, total, peak) in stats.items():
+                acc = totals[key]
+                acc[0] += count
+                acc[1] += total
+                acc[2] = max(acc[2], peak)
+    except KeyboardInterrupt:
+        print("\n[!] Tracing interrupted.")
+    print_thread_summary(totals, time.time() - start)
+
+# --- events mode: one line per call ---
+REC_SYSCALL = 2
+
+class SyscallEvent(ct.Structure):
+    """ctypes mirror of struct event_t."""
+    _fields_ = [("version", ct.c_uint8), ("kind", ct.c_uint8), ("slot", ct.c_uint16),
+                ("tid", ct.c_uint32), ("ts_ns", ct.c_uint64), ("tag", ct.c_uint32),
+                ("pad", ct.c_uint32)]
+
+tasks = TaskDictionary()
+clock = KernelClock()
+
+def print_event(event):
+    wall_ns = clock.wall_ns(event.ts_ns)
+    ts = datetime.fromtimestamp(wall_ns // 1000 / 1e6).strftime("%H:%M:%S.%f")
+    pid, _ppid, _uid, _cgroup_id, comm = tasks.get(event.tid)
+    msg = (f"[{ts}] {targets.name(event.tag)} PID {pid} TID {event.tid} "
+           f"({comm}) called {syscall_names[event.slot]}")
     print(msg)
     log_file.write(msg + "\n")
 
-b["events"].open_perf_buffer(print_event)
+def run_events():
+    transport = EventTransport(b, args.transport, args.buffer_pages,
+                               decoder=RecordDecoder({REC_TASK: TaskRecord, REC_SYSCALL: SyscallEvent}))
+    # per-CPU streams merged by entry time; task records apply immediately so
+    # the dictionary is current by the time a held event is printed
+    reorder = ReorderBuffer(args.reorder_ms * 1e6, args.reorder_max)
 
-try:
-    timeout = time.time() + args.duration
-    while time.time() < timeout:
-        b.perf_buffer_poll()
-except KeyboardInterrupt:
-    print("\n[!] Tracing interrupted.")
-
-log_file.close()
-print(f"\n[+] Syscall trace complete. Log saved to {args.logfile}")
+    def print_batch(records):
+        for raw in records:
+            event = transport.decode(raw)
+            if event is None:
+                continue
+            if event.kind == REC_TASK:
+                tasks.learn(event)
+            else:
+                reorder.push(event.ts_ns, event)
+
+    transport.open(print_batch)
+
+    try:
+        timeout = time.time() + args.duration
+        next_scan = time.time() + args.rescan
+        while time.time() < timeout:
+            transport.poll()
+            for event in reorder.pop_ready(time.monotonic_ns()):
+                print_event(event)
+            clock.maybe_recalibrate()
+            if args.rescan and time.time() >= next_scan:
+                sync_targets()
+                next_scan = time.time() + args.rescan
+    except KeyboardInterrupt:
+        print("\n[!] Tracing interrupted.")
+    for event in reorder.drain():
+        print_event(event)
+    if reorder.late or reorder.forced:
+        print(f"[!] {reorder.late} event(s) arrived after --reorder-ms, "
+              f"{reorder.forced} released early (--reorder-max)")
+    return transport.lost()
+
+if args.mode == "aggregate":
+    run_aggregate()
+    log_file.close()
+    print(f"\n[+] Syscall trace complete. Log saved to {args.logfile}")
+else:
+    lost = run_events()
+    log_file.close()
+    print(f"\n[+] Syscall trace complete ({lost} events lost). Log saved to {args.logfile}")
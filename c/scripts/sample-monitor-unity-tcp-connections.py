@@ -3,9 +3,9 @@
 """
 unity_tcp_monitor.py – Unity Server TCP Connection Tracer
 
-This BCC/eBPF-based tool traces incoming **TCP connections** to a Unity game server
-on a **specific port (default: 7777)** and reports remote IPs, ports, and resolves
-the PID of the Unity server listener. The tracing occurs at the kernel level and
+This BCC/eBPF-based tool traces incoming **TCP connections** to the Unity game servers
+on a host (every port their listeners own, or --port) and reports remote IPs, ports,
+and the instance / PID of the Unity server listener. The tracing occurs at the kernel level and
 is filtered for `TCP_ESTABLISHED` states only, ensuring only successful connections
 are reported.
 
@@ -13,8 +13,12 @@ are reported.
 
 Summary
 
-• Target Port:
-    - Hardcoded to Unity server TCP port `7777`
+• Targets:
+    - Every running `unityserver*.service` by default, or --pid / --unit / --cgroup
+    - Their listening ports go into a BPF hash (port -> instance tag); re-synced every
+      --rescan seconds, so instances that start, stop or move ports are followed by
+      one compiled program and one perf consumer
+    - --port watches given ports only; with no target found, port 7777 as before
 • Tracepoint:
     - Hooks `tcp_set_state()` to ensure connections are fully negotiated
 • Trigger Condition:
@@ -22,10 +26,11 @@ Summary
 • Reported Data:
     - Remote client IP and port
     - Server port
-    - PID of the Unity server (resolved via `ss -ntpln`)
+    - Instance name and PID of the Unity server (resolved via `ss -ntlp`)
 • Safety:
     - Uses `bpf_probe_read_kernel()` for verified safe access
-    - User-space `ss` is used instead of unreliable kernel PID tracking
+    - User-space `ss` is used instead of unreliable kernel PID tracking; the kernel
+      side only matches the local port against the map
 
 ---
 
@@ -48,7 +53,8 @@ Implementation Notes
 • Why is PID resolved in user-space?
     - `tcp_set_state()` may run in kernel context or softirq
     - Kernel context lacks access to reliable `task_struct` → `pid`
-    - So we run `ss -ntpln` once at startup and extract the `pid=` field
+    - So we map listening ports to their owners with `ss -ntlp` (at startup and on
+      every rescan) and tag events by local port
 
 • IPv4 only:
     - Uses `inet_ntop(AF_INET)` for simplicity
@@ -66,21 +72,34 @@ nc -vz 10.200.0.183 7777
 shows:
 Monitoring fully established TCP connections on Unity port 7777...
 
-[CONNECTED] Unity:7777 <= 10.100.10.150:43896 (pid 2987)
-[CONNECTED] Unity:7777 <= 10.100.10.150:43906 (pid 2987)
-[CONNECTED] Unity:7777 <= 10.100.10.150:43910 (pid 2987)
-[CONNECTED] Unity:7777 <= 10.100.10.150:43912 (pid 2987)
+[CONNECTED] unityserver@1.service:7777 <= 10.100.10.150:43896 (pid 2987)
+[CONNECTED] unityserver@1.service:7777 <= 10.100.10.150:43906 (pid 2987)
+[CONNECTED] unityserver@2.service:7778 <= 10.100.10.150:43910 (pid 3011)
+[CONNECTED] unityserver@2.service:7778 <= 10.100.10.150:43912 (pid 3011)
 
 ---
 """
 
-from bcc import BPF
+import argparse
+import ctypes as ct
+import os
+import re
 import socket
 import struct
 import subprocess
+import time
+
+from ebpf_common import TargetSet, add_target_args, load_bpf, release_compiler
 
 PORT = 7777
 TCP_ESTABLISHED = 1
+DEFAULT_UNIT = "unityserver*.service"
+
+parser = argparse.ArgumentParser(description="Unity server TCP connection tracer")
+add_target_args(parser, DEFAULT_UNIT)
+parser.add_argument("--port", type=int, action="append", default=[],
+                    help="Only watch these local ports; repeatable (default: every port the targets listen on)")
+args = parser.parse_args()
 
 bpf_text = f"""
 #include <uapi/linux/ptrace.h>
@@ -92,8 +111,10 @@ struct data_t {{
     u32 daddr;
     u16 sport;
     u16 dport;
+    u32 tag;           // instance owning the listening port
 }};
 BPF_PERF_OUTPUT(events);
+BPF_HASH(target_ports, u16, u32, 1024);   // local port -> instance tag
 
 int trace_tcp_state(struct pt_regs *ctx, struct sock *sk, int state) {{
     if (state != {TCP_ESTABLISHED})
@@ -103,12 +124,14 @@ int trace_tcp_state(struct pt_regs *ctx, struct sock *sk, int state) {{
     bpf_probe_read_kernel(&sport, sizeof(sport), &sk->__sk_common.skc_num);
     bpf_probe_read_kernel(&dport, sizeof(dport), &sk->__sk_common.skc_dport);
     dport = ntohs(dport);
-    if (sport != {PORT})
+    u32 *tag = target_ports.lookup(&sport);
+    if (!tag)
         return 0;
 
     struct data_t data = {{
         .sport = sport,
-        .dport = dport
+        .dport = dport,
+        .tag = *tag
     }};
     bpf_probe_read_kernel(&data.saddr, sizeof(data.saddr), &sk->__sk_common.skc_rcv_saddr);
     bpf_probe_read_kernel(&data.daddr, sizeof(data.daddr), &sk->__sk_common.skc_daddr);
@@ -121,31 +144,91 @@ int trace_tcp_state(struct pt_regs *ctx, struct sock *sk, int state) {{
 def ip(addr):
     return socket.inet_ntop(socket.AF_INET, struct.pack("I", addr))
 
-def find_unity_pid():
+USERS_RX = re.compile(r'\("([^"]*)",pid=(\d+)')
+
+def listen_owners():
+    """{local port: (pid, comm)} for listening TCP sockets, from `ss -ntlp`."""
+    owners = {}
     try:
-        output = subprocess.getoutput("ss -ntpln")
+        output = subprocess.getoutput("ss -ntlpH")
         for line in output.splitlines():
-            if f":{PORT} " in line and "pid=" in line:
-                return line.split("pid=")[1].split(",")[0]
-    except:
+            fields = line.split()
+            if len(fields) < 4:
+                continue
+            port = int(fields[3].rsplit(":", 1)[1])
+            m = USERS_RX.search(line)
+            if m:
+                owners.setdefault(port, (int(m.group(2)), m.group(1)))
+    except (OSError, ValueError, IndexError):
         pass
-    return "?"
+    return owners
 
-unity_pid = find_unity_pid()
+targets = TargetSet.from_args(args, DEFAULT_UNIT)
+watched = {}        # port -> (tag, pid)
+
+def in_cgroups(pid):
+    """True if pid lives in (or below) one of the --cgroup directories."""
+    try:
+        with open(f"/proc/{pid}/cgroup") as f:
+            path = next((line.split(":", 2)[2].strip() for line in f if line.startswith("0::")), "")
+    except OSError:
+        return False
+    for cgroup in args.cgroup:
+        rel = "/" + (os.path.relpath(cgroup, targets.cgroup_root) if cgroup.startswith("/sys/") else cgroup.strip("/"))
+        if path == rel or path.startswith(rel + "/"):
+            return True
+    return False
+
+def sync_ports():
+    """Point target_ports at the current instances' listening ports (only the differences)."""
+    owners = listen_owners()
+    pids, _cgroups = targets.discover()
+    want = {}
+    for port, (pid, comm) in owners.items():
+        if args.port and port not in args.port:
+            continue
+        if pid in pids:
+            want[port] = (targets.tag(pids[pid]), pid)
+        elif args.cgroup and in_cgroups(pid):
+            want[port] = (targets.tag(f"{comm}[{pid}]"), pid)
+    # explicit ports are watched even without a known owner; with nothing
+    # discovered at all, fall back to the classic single server on 7777
+    for port in args.port or ([] if want or pids else [PORT]):
+        if port not in want:
+            pid, comm = owners.get(port, (0, "Unity"))
+            want[port] = (targets.tag(f"{comm}[{pid}]" if pid else comm), pid)
+
+    table = b["target_ports"]
+    for port in [p for p in watched if watched[p] != want.get(p)]:
+        del table[ct.c_uint16(port)]
+        tag, pid = watched.pop(port)
+        print(f"[-] {targets.name(tag)}:{port} no longer watched")
+    for port, (tag, pid) in want.items():
+        if port not in watched:
+            table[ct.c_uint16(port)] = ct.c_uint32(tag)
+            watched[port] = (tag, pid)
+            print(f"[+] Watching {targets.name(tag)}:{port} (pid {pid or '?'})")
 
 def handle_event(cpu, data, size):
     e = b["events"].event(data)
     d_ip = ip(e.daddr)
-    print(f"[CONNECTED] Unity:{e.sport} <= {d_ip}:{e.dport} (pid {unity_pid})")
+    pid = watched.get(e.sport, (0, 0))[1]
+    print(f"[CONNECTED] {targets.name(e.tag)}:{e.sport} <= {d_ip}:{e.dport} (pid {pid or '?'})")
 
-b = BPF(text=bpf_text)
+b = load_bpf(bpf_text, label="unity-tcp")
 b.attach_kprobe(event="tcp_set_state", fn_name="trace_tcp_state")
+release_compiler(b)
 
-print(f"Monitoring fully established TCP connections on Unity port {PORT}...\n")
+sync_ports()
+print(f"Monitoring fully established TCP connections on {len(watched)} Unity port(s)...\n")
 b["events"].open_perf_buffer(handle_event)
 
 try:
+    next_scan = time.time() + args.rescan
     while True:
-        b.perf_buffer_poll()
+        b.perf_buffer_poll(timeout=1000)
+        if args.rescan and time.time() >= next_scan:
+            sync_ports()
+            next_scan = time.time() + args.rescan
 except KeyboardInterrupt:
     print("Monitor stopped.")
@@ -13,10 +13,15 @@ Tracks TCP retransmissions (tcp_retransmit_skb tracepoint), a key indicator of n
 Logs the process ID (PID) and command name (COMM) associated with each connection.
 Logs connection details (source/destination IP and port, process ID, and state) to /var/log/socket_monitor.log.
 Skips noisy or invalid entries, like connections with IP 0.0.0.0.
+Applies --pid/--src-ip/--dst-ip/--src-port/--dst-port/--active-only in the BPF program via a config map, so filtered events never reach user space.
 Maps TCP states to human-readable descriptions.
 Formats IP addresses for readability.
-Uses perf_buffer for real-time event handling.
+Uses perf_buffer (default) or a shared ring buffer (--transport ringbuf) for real-time event handling.
+Stamps every event in the kernel (bpf_ktime_get_ns) and converts it to wall-clock time through a calibrated offset, so timestamps are accurate to the microsecond without a syscall per event; events are held --reorder-ms (default 50) and merged across the per-CPU buffers in timestamp order, so each connection's lifecycle is logged in sequence.
 Can run continuously and provide live updates via the console and log file.
+Optionally keeps a compact columnar capture of raw events (--capture FILE) for offline queries with sample-capture-query.py.
+Can replay recorded captures or synthetic events through the same pipeline without root/bcc (--replay, --replay-report) to benchmark events/sec and per-stage latency.
+Writes the log from a background thread in batches, rotating by size/age (--log-max-bytes, --log-rotate-secs, --log-compress) and dropping per --log-drop-policy if the disk falls behind.
 
 Real-Time Logging: Captures and logs socket connections as they occur.
 Detailed Insights: Provides source and destination IP addresses, ports, PIDs, command names, and TCP states.
@@ -30,7 +35,6 @@ Enhances operational awareness for system administrators managing critical infra
 
 LIMITATIONS:
 IP4 only (wip)
-Need to add Dynamic Filters / pid/ip/ports
 Enhance Error Handling
 Perfomance Tuning
 
@@ -47,6 +51,8 @@ For the script version simply ensure you have python 3.11+
 pip install bcc
 python3 /root/scripts/socket-snoop.py
 
+Keep ebpf_common.py in the same directory as the script.
+
 or as a service 
 
 cat <<EOF > /etc/systemd/system/sockets-monitor.service
@@ -163,21 +169,35 @@ Each state change is associated with the process managing it (e.g., sshd-session
 """
 
 import argparse
+import ctypes as ct
 import hashlib
 import os
 import sys
+import time
 from datetime import datetime
-from collections import deque
+
+from event_capture import SOCKET_SCHEMA, CaptureWriter
+from ebpf_common import (DedupWindow, EventTransport, KernelClock, ReorderBuffer, ReplayTransport, add_dedup_args,
+                         add_log_args, add_reorder_args, add_replay_args, add_transport_args, apply_transport,
+                         load_bpf, log_writer_from_args, ipv4_arg, release_compiler, replay_filter,
+                         replay_records, set_filter_config_from_args, with_filter_config)
 
 def parse_args():
     p = argparse.ArgumentParser(description="Enhanced Socket Monitoring Script")
     p.add_argument("--pid", type=int, default=None, help="Filter by PID")
-    p.add_argument("--src-ip", type=str, default=None, help="Filter by source IPv4")
-    p.add_argument("--dst-ip", type=str, default=None, help="Filter by destination IPv4")
+    p.add_argument("--src-ip", type=ipv4_arg, default=None, help="Filter by source IPv4")
+    p.add_argument("--dst-ip", type=ipv4_arg, default=None, help="Filter by destination IPv4")
     p.add_argument("--src-port", type=int, default=None, help="Filter by source port")
     p.add_argument("--dst-port", type=int, default=None, help="Filter by destination port")
     p.add_argument("--active-only", action="store_true", help="Only established connections")
     p.add_argument("--log-file", default=os.environ.get("SOCKET_SNOOP_LOG", "/var/log/socket_monitor.log"))
+    add_log_args(p)
+    add_dedup_args(p, 2000)
+    p.add_argument("--capture", type=str, default=None,
+                   help="Also write raw events to a compact columnar capture (see sample-capture-query.py)")
+    add_transport_args(p)
+    add_reorder_args(p)
+    add_replay_args(p)
     return p.parse_args()
 
 BPF_PROGRAM = r"""
@@ -188,6 +208,7 @@ BPF_PROGRAM = r"""
 #include <bcc/proto.h>
 
 struct data_t {
+    u64 ts_ns;         // bpf_ktime_get_ns() at the state change
     u32 pid;
     u32 ppid;
     char comm[TASK_COMM_LEN];
@@ -199,13 +220,15 @@ struct data_t {
     char event[16];
     u32 uid;
 };
-BPF_PERF_OUTPUT(events);
+EVENTS_OUTPUT
+FILTER_CONFIG
 
 TRACEPOINT_PROBE(sock, inet_sock_set_state) {
     if (args->family != AF_INET)
         return 0;
 
     struct data_t data = {};
+    data.ts_ns = bpf_ktime_get_ns();
     u64 pid_tgid = bpf_get_current_pid_tgid();
     data.pid = pid_tgid >> 32;
     data.uid = bpf_get_current_uid_gid();
@@ -233,8 +256,11 @@ TRACEPOINT_PROBE(sock, inet_sock_set_state) {
     data.dst_port = ntohs(args->dport);
     data.state = args->newstate;
 
+    if (filtered_out(data.pid, data.src_ip, data.dst_ip, data.src_port, data.dst_port, data.state))
+        return 0;
+
     __builtin_strncpy(data.event, "State Change", sizeof(data.event));
-    events.perf_submit(args, &data, sizeof(data));
+    SUBMIT_EVENT(args, data);
     return 0;
 }
 """
@@ -253,6 +279,44 @@ TCP_STATES = {
     11: "Connection Closing (CLOSING)",
 }
 
+class SocketEvent(ct.Structure):
+    """ctypes mirror of struct data_t, for --replay (live runs use BCC's own class)."""
+    _fields_ = [
+        ("ts_ns", ct.c_uint64), ("pid", ct.c_uint32), ("ppid", ct.c_uint32), ("comm", ct.c_char * 16),
+        ("src_ip", ct.c_uint32), ("dst_ip", ct.c_uint32), ("src_port", ct.c_uint16), ("dst_port", ct.c_uint16),
+        ("state", ct.c_int), ("event", ct.c_char * 16), ("uid", ct.c_uint32),
+    ]
+
+SYNTHETIC_COMMS = [b"sshd", b"nginx", b"curl", b"UnityServer", b"swapper/0"]
+SYNTHETIC_LIFECYCLE = (2, 1, 4, 5, 6, 7)   # SYN_SENT -> ESTABLISHED -> FIN_WAIT1/2 -> TIME_WAIT -> CLOSE
+
+def synthetic_event(i: int, rng) -> SocketEvent:
+    """Connections over ~4k flows, each walking a normal TCP lifecycle."""
+    flow = rng.randrange(4096)
+    ev = SocketEvent()
+    ev.pid = 1000 + flow % 128
+    ev.ppid = 1
+    ev.uid = 0 if flow % 3 else 1000
+    ev.comm = SYNTHETIC_COMMS[flow % len(SYNTHETIC_COMMS)]
+    ev.src_ip = 0x0A640A96
+    ev.dst_ip = 0x0A640A00 | (flow % 200)
+    ev.src_port = (22, 80, 443)[flow % 3]
+    ev.dst_port = 32768 + flow
+    ev.state = SYNTHETIC_LIFECYCLE[(i + flow) % len(SYNTHETIC_LIFECYCLE)]
+    ev.event = b"State Change"
+    return ev
+
+def event_from_row(row: dict) -> SocketEvent:
+    """SOCKET_SCHEMA capture row -> SocketEvent."""
+    ev = SocketEvent()
+    ev.pid, ev.ppid, ev.uid, ev.comm = row["pid"], row["ppid"], row["uid"], row["comm"]
+    ev.src_ip, ev.dst_ip, ev.src_port, ev.dst_port = row["src_ip"], row["dst_ip"], row["src_port"], row["dst_port"]
+    ev.state = row["state"]
+    ev.event = b"State Change"
+    return ev
+
+LOG_HEADER = "Enhanced Socket Monitoring Log\n" + "=" * 60 + "\n"
+
 def format_ip(ip_u32: int) -> str:
     return ".".join(str((ip_u32 >> s) & 0xFF) for s in (24, 16, 8, 0))
 
@@ -271,35 +335,69 @@ def main():
     try:
         if not os.path.exists(log_file):
             with open(log_file, "w") as f:
-                f.write("Enhanced Socket Monitoring Log\n" + "=" * 60 + "\n")
+                f.write(LOG_HEADER)
     except PermissionError:
         print(f"Warning: cannot write to {log_file}; falling back to ./socket_monitor.log", file=sys.stderr)
         log_file = "./socket_monitor.log"
 
-    from bcc import BPF   # lazy import so tests don’t need bcc
-    b = BPF(text=BPF_PROGRAM)
+    clock = KernelClock()
+    if args.replay:
+        t0 = time.monotonic_ns()
+
+        def synthesize(i, rng):
+            ev = synthetic_event(i, rng)
+            # 20us apart and up to 2ms out of order, like per-CPU buffers read in turn
+            ev.ts_ns = t0 + i * 20000 + rng.randrange(2000000)
+            return ev
+
+        def from_row(row):
+            ev = event_from_row(row)
+            ev.ts_ns = max(0, clock.ktime_ns(row["ts_ns"]))
+            return ev
+
+        try:
+            records = replay_records(args.replay, synthesize, from_row, replay_filter(args, "pid"))
+        except (OSError, ValueError) as e:
+            print(f"Error: cannot replay {args.replay}: {e}", file=sys.stderr)
+            sys.exit(2)
+        transport = ReplayTransport(SocketEvent, records, args.replay_rate, args.replay_loops,
+                                    report=bool(args.replay_report), tracemalloc_on=args.replay_tracemalloc)
+    else:
+        try:
+            text = apply_transport(with_filter_config(BPF_PROGRAM), args.transport, args.buffer_pages)
+        except ValueError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(2)
+
+        b = load_bpf(text, label="socket")   # imports bcc lazily, so replay runs without it
+        release_compiler(b)
+        set_filter_config_from_args(b, args)
+        transport = EventTransport(b, args.transport, args.buffer_pages)
+    timer = getattr(transport, "timer", None)   # per-stage timing, replay reports only
 
     metrics = {
         "active_connections": 0,
         "closing_connections": 0,
         "closed_connections": 0,
     }
-    recent_events = deque(maxlen=2000)
+    recent_events = DedupWindow(args.dedup_window, args.dedup_ttl)
+    reorder = ReorderBuffer(args.reorder_ms * 1e6, args.reorder_max)
 
-    def handle_event(cpu, data, size):
-        event = b["events"].event(data)
+    def handle_event(event):
         state_str = TCP_STATES.get(event.state, "UNKNOWN STATE")
-        timestamp = datetime.now().strftime("%b %d %Y %H:%M:%S.%f")[:-3]
+        wall_ns = clock.wall_ns(event.ts_ns)
+        timestamp = datetime.fromtimestamp(wall_ns // 1000 / 1e6).strftime("%b %d %Y %H:%M:%S.%f")[:-3]
 
         src_ip = format_ip(event.src_ip)
         dst_ip = format_ip(event.dst_ip)
+        if timer: timer.mark("prepare")
 
-        if args.pid and event.pid != args.pid: return
-        if args.src_ip and src_ip != args.src_ip: return
-        if args.dst_ip and dst_ip != args.dst_ip: return
-        if args.src_port and event.src_port != args.src_port: return
-        if args.dst_port and event.dst_port != args.dst_port: return
-        if args.active_only and event.state != 1: return
+        # --pid/--src-ip/--dst-ip/--src-port/--dst-port/--active-only run in-kernel (filter_cfg)
+
+        if capture:
+            capture.append((wall_ns, event.pid, event.ppid, event.uid, event.src_ip, event.dst_ip,
+                            event.src_port, event.dst_port, event.state, event.comm))
+            if timer: timer.mark("capture")
 
         if event.state == 1:
             metrics["active_connections"] += 1
@@ -312,12 +410,14 @@ def main():
 
         event_key = (src_ip, int(event.src_port), dst_ip, int(event.dst_port),
                      int(event.pid), int(event.state))
-        if event_key in recent_events:
+        duplicate = recent_events.seen(event_key)
+        if timer: timer.mark("dedup")
+        if duplicate:
             return
-        recent_events.append(event_key)
 
         entry = {
             "timestamp": timestamp,
+            "ts_ns": wall_ns,
             "event": event.event.decode(errors="ignore"),
             "src_ip": src_ip,
             "dst_ip": dst_ip,
@@ -332,21 +432,51 @@ def main():
             "uid": int(event.uid),
             "comm": event.comm.decode(errors="ignore"),
         }
+        if timer: timer.mark("format")
 
         print(entry)
-        try:
-            with open(log_file, "a") as f:
-                f.write(str(entry) + "\n")
-        except Exception as e:
-            print(f"Log write failed: {e}", file=sys.stderr)
-
-    b["events"].open_perf_buffer(handle_event)
-    print(f"Monitoring socket connections. Logging to {log_file}")
+        log_sink.write(str(entry))
+        if timer: timer.mark("output")
+
+    log_sink = log_writer_from_args(log_file, LOG_HEADER, args)
+    capture = CaptureWriter(args.capture, SOCKET_SCHEMA, source="sample-socket-monitor") if args.capture else None
+
+    def handle_batch(records):
+        for raw in records:
+            if timer: timer.start()
+            event = transport.decode(raw)
+            reorder.push(event.ts_ns, event)
+            if timer: timer.mark("decode")
+
+    def release(events):
+        for event in events:
+            if timer: timer.start()
+            handle_event(event)
+
+    transport.open(handle_batch)
+    print(f"Monitoring socket connections ({args.transport} transport). Logging to {log_file}")
     try:
-        while True:
-            b.perf_buffer_poll()
+        while not transport.done:
+            transport.poll()
+            # replays carry their own timestamps: only the event-time watermark applies
+            release(reorder.pop_ready(None if args.replay else time.monotonic_ns()))
+            clock.maybe_recalibrate()
     except KeyboardInterrupt:
-        print("\nStopping monitoring...")
+        pass
+    release(reorder.drain())
+    log_sink.close()
+    if capture:
+        capture.close()
+        print(f"\nCapture: {capture.rows} events in {args.capture}")
+    if args.replay_report:
+        transport.write_report(args.replay_report, args.replay, duplicates=recent_events.suppressed,
+                               log_lines_dropped=log_sink.dropped)
+        print(f"Replay report: {args.replay_report}")
+    if reorder.late or reorder.forced:
+        print(f"{reorder.late} events arrived after --reorder-ms, "
+              f"{reorder.forced} released early (--reorder-max)", file=sys.stderr)
+    print(f"\nStopping monitoring... {transport.lost()} events lost, "
+          f"{recent_events.suppressed} duplicates suppressed, {log_sink.dropped} log lines dropped.")
 
 if __name__ == "__main__":
     main()